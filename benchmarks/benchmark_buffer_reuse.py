@@ -0,0 +1,162 @@
+"""
+Count tensor allocations per denoising step with and without buffer reuse.
+
+Only the denoising loop around the UNet is measured: classifier-free guidance,
+guidance rescaling, duplication of the latent and the scheduler step. Allocations
+and time of the UNet itself, which buffer reuse does not change, are excluded, as
+are prompt encoding and decoding.
+
+On CUDA the allocation count is read from the caching allocator. On CPU, operators
+that allocate memory are counted with the PyTorch profiler. Times are measured in
+separate runs without the profiler.
+
+Usage:
+    python benchmarks/benchmark_buffer_reuse.py --device cpu --batch-size 4
+"""
+
+import argparse
+import time
+import torch
+
+from torch.profiler import ProfilerActivity, profile, record_function
+
+from stablefused import TextToImageDiffusion
+
+
+def is_inside(event, name: str) -> bool:
+    while event is not None:
+        if event.name == name:
+            return True
+        event = event.cpu_parent
+    return False
+
+
+class LoopMeter:
+    """
+    Measures time and CUDA allocations spent in the denoising loop, minus the time
+    and allocations of the UNet calls, by wrapping `denoise` and the model call.
+    """
+
+    def __init__(self, model: TextToImageDiffusion) -> None:
+        self.model = model
+        self.cuda = model.device == "cuda"
+        self.reset()
+
+        denoise = model.denoise
+
+        def timed_denoise(*args, **kwargs):
+            self._sync()
+            allocations = self._allocations()
+            start = time.perf_counter()
+            with record_function("denoise_loop"):
+                result = denoise(*args, **kwargs)
+            self._sync()
+            self.loop_time += time.perf_counter() - start
+            self.loop_allocations += self._allocations() - allocations
+            return result
+
+        def timed_model_call(call_model, latent_model_input, timestep, embedding):
+            self._sync()
+            allocations = self._allocations()
+            start = time.perf_counter()
+            with record_function("unet"):
+                noise = call_model(latent_model_input, timestep, embedding)
+            self._sync()
+            self.unet_time += time.perf_counter() - start
+            self.unet_allocations += self._allocations() - allocations
+            return noise
+
+        model.denoise = timed_denoise
+        model.add_denoise_hook("model_call", timed_model_call)
+
+    def reset(self) -> None:
+        self.loop_time = self.unet_time = 0.0
+        self.loop_allocations = self.unet_allocations = 0
+
+    def _sync(self) -> None:
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    def _allocations(self) -> int:
+        if self.cuda:
+            return torch.cuda.memory_stats()["allocation.all.allocated"]
+        return 0
+
+
+def run(model: TextToImageDiffusion, meter: LoopMeter, args) -> dict:
+    kwargs = dict(
+        prompt=[args.prompt] * args.batch_size,
+        image_height=args.image_dim,
+        image_width=args.image_dim,
+        num_inference_steps=args.num_inference_steps,
+        guidance_rescale=args.guidance_rescale,
+        output_type="latent",
+    )
+
+    # Warmup
+    model(**kwargs)
+
+    # Time of the loop without the UNet, and of the whole loop, best of all repeats
+    loop_times, total_times = [], []
+    for _ in range(args.repeats):
+        meter.reset()
+        model(**kwargs)
+        loop_times.append(meter.loop_time - meter.unet_time)
+        total_times.append(meter.loop_time)
+
+    meter.reset()
+    if meter.cuda:
+        model(**kwargs)
+        allocations = meter.loop_allocations - meter.unet_allocations
+    else:
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            model(**kwargs)
+        allocations = sum(
+            1
+            for event in prof.events()
+            if event.self_cpu_memory_usage > 0
+            and is_inside(event, "denoise_loop")
+            and not is_inside(event, "unet")
+        )
+
+    return {
+        "allocations_per_step": allocations / args.num_inference_steps,
+        "loop_time_per_step": min(loop_times) / args.num_inference_steps,
+        "total_time_per_step": min(total_times) / args.num_inference_steps,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--prompt", default="a photo of a cat")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--image-dim", type=int, default=64)
+    parser.add_argument("--num-inference-steps", type=int, default=10)
+    parser.add_argument("--guidance-rescale", type=float, default=0.7)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    model = TextToImageDiffusion(model_id=args.model_id, device=args.device)
+    meter = LoopMeter(model)
+
+    for reuse_buffers in [False, True]:
+        if reuse_buffers:
+            model.enable_buffer_reuse()
+        else:
+            model.disable_buffer_reuse()
+        torch.manual_seed(0)
+        result = run(model, meter, args)
+        print(
+            f"reuse_buffers={reuse_buffers}: "
+            f"{result['allocations_per_step']:.1f} allocations/step outside the UNet, "
+            f"{result['loop_time_per_step'] * 1000:.3f} ms/step outside the UNet, "
+            f"{result['total_time_per_step'] * 1000:.3f} ms/step in total"
+        )
+
+
+if __name__ == "__main__":
+    main()
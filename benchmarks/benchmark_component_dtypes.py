@@ -0,0 +1,85 @@
+"""
+Compare a float32 pipeline with a mixed precision pipeline on CPU: a bfloat16 UNet
+and text encoder, with a float32 VAE and float32 latents. Reports denoising latency,
+weight memory and drift of the generated images, with and without autocast.
+
+bfloat16 is only faster on CPUs with native bfloat16 matrix instructions, such as
+AVX512-BF16 or AMX. On other CPUs it is emulated and usually slower than float32.
+
+Usage:
+    python benchmarks/benchmark_component_dtypes.py --image-dim 512 --num-inference-steps 20
+"""
+
+import argparse
+import time
+import torch
+
+from stablefused import TextToImageDiffusion
+from stablefused.utils import ModelCache
+
+
+def time_call(model: TextToImageDiffusion, kwargs: dict, repeats: int) -> float:
+    # Warmup
+    model(**kwargs, output_type="latent")
+
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model(**kwargs, output_type="latent")
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--prompt", default="a photo of a cat")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--image-dim", type=int, default=64)
+    parser.add_argument("--num-inference-steps", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = TextToImageDiffusion(model_id=args.model_id, device="cpu")
+    mixed = TextToImageDiffusion(
+        model_id=args.model_id,
+        device="cpu",
+        component_dtypes={"unet": torch.bfloat16, "text_encoder": torch.bfloat16},
+    )
+
+    latent_dim = args.image_dim // model.vae_scale_factor
+    kwargs = dict(
+        prompt=[args.prompt] * args.batch_size,
+        image_height=args.image_dim,
+        image_width=args.image_dim,
+        num_inference_steps=args.num_inference_steps,
+        latent=model.random_tensor(
+            (args.batch_size, model.unet.config.in_channels, latent_dim, latent_dim)
+        ),
+    )
+    images = model(**kwargs, output_type="np")
+
+    for name, pipeline, autocast in [
+        ("float32", model, False),
+        ("bfloat16 unet", mixed, True),
+        ("bfloat16 unet without autocast", mixed, False),
+    ]:
+        if autocast:
+            pipeline.enable_autocast()
+        else:
+            pipeline.disable_autocast()
+        elapsed = time_call(pipeline, kwargs, args.repeats)
+        sizes = ModelCache.size_of(pipeline)
+        drift = abs(images - pipeline(**kwargs, output_type="np"))
+        print(
+            f"{name}: {elapsed * 1000:.3f}ms, "
+            f"unet {sizes['unet'] / 2**20:.2f}MiB, "
+            f"text_encoder {sizes['text_encoder'] / 2**20:.2f}MiB, "
+            f"image drift max {drift.max():.4f} mean {drift.mean():.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
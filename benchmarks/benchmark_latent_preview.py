@@ -0,0 +1,75 @@
+"""
+Compare the cost of decoding previews with the VAE, the calibrated linear
+latent-to-RGB decoder and, optionally, a tiny autoencoder.
+
+Usage:
+    python benchmarks/benchmark_latent_preview.py --device cpu --image-dim 512
+    python benchmarks/benchmark_latent_preview.py --fast-vae path/to/taesd
+"""
+
+import argparse
+import time
+import torch
+
+from stablefused import TextToImageDiffusion
+
+
+def time_decode(
+    model: TextToImageDiffusion,
+    latent: torch.FloatTensor,
+    decoder: str,
+    repeats: int,
+    device: str,
+) -> float:
+    # Warmup, which also calibrates the linear decoder
+    model.latent_to_image(latent, "pt", decoder)
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.latent_to_image(latent, "pt", decoder)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+@torch.no_grad()
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--image-dim", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument(
+        "--fast-vae",
+        default=None,
+        help="Directory containing tiny autoencoder weights",
+    )
+    args = parser.parse_args()
+
+    model = TextToImageDiffusion(model_id=args.model_id, device=args.device)
+    latent_dim = args.image_dim // model.vae_scale_factor
+    latent = model.random_tensor(
+        (args.batch_size, model.unet.config.in_channels, latent_dim, latent_dim)
+    )
+
+    start = time.perf_counter()
+    model.calibrate_linear_latent_decoder()
+    print(f"calibration: {time.perf_counter() - start:.4f}s")
+
+    decoders = ["vae", "linear"]
+    if args.fast_vae is not None:
+        model.set_fast_vae(args.fast_vae, enable=False)
+        decoders.append("tiny")
+
+    for decoder in decoders:
+        elapsed = time_decode(model, latent, decoder, args.repeats, args.device)
+        print(f"{decoder}: {elapsed * 1000:.3f}ms per preview")
+
+
+if __name__ == "__main__":
+    main()
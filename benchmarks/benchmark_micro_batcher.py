@@ -0,0 +1,75 @@
+"""
+Compare the throughput of concurrent single-prompt requests run one at a time with
+`__call__` against running them through the MicroBatcher.
+
+Usage:
+    python benchmarks/benchmark_micro_batcher.py --device cpu --num-requests 16
+"""
+
+import argparse
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from stablefused import MicroBatcher, TextToImageDiffusion
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--prompt", default="a photo of a cat")
+    parser.add_argument("--num-requests", type=int, default=16)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait", type=float, default=0.01)
+    parser.add_argument("--image-dim", type=int, default=64)
+    parser.add_argument("--num-inference-steps", type=int, default=10)
+    args = parser.parse_args()
+
+    model = TextToImageDiffusion(model_id=args.model_id, device=args.device)
+    kwargs = dict(
+        image_height=args.image_dim,
+        image_width=args.image_dim,
+        num_inference_steps=args.num_inference_steps,
+        output_type="np",
+    )
+    prompts = [f"{args.prompt} {i}" for i in range(args.num_requests)]
+
+    # Warmup
+    model(prompt=prompts[0], **kwargs)
+
+    # Without batching, concurrent callers are serialized on the model
+    lock = threading.Lock()
+
+    def call(prompt: str) -> None:
+        with lock:
+            model(prompt=prompt, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=args.num_requests) as pool:
+        start = time.perf_counter()
+        list(pool.map(call, prompts))
+        unbatched = time.perf_counter() - start
+
+    with MicroBatcher(
+        model, max_batch_size=args.max_batch_size, max_wait=args.max_wait
+    ) as batcher:
+        with ThreadPoolExecutor(max_workers=args.num_requests) as pool:
+            start = time.perf_counter()
+            futures = list(
+                pool.map(lambda prompt: batcher.submit(prompt, **kwargs), prompts)
+            )
+            for future in futures:
+                future.result()
+            batched = time.perf_counter() - start
+
+    print(f"unbatched: {args.num_requests / unbatched:.3f} requests/s")
+    print(f"batched: {args.num_requests / batched:.3f} requests/s")
+    for name, value in batcher.metrics().items():
+        print(f"{name}: {value:.4f}")
+
+
+if __name__ == "__main__":
+    main()
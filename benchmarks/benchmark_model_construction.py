@@ -0,0 +1,78 @@
+"""
+Measure the construction time of pipelines on a cold and a hot model cache.
+
+The cold start loads the weights of the model. Hot starts create pipelines of
+every class from the components of the cached pipeline.
+
+Usage:
+    python benchmarks/benchmark_model_construction.py --device cpu --repeats 10
+    python benchmarks/benchmark_model_construction.py --lazy-components vae
+    python benchmarks/benchmark_model_construction.py --num-load-workers 1
+"""
+
+import argparse
+import time
+
+from stablefused import (
+    ImageToImageDiffusion,
+    LatentWalkDiffusion,
+    TextToImageDiffusion,
+    clear_model_cache,
+    model_cache_info,
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument(
+        "--lazy-components",
+        nargs="*",
+        default=[],
+        help="Components to load on first use, any of text_encoder, vae and unet",
+    )
+    parser.add_argument(
+        "--num-load-workers",
+        type=int,
+        default=None,
+        help="Threads used to load components, one per component by default",
+    )
+    args = parser.parse_args()
+
+    kwargs = dict(
+        model_id=args.model_id,
+        device=args.device,
+        lazy_components=args.lazy_components,
+        num_load_workers=args.num_load_workers,
+    )
+
+    # Warmup, which also downloads the weights if required
+    TextToImageDiffusion(**kwargs, use_cache=False)
+
+    cold = []
+    for _ in range(args.repeats):
+        clear_model_cache()
+        start = time.perf_counter()
+        model = TextToImageDiffusion(**kwargs)
+        cold.append(time.perf_counter() - start)
+    print(f"cold TextToImageDiffusion: {min(cold) * 1000:.3f}ms")
+    for name, elapsed in model.load_timings.items():
+        print(f"  {name}: {elapsed * 1000:.3f}ms")
+
+    for cls in [TextToImageDiffusion, ImageToImageDiffusion, LatentWalkDiffusion]:
+        hot = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            cls(**kwargs)
+            hot.append(time.perf_counter() - start)
+        print(f"hot {cls.__name__}: {min(hot) * 1000:.3f}ms")
+
+    print(model_cache_info())
+
+
+if __name__ == "__main__":
+    main()
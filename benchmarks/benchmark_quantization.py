@@ -0,0 +1,76 @@
+"""
+Compare float32 and dynamic int8 quantized pipelines on CPU: denoising latency,
+weight memory of the quantized components, and drift of the generated images.
+
+Usage:
+    python benchmarks/benchmark_quantization.py --image-dim 512 --num-inference-steps 20
+"""
+
+import argparse
+import time
+import torch
+
+from stablefused import TextToImageDiffusion
+from stablefused.utils import ModelCache
+
+
+def time_call(model: TextToImageDiffusion, kwargs: dict, repeats: int) -> float:
+    # Warmup
+    model(**kwargs, output_type="latent")
+
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model(**kwargs, output_type="latent")
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--prompt", default="a photo of a cat")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--image-dim", type=int, default=64)
+    parser.add_argument("--num-inference-steps", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = TextToImageDiffusion(model_id=args.model_id, device="cpu")
+    quantized = TextToImageDiffusion(model_id=args.model_id, device="cpu")
+    quantized.quantize("dynamic_int8")
+
+    latent_dim = args.image_dim // model.vae_scale_factor
+    kwargs = dict(
+        prompt=[args.prompt] * args.batch_size,
+        image_height=args.image_dim,
+        image_width=args.image_dim,
+        num_inference_steps=args.num_inference_steps,
+        latent=model.random_tensor(
+            (args.batch_size, model.unet.config.in_channels, latent_dim, latent_dim)
+        ),
+    )
+
+    for name, pipeline in [("float32", model), ("dynamic_int8", quantized)]:
+        elapsed = time_call(pipeline, kwargs, args.repeats)
+        sizes = ModelCache.size_of(pipeline)
+        print(
+            f"{name}: {elapsed * 1000:.3f}ms, "
+            f"unet {sizes['unet'] / 2**20:.2f}MiB, "
+            f"text_encoder {sizes['text_encoder'] / 2**20:.2f}MiB"
+        )
+
+    images = model(**kwargs, output_type="np")
+    quantized_images = quantized(**kwargs, output_type="np")
+    drift = abs(images - quantized_images)
+    print(f"image drift: max {drift.max():.4f}, mean {drift.mean():.4f}")
+    print(
+        "quantized layers: "
+        + ", ".join(f"{k} {len(v)}" for k, v in quantized.quantized_modules.items())
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compare the startup time of pipelines loaded from a model id and from a snapshot
+saved with `save_snapshot`.
+
+Both are measured with a warm page cache. Run every variant in a fresh process, for
+example with `--mode`, to measure the startup of a new worker.
+
+Usage:
+    python benchmarks/benchmark_snapshot.py --device cpu --snapshot-dir /tmp/snapshot
+    python benchmarks/benchmark_snapshot.py --mode snapshot --snapshot-dir /tmp/snapshot
+"""
+
+import argparse
+import os
+import time
+import torch
+
+from stablefused import TextToImageDiffusion
+
+
+def time_load(load, repeats: int) -> float:
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        load()
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--snapshot-dir", default="snapshot")
+    parser.add_argument("--torch-dtype", default="float32")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--mode", choices=["both", "model_id", "snapshot"], default="both"
+    )
+    args = parser.parse_args()
+
+    torch_dtype = getattr(torch, args.torch_dtype)
+    kwargs = dict(device=args.device, use_cache=False)
+
+    if not os.path.exists(args.snapshot_dir):
+        model = TextToImageDiffusion(
+            model_id=args.model_id, torch_dtype=torch_dtype, **kwargs
+        )
+        model.save_snapshot(args.snapshot_dir)
+
+    if args.mode in ["both", "model_id"]:
+        elapsed = time_load(
+            lambda: TextToImageDiffusion(
+                model_id=args.model_id, torch_dtype=torch_dtype, **kwargs
+            ),
+            args.repeats,
+        )
+        print(f"model_id: {elapsed * 1000:.3f}ms")
+
+    if args.mode in ["both", "snapshot"]:
+        elapsed = time_load(
+            lambda: TextToImageDiffusion.from_snapshot(args.snapshot_dir, **kwargs),
+            args.repeats,
+        )
+        print(f"snapshot: {elapsed * 1000:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compare the throughput of running jobs one after another with `__call__` against
+running them through the StagedExecutor, which overlaps text encoding, denoising,
+decoding and post-processing of consecutive jobs.
+
+Usage:
+    python benchmarks/benchmark_staged_executor.py --device cpu --num-jobs 8
+"""
+
+import argparse
+import time
+import torch
+
+from stablefused import StagedExecutor, TextToImageDiffusion
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--model-id", default="hf-internal-testing/tiny-stable-diffusion-pipe"
+    )
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--prompt", default="a photo of a cat")
+    parser.add_argument("--num-jobs", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--image-dim", type=int, default=64)
+    parser.add_argument("--num-inference-steps", type=int, default=10)
+    parser.add_argument("--max-queue-size", type=int, default=2)
+    args = parser.parse_args()
+
+    model = TextToImageDiffusion(model_id=args.model_id, device=args.device)
+    # Distinct prompts, so that the embedding cache does not hide the encode stage
+    jobs = [
+        dict(
+            prompt=[f"{args.prompt} {i} {j}" for j in range(args.batch_size)],
+            image_height=args.image_dim,
+            image_width=args.image_dim,
+            num_inference_steps=args.num_inference_steps,
+            output_type="pil",
+        )
+        for i in range(args.num_jobs)
+    ]
+    model.disable_embedding_cache()
+
+    # Warmup
+    model(**jobs[0])
+
+    start = time.perf_counter()
+    for job in jobs:
+        model(**job)
+    sequential = time.perf_counter() - start
+
+    with StagedExecutor(model, max_queue_size=args.max_queue_size) as executor:
+        start = time.perf_counter()
+        list(executor.map(jobs))
+        staged = time.perf_counter() - start
+
+    print(f"torch threads: {torch.get_num_threads()}")
+    print(f"sequential: {args.num_jobs / sequential:.3f} jobs/s")
+    print(f"staged: {args.num_jobs / staged:.3f} jobs/s")
+    print(
+        "stage busy time: "
+        + ", ".join(f"{k}={v:.3f}s" for k, v in executor.stage_times.items())
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,51 @@
 .. include:: ../README.md
 """
 
-from .diffusion import (
-    BaseDiffusion,
-    ImageToImageDiffusion,
-    LatentWalkDiffusion,
-    TextToImageDiffusion,
-    TextToVideoDiffusion,
-)
+from .utils.lazy_import import attach as _attach
 
-from .typing import (
-    UNet,
-    Scheduler,
-)
 
-from .utils import (
-    denormalize,
-    image_grid,
-    lerp,
-    load_model_from_cache,
-    normalize,
-    numpy_to_pil,
-    numpy_to_pt,
-    pil_to_numpy,
-    pil_to_video,
-    pt_to_numpy,
-    save_model_to_cache,
-    slerp,
+# Submodules are imported on first use of their attributes, so that importing the
+# package does not import diffusers, transformers and other heavy dependencies
+__getattr__, __dir__, __all__ = _attach(
+    __name__,
+    {
+        ".diffusion": [
+            "BaseDiffusion",
+            "DiffusionStepEvent",
+            "ImageToImageDiffusion",
+            "LatentWalkDiffusion",
+            "TextToImageDiffusion",
+            "TextToVideoDiffusion",
+        ],
+        ".models": [
+            "TinyAutoencoder",
+        ],
+        ".serving": [
+            "ContinuousBatcher",
+            "MicroBatcher",
+            "StagedExecutor",
+        ],
+        ".typing": [
+            "UNet",
+            "Scheduler",
+        ],
+        ".utils": [
+            "clear_model_cache",
+            "denormalize",
+            "image_grid",
+            "lerp",
+            "load_model_from_cache",
+            "model_cache_info",
+            "normalize",
+            "numpy_to_pil",
+            "numpy_to_pt",
+            "numpy_to_uint8",
+            "pil_to_numpy",
+            "pil_to_video",
+            "pt_to_numpy",
+            "resize_model_cache",
+            "save_model_to_cache",
+            "slerp",
+        ],
+    },
 )
@@ -1,4 +1,4 @@
-from .base_diffusion import BaseDiffusion
+from .base_diffusion import BaseDiffusion, DiffusionStepEvent
 from .image_to_image_diffusion import ImageToImageDiffusion
 from .latent_walk_diffusion import LatentWalkDiffusion
 from .text_to_image_diffusion import TextToImageDiffusion
@@ -1,30 +1,168 @@
+import contextlib
+import copy
+import functools
+import inspect
+import json
+import math
+import os
+import time
 import numpy as np
 import torch
 
 from PIL import Image
 from abc import ABC, abstractmethod
-from diffusers import (
-    AutoencoderKL,
-    DiffusionPipeline,
-)
+from diffusers import AutoencoderKL
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
-from typing import Any, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
+from stablefused.models import TinyAutoencoder
 from stablefused.typing import UNet, Scheduler
 from stablefused.utils import (
+    EmbeddingCache,
+    LatentHistory,
+    LazyComponent,
+    LinearLatentDecoder,
+    ModelCache,
+    PIPELINE_COMPONENTS,
+    QUANTIZATION_MODES,
     denormalize,
+    is_snapshot,
+    load_component,
+    load_component_classes,
+    load_component_config,
+    load_latent_decoder_from_cache,
     load_model_from_cache,
     normalize,
     numpy_to_pil,
     numpy_to_pt,
     pil_to_numpy,
     pt_to_numpy,
+    quantize_dynamic_int8,
+    refresh_model_in_cache,
+    replace_model_in_cache,
+    run_parallel,
+    save_latent_decoder_to_cache,
     save_model_to_cache,
+    save_snapshot,
 )
 
 
+# Keys of `component_dtypes`. `latent` is the dtype of latents, noise predictions and
+# scheduler math, which stay in full precision when the UNet runs in half precision.
+DTYPE_POLICY_KEYS = ["text_encoder", "vae", "unet", "latent"]
+
+
+class DiffusionStepEvent(NamedTuple):
+    """
+    Event yielded by the streaming generation API after every denoising step.
+
+    Attributes
+    ----------
+    step: int
+        Index of the denoising step, starting from 0.
+    num_steps: int
+        Total number of denoising steps.
+    timestep: torch.Tensor
+        The scheduler timestep of the step.
+    latent: torch.FloatTensor
+        The latent after the scheduler step.
+    preview: Union[torch.Tensor, np.ndarray, List[Image.Image]], optional
+        A preview of the images decoded from the latent, if requested for this step.
+    """
+
+    step: int
+    num_steps: int
+    timestep: torch.Tensor
+    latent: torch.FloatTensor
+    preview: Optional[Union[torch.Tensor, np.ndarray, List[Image.Image]]] = None
+
+
+class _Component:
+    """
+    Attribute holding a model component that may be a `LazyComponent`, in which case
+    the component is loaded on first access.
+    """
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = f"_{name}"
+
+    def __get__(self, instance: Any, owner: type = None) -> Any:
+        if instance is None:
+            return self
+        component = instance.__dict__[self.name]
+        if isinstance(component, LazyComponent):
+            component = component.load()
+            instance.__dict__[self.name] = component
+            refresh_model_in_cache(instance)
+        return component
+
+    def __set__(self, instance: Any, component: Any) -> None:
+        instance.__dict__[self.name] = component
+
+
 class BaseDiffusion(ABC):
+    """
+    Base class of the diffusion pipelines. It holds the tokenizer, text encoder, VAE,
+    UNet and scheduler, and implements the denoising loop shared by all pipelines.
+
+    Parameters
+    ----------
+    model_id: str, optional
+        Model id or local directory of the pipeline, or of a snapshot saved with
+        `save_snapshot`. If None, all components must be passed explicitly.
+    tokenizer: CLIPTokenizer, optional
+        The tokenizer, used when `model_id` is None.
+    text_encoder: CLIPTextModel, optional
+        The text encoder, used when `model_id` is None.
+    vae: AutoencoderKL, optional
+        The VAE, used when `model_id` is None.
+    unet: UNet, optional
+        The UNet, used when `model_id` is None.
+    scheduler: Scheduler, optional
+        The scheduler, used when `model_id` is None.
+    torch_dtype: torch.dtype
+        Dtype to load model weights in. Components passed explicitly are only cast
+        when listed in `component_dtypes`.
+    device: str
+        The device to run the model on.
+    use_cache: bool
+        Whether to share components with pipelines of the same model through the
+        model cache.
+    lazy_components: List[str], optional
+        Components to load on first use instead of on construction. Any of
+        `text_encoder`, `vae` and `unet`.
+    num_load_workers: int, optional
+        Number of threads used to load components. If None, one per component.
+    component_dtypes: Dict[str, torch.dtype], optional
+        Dtypes overriding `torch_dtype` per component. Keys are any of
+        `text_encoder`, `vae`, `unet` and `latent`, where `latent` is the dtype of
+        latents and scheduler math. For example, a bfloat16 UNet and text encoder
+        with a float32 VAE and float32 latents. Components passed explicitly are cast
+        in place to the dtype listed for them.
+    use_autocast: bool
+        Whether to run the UNet in an autocast region when its dtype is a half
+        precision dtype different from the latent dtype. See `enable_autocast`.
+    kwargs
+        Arguments passed to `from_pretrained` of the components they apply to, such
+        as `variant` or `revision`.
+    """
+
+    text_encoder = _Component()
+    vae = _Component()
+    unet = _Component()
+
     def __init__(
         self,
         model_id: str = None,
@@ -36,12 +174,38 @@ class BaseDiffusion(ABC):
         torch_dtype: torch.dtype = torch.float32,
         device="cuda",
         use_cache=True,
+        lazy_components: Optional[List[str]] = None,
+        num_load_workers: Optional[int] = None,
+        component_dtypes: Optional[Dict[str, torch.dtype]] = None,
+        use_autocast: bool = True,
         *args,
         **kwargs,
     ) -> None:
+        if args:
+            raise TypeError(
+                f"{type(self).__name__} got unexpected positional arguments: {args}"
+            )
+        component_dtypes = component_dtypes or {}
+        invalid = set(component_dtypes) - set(DTYPE_POLICY_KEYS)
+        if invalid:
+            raise ValueError(
+                f"`component_dtypes` keys must be a subset of {DTYPE_POLICY_KEYS}, got {sorted(invalid)}"
+            )
+
         self.device: str = device
         self.torch_dtype: torch.dtype = torch_dtype
+        # Components not listed in `component_dtypes` use `torch_dtype`
+        self.component_dtypes: Dict[str, torch.dtype] = {
+            name: component_dtypes.get(name, torch_dtype) for name in DTYPE_POLICY_KEYS
+        }
+        self.use_autocast: bool = use_autocast
         self.model_id: str = model_id
+        self.variant: Optional[str] = kwargs.get("variant")
+        self.num_load_workers: Optional[int] = num_load_workers
+        self.use_cache: bool = use_cache
+        self.quantization: Optional[str] = None
+        self.quantized_modules: Dict[str, List[str]] = {}
+        self.load_timings: Dict[str, float] = {}
 
         self.tokenizer: CLIPTokenizer
         self.text_encoder: CLIPTextModel
@@ -49,8 +213,35 @@ class BaseDiffusion(ABC):
         self.unet: UNet
         self.scheduler: Scheduler
         self.vae_scale_factor: int
+        self.embedding_cache: EmbeddingCache = EmbeddingCache()
+        self.use_embedding_cache: bool = True
+        self.text_encoder_batch_size: int = 64
+        self.reuse_buffers: bool = False
+        self.unconditional_reuse_interval: int = 1
+        self.unconditional_reuse_mode: str = "reuse"
+        self.denoise_stats: Dict[str, int] = {}
+        self.latent_history_storage: str = "device"
+        self.latent_history_stride: int = 1
+        self.latent_history_directory: Optional[str] = None
+        self.decode_batch_size: int = 8
+        self.linear_latent_decoder: Optional[LinearLatentDecoder] = None
+        self.fast_vae: Optional[TinyAutoencoder] = None
+        self.use_fast_vae: bool = False
+        self.denoise_hooks: Dict[str, List[Callable]] = {
+            "pre_step": [],
+            "model_call": [],
+            "post_step": [],
+        }
+
+        # Look up the cache before loading any weights, so that a pipeline of any class
+        # is created from the components of a pipeline loaded earlier
+        cached_model = None
+        if use_cache and model_id is not None:
+            cached_model = load_model_from_cache(ModelCache.key_of(self), None)
 
-        if model_id is None:
+        if cached_model is not None:
+            self.share_components_with(cached_model)
+        elif model_id is None:
             if (
                 tokenizer is None
                 or text_encoder is None
@@ -67,25 +258,19 @@ class BaseDiffusion(ABC):
             self.vae = vae
             self.unet = unet
             self.scheduler = scheduler
-        else:
-            model = DiffusionPipeline.from_pretrained(
-                model_id, torch_dtype=torch_dtype, *args, **kwargs
-            )
-            self.tokenizer = model.tokenizer
-            self.text_encoder = model.text_encoder
-            self.vae = model.vae
-            self.unet = model.unet
-            self.scheduler = model.scheduler
 
-        self.to(self.device)
-        self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+            # Components passed in are only cast when a dtype is requested for them
+            for name, dtype in component_dtypes.items():
+                if name != "latent":
+                    setattr(self, name, getattr(self, name).to(dtype))
+        else:
+            self.load_components(model_id, torch_dtype, lazy_components, **kwargs)
 
-        if use_cache and model_id is not None:
-            model = load_model_from_cache(model_id, None)
-            if model is None:
+        if cached_model is None:
+            self.to(self.device)
+            self.vae_scale_factor = 2 ** (len(self._vae.config.block_out_channels) - 1)
+            if use_cache and model_id is not None:
                 save_model_to_cache(self)
-            else:
-                self.share_components_with(model)
 
     def to(self, device: str) -> None:
         """
@@ -97,9 +282,14 @@ class BaseDiffusion(ABC):
             The device to move the model to. Must be one of `cuda` or `cpu`.
         """
         self.device = device
-        self.text_encoder = self.text_encoder.to(device)
-        self.vae = self.vae.to(device)
-        self.unet = self.unet.to(device)
+
+        self._text_encoder = self._text_encoder.to(device)
+        self._vae = self._vae.to(device)
+        self._unet = self._unet.to(device)
+        if self.fast_vae is not None:
+            self.fast_vae = self.fast_vae.to(device)
+        self.embedding_cache.clear()
+        refresh_model_in_cache(self)
 
     def share_components_with(self, model: "BaseDiffusion") -> None:
         """
@@ -115,12 +305,267 @@ class BaseDiffusion(ABC):
         """
         self.device = model.device
         self.torch_dtype = model.torch_dtype
+        self.component_dtypes = model.component_dtypes
+        self.variant = model.variant
+        self.quantization = model.quantization
+        self.quantized_modules = model.quantized_modules
         self.tokenizer = model.tokenizer
-        self.text_encoder = model.text_encoder
-        self.vae = model.vae
-        self.unet = model.unet
+        # Components that are not loaded yet are shared as well, so they are loaded once
+        self._text_encoder = model._text_encoder
+        self._vae = model._vae
+        self._unet = model._unet
         self.scheduler = model.scheduler
         self.vae_scale_factor = model.vae_scale_factor
+        self.embedding_cache = model.embedding_cache
+        self.linear_latent_decoder = model.linear_latent_decoder
+        self.fast_vae = model.fast_vae
+
+    def load_components(
+        self,
+        model_id: str,
+        torch_dtype: torch.dtype = torch.float32,
+        lazy_components: Optional[List[str]] = None,
+        **kwargs,
+    ) -> None:
+        """
+        Load the tokenizer, text encoder, VAE, UNet and scheduler of a pipeline from
+        their subfolders. Other components of the pipeline, such as the safety checker,
+        are not loaded. Components are loaded and moved to the device concurrently,
+        using up to `num_load_workers` threads, although `from_pretrained` calls are
+        serialized, since they patch torch globals. The time taken by every
+        component is stored in `load_timings`.
+
+        Parameters
+        ----------
+        model_id: str
+            Model id or local directory of the pipeline.
+        torch_dtype: torch.dtype
+            Dtype to load model weights in, unless overridden for a component by
+            `component_dtypes`.
+        lazy_components: List[str], optional
+            Components to load on first use instead of now. Any of `text_encoder`,
+            `vae` and `unet`. For example, a pipeline that only produces latents never
+            loads a lazy VAE.
+        kwargs
+            Arguments passed to `from_pretrained` of the components they apply to,
+            such as `variant`, `revision` or `use_safetensors`. Arguments of the whole
+            pipeline, such as `safety_checker`, are ignored.
+        """
+        lazy_components = lazy_components or []
+        invalid = set(lazy_components) - {"text_encoder", "vae", "unet"}
+        if invalid:
+            raise ValueError(
+                f"`lazy_components` must be a subset of [`text_encoder`, `vae`, `unet`], got {sorted(invalid)}"
+            )
+
+        start = time.perf_counter()
+        classes = load_component_classes(model_id, **kwargs)
+
+        dtypes = {name: torch_dtype for name in PIPELINE_COMPONENTS}
+        dtypes.update(
+            {
+                name: dtype
+                for name, dtype in self.component_dtypes.items()
+                if name in dtypes and dtype != self.torch_dtype
+            }
+        )
+
+        def load(name: str) -> Any:
+            component = load_component(
+                model_id, name, classes[name], dtypes[name], **kwargs
+            )
+            if isinstance(component, torch.nn.Module):
+                component = component.to(self.device)
+            return component
+
+        components, timings = run_parallel(
+            {
+                name: functools.partial(load, name)
+                for name in PIPELINE_COMPONENTS
+                if name not in lazy_components
+            },
+            self.num_load_workers,
+        )
+        for name in lazy_components:
+            components[name] = LazyComponent(
+                loader=functools.partial(
+                    load_component,
+                    model_id,
+                    name,
+                    classes[name],
+                    dtypes[name],
+                    **kwargs,
+                ),
+                config=load_component_config(model_id, name, classes[name], **kwargs),
+                device=self.device,
+            )
+
+        for name, component in components.items():
+            setattr(self, name, component)
+        self.load_timings = {**timings, "total": time.perf_counter() - start}
+
+    def is_component_loaded(self, name: str) -> bool:
+        """
+        Check whether a component is loaded, or will be loaded on first use.
+
+        Parameters
+        ----------
+        name: str
+            Name of the component, such as `vae`.
+
+        Returns
+        -------
+        bool
+            False if the component is lazy and has not been loaded yet, True
+            otherwise.
+        """
+        component = self.__dict__.get(f"_{name}")
+        return not isinstance(component, LazyComponent) or component.loaded
+
+    def save_snapshot(
+        self, path: str, torch_dtype: Optional[torch.dtype] = None
+    ) -> None:
+        """
+        Save the components of the pipeline as a snapshot that loads quickly with
+        `from_snapshot`. The weights of the text encoder, VAE and UNet are saved to a
+        single safetensors file, in the dtype they are loaded in. Loading a snapshot
+        memory-maps this file instead of deserializing and initializing every model.
+
+        Parameters
+        ----------
+        path: str
+            Directory to save the snapshot in. It is created if it does not exist.
+        torch_dtype: torch.dtype, optional
+            Dtype to save floating point weights in. If None, `torch_dtype` of the
+            pipeline is used.
+        """
+        torch_dtype = torch_dtype or self.torch_dtype
+        save_snapshot(
+            path,
+            components={
+                "tokenizer": self.tokenizer,
+                "text_encoder": self.text_encoder,
+                "vae": self.vae,
+                "unet": self.unet,
+                "scheduler": self.scheduler,
+            },
+            torch_dtype=torch_dtype,
+            torch_dtype_name=str(torch_dtype).replace("torch.", ""),
+            model_id=self.model_id,
+        )
+
+    @classmethod
+    def from_snapshot(
+        cls, path: str, device: str = "cuda", **kwargs
+    ) -> "BaseDiffusion":
+        """
+        Create a pipeline from a snapshot saved with `save_snapshot`. Models are
+        created on the meta device and their weights are bound to a memory-mapped view
+        of the snapshot, so startup costs little more than reading the pages that are
+        used, and processes loading the same snapshot share page cache memory. A
+        snapshot directory can also be passed as `model_id` to the constructor.
+
+        Parameters
+        ----------
+        path: str
+            Directory of the snapshot.
+        device: str
+            The device to move the model to.
+        kwargs
+            Arguments passed to the constructor, such as `use_cache` or
+            `lazy_components`. By default, `torch_dtype` is the dtype of the snapshot.
+
+        Returns
+        -------
+        BaseDiffusion
+            The pipeline.
+        """
+        if not is_snapshot(path):
+            raise ValueError(f"`path` must be a snapshot directory, got {path}")
+        with open(os.path.join(path, "model_index.json")) as file:
+            dtype_name = json.load(file)["torch_dtype_name"]
+        kwargs.setdefault("torch_dtype", getattr(torch, dtype_name))
+        return cls(model_id=path, device=device, **kwargs)
+
+    def quantize(
+        self,
+        mode: str = "dynamic_int8",
+        components: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Quantize the UNet and text encoder for faster inference on CPU. With
+        `dynamic_int8`, the weights of linear layers are quantized to int8 ahead of
+        time and activations are quantized on the fly. The VAE is kept in float, since
+        decoding is sensitive to quantization error. The converted layers are recorded
+        in `quantized_modules`.
+
+        The quantized components are new modules, so other pipelines sharing the
+        original components are not affected. They are stored in the model cache under
+        their own key, and pipelines quantized later with the same mode share them.
+
+        Parameters
+        ----------
+        mode: str
+            The quantization mode. Must be one of [`dynamic_int8`].
+        components: List[str], optional
+            Components to quantize. Any of `unet` and `text_encoder`. If None, both
+            are quantized.
+        """
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"`mode` must be one of {QUANTIZATION_MODES}, got {mode}")
+        if self.quantization is not None:
+            raise ValueError(f"Model is already quantized with `{self.quantization}`")
+        components = components or ["unet", "text_encoder"]
+        invalid = set(components) - {"unet", "text_encoder"}
+        if invalid:
+            raise ValueError(
+                f"`components` must be a subset of [`unet`, `text_encoder`], got {sorted(invalid)}"
+            )
+        if torch.device(self.device).type != "cpu" or any(
+            self.component_dtypes[name] != torch.float32 for name in components
+        ):
+            raise ValueError(
+                "`dynamic_int8` quantization requires a float32 model on CPU"
+            )
+
+        # If this pipeline is the cached float pipeline, a shallow copy takes its place
+        # in the cache, so that float and quantized pipelines are cached side by side
+        if self.use_cache and self.model_id is not None:
+            replace_model_in_cache(self, copy.copy(self))
+
+        # Embeddings of the quantized text encoder must not be mixed with the cached
+        # embeddings of the original text encoder
+        embedding_cache = self.embedding_cache
+        self.embedding_cache = EmbeddingCache(
+            embedding_cache.max_entries, embedding_cache.max_bytes
+        )
+
+        cached_model = None
+        if self.use_cache and self.model_id is not None:
+            key = ModelCache.make_key(
+                self.model_id,
+                self.torch_dtype,
+                self.device,
+                self.variant,
+                mode,
+                self.component_dtypes,
+            )
+            cached_model = load_model_from_cache(key, None)
+        if cached_model is not None and set(
+            cached_model.quantized_modules.keys()
+        ) == set(components):
+            self.share_components_with(cached_model)
+            return
+
+        quantized_modules = {}
+        for name in components:
+            module, quantized_modules[name] = quantize_dynamic_int8(getattr(self, name))
+            setattr(self, name, module)
+        self.quantization = mode
+        self.quantized_modules = quantized_modules
+
+        if self.use_cache and self.model_id is not None:
+            save_model_to_cache(self)
 
     def enable_attention_slicing(self, slice_size: Optional[int] = -1) -> None:
         """
@@ -165,6 +610,258 @@ class BaseDiffusion(ABC):
         """Disable tensor tiling for vae."""
         self.vae.disable_tiling()
 
+    def set_fast_vae(
+        self, fast_vae: Optional[Union[TinyAutoencoder, str]], enable: bool = True
+    ) -> None:
+        """
+        Set the tiny autoencoder used for decoding and encoding when fast VAE mode is
+        enabled. It can be swapped at any time, including between generations.
+
+        Parameters
+        ----------
+        fast_vae: Union[TinyAutoencoder, str], optional
+            The tiny autoencoder, or a local directory to load its encoder and decoder
+            weights from. A model loaded with only one of them, with
+            `TinyAutoencoder.from_pretrained`, can be passed instead. If None, the tiny
+            autoencoder is removed and fast VAE mode is disabled.
+        enable: bool
+            Whether to enable fast VAE mode.
+        """
+        if fast_vae is None:
+            self.fast_vae = None
+            self.use_fast_vae = False
+            return
+
+        if isinstance(fast_vae, str):
+            fast_vae = TinyAutoencoder.from_pretrained(
+                fast_vae,
+                torch_dtype=self.component_dtypes["vae"],
+                latent_channels=self.vae.config.latent_channels,
+                num_scales=int(math.log2(self.vae_scale_factor)),
+            )
+        if fast_vae.scale_factor != self.vae_scale_factor:
+            raise ValueError(
+                f"The scale factor of `fast_vae` ({fast_vae.scale_factor}) must match "
+                f"the scale factor of the VAE ({self.vae_scale_factor})"
+            )
+
+        self.fast_vae = fast_vae.to(
+            device=self.device, dtype=self.component_dtypes["vae"]
+        )
+        self.use_fast_vae = enable
+
+    def enable_fast_vae(self) -> None:
+        """
+        Use the tiny autoencoder set with `set_fast_vae` instead of the VAE in
+        `latent_to_image` and `image_to_latent`. This makes decoding much cheaper at a
+        small cost in quality.
+        """
+        if self.fast_vae is None:
+            raise ValueError("A tiny autoencoder must be set with `set_fast_vae` first")
+        self.use_fast_vae = True
+
+    def disable_fast_vae(self) -> None:
+        """Use the VAE for decoding and encoding."""
+        self.use_fast_vae = False
+
+    def enable_embedding_cache(
+        self, max_entries: int = 256, max_bytes: Optional[int] = None
+    ) -> None:
+        """
+        Enable caching of prompt embeddings. Prompts that have been encoded before
+        skip the text encoder forward pass. The cache is shared with all pipelines
+        that share components with this one, so changing its budget affects them too.
+
+        Parameters
+        ----------
+        max_entries: int
+            Maximum number of prompt embeddings to keep in the cache.
+        max_bytes: int, optional
+            Maximum total size of cached embeddings in bytes. If None, only the number
+            of entries is bounded.
+        """
+        self.embedding_cache.resize(max_entries, max_bytes)
+        self.use_embedding_cache = True
+
+    def disable_embedding_cache(self) -> None:
+        """Disable caching of prompt embeddings."""
+        self.use_embedding_cache = False
+
+    def enable_buffer_reuse(self) -> None:
+        """
+        Preallocate the UNet input buffer once per denoising call and update it in
+        place at every step. Classifier-free guidance is also applied in place on the
+        UNet output. This reduces allocator churn and peak memory for large batch sizes
+        and resolutions. Results may differ slightly from the default path when
+        `guidance_rescale` is used, due to floating point rounding.
+        """
+        self.reuse_buffers = True
+
+    def disable_buffer_reuse(self) -> None:
+        """Disable reuse of preallocated buffers in the denoising loop."""
+        self.reuse_buffers = False
+
+    def enable_autocast(self) -> None:
+        """
+        Run the UNet in an autocast region when its dtype in `component_dtypes` is a
+        half precision dtype and differs from the latent dtype. Matrix multiplications
+        and convolutions run in half precision, while numerically sensitive operations
+        are computed in float32. On CPU, only bfloat16 is supported. This is the
+        default.
+        """
+        self.use_autocast = True
+
+    def disable_autocast(self) -> None:
+        """Run the UNet without autocast, on inputs cast to its dtype."""
+        self.use_autocast = False
+
+    def enable_unconditional_reuse(
+        self, interval: int = 2, mode: str = "reuse"
+    ) -> None:
+        """
+        Recompute the unconditional branch of classifier-free guidance only every
+        `interval` steps. In between, only the conditional branch of the UNet is
+        evaluated and the unconditional noise prediction is estimated from previous
+        steps. This trades some quality for speed. The number of UNet evaluations
+        saved by the last denoising run is available in `denoise_stats`.
+
+        Parameters
+        ----------
+        interval: int
+            Number of steps between evaluations of the unconditional branch.
+        mode: str
+            How to estimate the unconditional noise prediction in between. Must be
+            one of [`reuse`, `extrapolate`]. `reuse` uses the last prediction as is
+            and `extrapolate` linearly extrapolates from the last two predictions.
+        """
+        if interval < 1:
+            raise ValueError(f"`interval` must be a positive integer, got {interval}")
+        if mode not in ["reuse", "extrapolate"]:
+            raise ValueError(
+                f"`mode` must be one of ['reuse', 'extrapolate'], got {mode}"
+            )
+        self.unconditional_reuse_interval = interval
+        self.unconditional_reuse_mode = mode
+
+    def disable_unconditional_reuse(self) -> None:
+        """Evaluate the unconditional branch of classifier-free guidance at every step."""
+        self.unconditional_reuse_interval = 1
+        self.unconditional_reuse_mode = "reuse"
+
+    def set_latent_history_storage(
+        self,
+        storage: str = "device",
+        stride: int = 1,
+        directory: Optional[str] = None,
+    ) -> None:
+        """
+        Configure where the latent history is kept when `return_latent_history` is
+        True. Latents are written into a buffer preallocated once per call. With
+        `host` or `memmap` storage, a `LatentHistory` is returned instead of a tensor
+        and `resolve_output` decodes from it lazily.
+
+        Parameters
+        ----------
+        storage: str
+            Must be one of [`device`, `host`, `memmap`]. `device` keeps the history on
+            the compute device in the model dtype, `host` keeps it in host memory as
+            float16 and `memmap` keeps it in a float16 numpy memmap on disk.
+        stride: int
+            Keep only every `stride`-th latent. The final latent is always kept.
+        directory: str, optional
+            Directory to create memmap files in. If None, the system temporary
+            directory is used.
+        """
+        if storage not in ["device", "host", "memmap"]:
+            raise ValueError(
+                f"`storage` must be one of ['device', 'host', 'memmap'], got {storage}"
+            )
+        if stride < 1:
+            raise ValueError(f"`stride` must be a positive integer, got {stride}")
+        self.latent_history_storage = storage
+        self.latent_history_stride = stride
+        self.latent_history_directory = directory
+
+    def calibrate_linear_latent_decoder(
+        self,
+        latent: Optional[torch.FloatTensor] = None,
+        num_samples: int = 4,
+        latent_size: int = 16,
+    ) -> LinearLatentDecoder:
+        """
+        Fit the linear latent-to-RGB map used for cheap previews against the VAE of
+        the model. The calibrated decoder is cached per VAE, so pipelines sharing a
+        VAE calibrate only once.
+
+        Parameters
+        ----------
+        latent: torch.FloatTensor, optional
+            Latents to calibrate on. If None, random latents are used. Latents of real
+            images give a better fit.
+        num_samples: int
+            Number of random latents to calibrate on when `latent` is None.
+        latent_size: int
+            Height and width of random latents used when `latent` is None.
+
+        Returns
+        -------
+        LinearLatentDecoder
+            The calibrated decoder.
+        """
+        self.linear_latent_decoder = LinearLatentDecoder.calibrate(
+            vae=self.vae,
+            scale_factor=self.vae_scale_factor,
+            latent=latent,
+            num_samples=num_samples,
+            latent_size=latent_size,
+        )
+        save_latent_decoder_to_cache(self.vae, self.linear_latent_decoder)
+        return self.linear_latent_decoder
+
+    def add_denoise_hook(self, hook_type: str, hook: Callable) -> None:
+        """
+        Register a hook on the denoising loop. Hooks run in the order they were added.
+
+        - `pre_step` hooks are called as `hook(pipeline, step, timestep, latent)` before
+          each denoising step. They may return a new latent to replace the current one.
+        - `model_call` hooks wrap the noise prediction and are called as
+          `hook(call_model, latent_model_input, timestep, embedding)`. They must return
+          the noise prediction, usually by calling `call_model` with the same arguments.
+          In `ContinuousBatcher`, a single call covers the running batch of many
+          requests, and `timestep` holds one value per sample.
+        - `post_step` hooks are called as `hook(pipeline, step, timestep, latent)` after
+          each scheduler step. They may return a new latent to replace the current one.
+
+        Parameters
+        ----------
+        hook_type: str
+            The type of hook. Must be one of [`pre_step`, `model_call`, `post_step`].
+        hook: Callable
+            The hook to register.
+        """
+        if hook_type not in self.denoise_hooks:
+            raise ValueError(
+                f"`hook_type` must be one of {list(self.denoise_hooks.keys())}, got {hook_type}"
+            )
+        self.denoise_hooks[hook_type].append(hook)
+
+    def remove_denoise_hook(self, hook_type: str, hook: Callable) -> None:
+        """
+        Remove a hook previously registered with `add_denoise_hook`.
+
+        Parameters
+        ----------
+        hook_type: str
+            The type of hook. Must be one of [`pre_step`, `model_call`, `post_step`].
+        hook: Callable
+            The hook to remove.
+        """
+        if hook_type not in self.denoise_hooks:
+            raise ValueError(
+                f"`hook_type` must be one of {list(self.denoise_hooks.keys())}, got {hook_type}"
+            )
+        self.denoise_hooks[hook_type].remove(hook)
+
     @staticmethod
     def validate_input(
         prompt: Union[str, List[str]] = None,
@@ -174,6 +871,7 @@ class BaseDiffusion(ABC):
         start_step: int = None,
         num_inference_steps: int = None,
         strength: float = None,
+        guidance_end: float = None,
     ) -> None:
         """
         Validate input parameters.
@@ -195,6 +893,9 @@ class BaseDiffusion(ABC):
             The number of inference steps to perform.
         strength: float
             The strength of the noise mixing when performing LatentWalkDiffusion.
+        guidance_end: float
+            The fraction of inference steps during which classifier-free guidance is
+            applied.
         """
         if image_height is not None and image_width is not None:
             if image_height % 8 != 0 or image_width % 8 != 0:
@@ -222,6 +923,9 @@ class BaseDiffusion(ABC):
         if strength is not None:
             if strength < 0 or strength > 1:
                 raise ValueError("`strength` must be in the range [0.0, 1.0]")
+        if guidance_end is not None:
+            if guidance_end < 0 or guidance_end > 1:
+                raise ValueError("`guidance_end` must be in the range [0.0, 1.0]")
 
     @abstractmethod
     def embedding_to_latent(self, *args: Any, **kwargs: Any) -> Any:
@@ -239,7 +943,11 @@ class BaseDiffusion(ABC):
         """
         pass
 
-    def random_tensor(self, shape: Union[List[int], Tuple[int]]) -> torch.FloatTensor:
+    def random_tensor(
+        self,
+        shape: Union[List[int], Tuple[int]],
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> torch.FloatTensor:
         """
         Generate a random tensor of the specified shape.
 
@@ -247,15 +955,50 @@ class BaseDiffusion(ABC):
         ----------
         shape: List[int] or Tuple[int]
             The shape of the random tensor to generate.
+        generator: Union[torch.Generator, List[torch.Generator]], optional
+            Random number generator(s) to draw from. If a list, it must contain one
+            generator per sample along the first dimension, and every sample is drawn
+            from its own generator. This makes a sample independent of the other
+            samples in the batch. If None, the global random number generator is used.
 
         Returns
         -------
         torch.FloatTensor
-            A random tensor of the specified shape on the same device and dtype
-            as model.
+            A random tensor of the specified shape on the same device as model, in
+            the latent dtype of `component_dtypes`.
         """
-        rand_tensor = torch.randn(shape, device=self.device, dtype=self.torch_dtype)
-        return rand_tensor
+        dtype = self.component_dtypes["latent"]
+        if generator is None:
+            rand_tensor = torch.randn(shape, device=self.device, dtype=dtype)
+            return rand_tensor
+
+        if isinstance(generator, torch.Generator):
+            rand_tensor = torch.randn(
+                shape,
+                generator=generator,
+                device=generator.device,
+                dtype=dtype,
+            )
+            return rand_tensor.to(self.device)
+
+        if len(generator) != shape[0]:
+            raise ValueError(
+                f"Number of generators ({len(generator)}) must match the batch size ({shape[0]})"
+            )
+
+        # Samples are drawn on the device of their generator and moved to the model
+        rand_tensor = torch.cat(
+            [
+                torch.randn(
+                    (1, *shape[1:]),
+                    generator=g,
+                    device=g.device,
+                    dtype=dtype,
+                )
+                for g in generator
+            ]
+        )
+        return rand_tensor.to(self.device)
 
     def prompt_to_embedding(
         self,
@@ -297,9 +1040,52 @@ class BaseDiffusion(ABC):
         else:
             raise TypeError("`prompt` must be a string or a list of strings")
 
-        # Tokenize the prompt(s)
+        # Unconditioning input is an empty string if negative_prompt is not provided.
+        # It is the same for every prompt, so it is encoded once and broadcast to the
+        # batch size as a view.
+        if negative_prompt is None:
+            unconditioning_input = [""]
+        else:
+            unconditioning_input = negative_prompt
+
+        # Encode unconditioning input and prompt(s) in a single text encoder pass
+        embedding = self._encode_text(unconditioning_input + prompt)
+        unconditional_embedding = embedding[: len(unconditioning_input)]
+        text_embedding = embedding[len(unconditioning_input) :]
+        if negative_prompt is None:
+            unconditional_embedding = unconditional_embedding.expand(batch_size, -1, -1)
+
+        # Concatenate unconditional and conditional embeddings
+        embedding = torch.cat([unconditional_embedding, text_embedding])
+        return embedding
+
+    def _encode_text(self, text: List[str]) -> torch.FloatTensor:
+        """
+        Tokenize and encode a list of strings with the text encoder. Duplicate strings
+        are encoded only once, and embeddings of strings found in the embedding cache
+        are reused instead of being recomputed.
+
+        Parameters
+        ----------
+        text: List[str]
+            The strings to encode.
+
+        Returns
+        -------
+        torch.FloatTensor
+            Text embedding of shape (len(text), max_length, hidden_size).
+        """
+        # Encode each distinct string once and scatter the results back afterwards
+        unique_text = list(dict.fromkeys(text))
+        if len(unique_text) < len(text):
+            embedding = self._encode_text(unique_text)
+            if len(unique_text) == 1:
+                return embedding.expand(len(text), -1, -1)
+            index = {string: i for i, string in enumerate(unique_text)}
+            return embedding[[index[string] for string in text]]
+
         text_input = self.tokenizer(
-            prompt,
+            text,
             padding="max_length",
             max_length=self.tokenizer.model_max_length,
             truncation=True,
@@ -307,49 +1093,96 @@ class BaseDiffusion(ABC):
         )
 
         # Enable use of attention_mask if the text_encoder supports it
-        if (
+        use_attention_mask = (
             hasattr(self.text_encoder.config, "use_attention_mask")
             and self.text_encoder.config.use_attention_mask
-        ):
-            attention_mask = text_input.attention_mask.to(self.device)
+        )
+
+        keys = [
+            EmbeddingCache.make_key(self.model_id, input_ids, use_attention_mask)
+            for input_ids in text_input.input_ids
+        ]
+        if self.use_embedding_cache:
+            embeddings = [self.embedding_cache.get(key) for key in keys]
         else:
+            embeddings = [None] * len(keys)
+
+        # Run the text encoder only on strings that were not found in the cache. Large
+        # inputs are encoded in chunks so that peak memory stays bounded.
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        for start in range(0, len(missing), self.text_encoder_batch_size):
+            chunk = missing[start : start + self.text_encoder_batch_size]
             attention_mask = None
+            if use_attention_mask:
+                attention_mask = text_input.attention_mask[chunk].to(self.device)
+            text_embedding = self.text_encoder(
+                text_input.input_ids[chunk].to(self.device),
+                attention_mask=attention_mask,
+            )[0]
 
-        # Generate text embedding
-        text_embedding = self.text_encoder(
-            text_input.input_ids.to(self.device), attention_mask=attention_mask
-        )[0]
+            for i, embedding in zip(chunk, text_embedding):
+                embeddings[i] = embedding
+                if self.use_embedding_cache:
+                    self.embedding_cache.set(keys[i], embedding.detach().clone())
 
-        # Unconditioning input is an empty string if negative_prompt is not provided
-        if negative_prompt is None:
-            unconditioning_input = [""] * batch_size
-        else:
-            unconditioning_input = negative_prompt
+        return torch.stack(embeddings)
 
-        # Tokenize the unconditioning input
-        unconditioning_input = self.tokenizer(
-            unconditioning_input,
-            padding="max_length",
-            max_length=self.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
-        )
+    def predict_noise(
+        self,
+        latent_model_input: torch.FloatTensor,
+        timestep: Union[torch.Tensor, float, int],
+        embedding: torch.FloatTensor,
+    ) -> torch.FloatTensor:
+        """
+        Predict noise with the UNet. Inputs are cast to the UNet dtype of
+        `component_dtypes` and the prediction is cast back to the latent dtype, so
+        that classifier-free guidance and the scheduler step run in the latent dtype.
 
-        # Generate unconditional embedding
-        unconditional_embedding = self.text_encoder(
-            unconditioning_input.input_ids.to(self.device),
-            attention_mask=attention_mask,
-        )[0]
+        Parameters
+        ----------
+        latent_model_input: torch.FloatTensor
+            The scaled latent input of the UNet.
+        timestep: Union[torch.Tensor, float, int]
+            The timestep, either a scalar or one value per sample.
+        embedding: torch.FloatTensor
+            The text embedding, with one row per sample.
 
-        # Concatenate unconditional and conditional embeddings
-        embedding = torch.cat([unconditional_embedding, text_embedding])
-        return embedding
+        Returns
+        -------
+        torch.FloatTensor
+            The noise prediction, in the latent dtype.
+        """
+        dtype = self.component_dtypes["unet"]
+        latent_dtype = self.component_dtypes["latent"]
+        device_type = torch.device(self.device).type
+
+        # Autocast supports bfloat16 on every device, but float16 only on CUDA
+        autocast = contextlib.nullcontext()
+        if (
+            self.use_autocast
+            and dtype != latent_dtype
+            and (
+                dtype == torch.bfloat16
+                or (dtype, device_type) == (torch.float16, "cuda")
+            )
+        ):
+            autocast = torch.autocast(device_type, dtype=dtype)
+
+        with autocast:
+            noise_prediction = self.unet(
+                latent_model_input.to(dtype),
+                timestep,
+                encoder_hidden_states=embedding.to(dtype),
+                return_dict=False,
+            )[0]
+        return noise_prediction.to(latent_dtype)
 
     def classifier_free_guidance(
         self,
         noise_prediction: torch.FloatTensor,
-        guidance_scale: float,
-        guidance_rescale: float,
+        guidance_scale: Union[float, List[float], torch.Tensor],
+        guidance_rescale: Union[float, List[float], torch.Tensor],
+        inplace: bool = False,
     ) -> torch.FloatTensor:
         """
         Apply classifier-free guidance to noise prediction.
@@ -358,12 +1191,17 @@ class BaseDiffusion(ABC):
         ----------
         noise_prediction: torch.FloatTensor
             The noise prediction tensor to which guidance will be applied.
-        guidance_scale: float
-            The scale factor for applying guidance to the noise prediction.
-        guidance_rescale: float
+        guidance_scale: Union[float, List[float], torch.Tensor]
+            The scale factor for applying guidance to the noise prediction. Either a
+            scalar, or one value per sample.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
             The rescale factor for adjusting the noise prediction based on
             guidance. Based on findings in Section 3.4  of [Common Diffusion
             Noise Schedules and Sample Steps are Flawed](https://arxiv.org/pdf/2305.08891.pdf).
+            Either a scalar, or one value per sample.
+        inplace: bool
+            If True, guidance is computed in the memory of `noise_prediction` without
+            allocating temporaries. The returned tensor is a view of its second half.
 
         Returns
         -------
@@ -373,12 +1211,48 @@ class BaseDiffusion(ABC):
 
         # Perform guidance
         noise_unconditional, noise_prompt = noise_prediction.chunk(2)
+
+        guidance_scale = self._per_sample_parameter(guidance_scale, noise_prompt)
+        apply_rescale = bool(torch.any(torch.as_tensor(guidance_rescale) > 0))
+        guidance_keep = self._per_sample_parameter(
+            guidance_rescale, noise_prompt, complement=True
+        )
+        guidance_rescale = self._per_sample_parameter(guidance_rescale, noise_prompt)
+
+        if inplace:
+            if apply_rescale:
+                std_prompt = noise_prompt.std(
+                    dim=list(range(1, noise_prompt.ndim)), keepdim=True
+                )
+
+            # The conditional half is overwritten with the guided prediction
+            noise_prediction = (
+                noise_prompt.sub_(noise_unconditional)
+                .mul_(guidance_scale)
+                .add_(noise_unconditional)
+            )
+
+            # Rescaling is folded into a single per-sample factor:
+            # x * (1 - r) + x * (s_p / s_x) * r = x * (r * s_p / s_x + 1 - r)
+            if apply_rescale:
+                std_prediction = noise_prediction.std(
+                    dim=list(range(1, noise_prediction.ndim)), keepdim=True
+                )
+                factor = (
+                    std_prompt.div_(std_prediction)
+                    .mul_(guidance_rescale)
+                    .add_(guidance_keep)
+                )
+                noise_prediction.mul_(factor)
+
+            return noise_prediction
+
         noise_prediction = noise_unconditional + guidance_scale * (
             noise_prompt - noise_unconditional
         )
 
         # Skip computing std if guidance_rescale is 0
-        if guidance_rescale > 0:
+        if apply_rescale:
             std_prompt = noise_prompt.std(
                 dim=list(range(1, noise_prompt.ndim)), keepdim=True
             )
@@ -387,14 +1261,453 @@ class BaseDiffusion(ABC):
             )
             noise_prediction_rescaled = noise_prediction * (std_prompt / std_prediction)
             noise_prediction = (
-                noise_prediction * (1 - guidance_rescale)
+                noise_prediction * guidance_keep
                 + noise_prediction_rescaled * guidance_rescale
             )
 
         return noise_prediction
 
+    @staticmethod
+    def _per_sample_parameter(
+        value: Union[float, List[float], torch.Tensor],
+        like: torch.Tensor,
+        complement: bool = False,
+    ) -> Union[float, torch.Tensor]:
+        # Scalars are returned as is. Per-sample values are shaped to broadcast over
+        # all but the batch dimension, and cast to the dtype of the prediction only at
+        # the end, as Python scalars are, so that every sample gets exactly the result
+        # it would get when run alone with a scalar. With `complement`, 1 - value is
+        # returned, computed before the cast for the same reason.
+        if isinstance(value, (int, float)):
+            return 1 - value if complement else value
+        value = torch.as_tensor(value, dtype=torch.float64)
+        if complement:
+            value = 1 - value
+        if value.ndim == 0:
+            return value.item()
+        if value.shape != (like.shape[0],):
+            raise ValueError(
+                f"Per-sample guidance parameters must have shape ({like.shape[0]},), got {tuple(value.shape)}"
+            )
+        value = value.to(device=like.device, dtype=like.dtype)
+        return value.view(-1, *([1] * (like.ndim - 1)))
+
+    def denoise_steps(
+        self,
+        latent: torch.FloatTensor,
+        embedding: torch.FloatTensor,
+        timesteps: torch.Tensor,
+        guidance_scale: Union[float, List[float], torch.Tensor],
+        guidance_rescale: Union[float, List[float], torch.Tensor],
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Iterator[Tuple[int, torch.Tensor, torch.FloatTensor]]:
+        """
+        Run the denoising loop shared by all diffusion pipelines, yielding after every
+        scheduler step. The scheduler must already be configured with the desired
+        number of inference steps. The number of per-sample UNet evaluations performed,
+        and saved compared to full classifier-free guidance, is recorded in
+        `denoise_stats`.
+
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Latent to start denoising from, already scaled as required by the scheduler.
+        embedding: torch.FloatTensor
+            Unconditional and conditional text embeddings concatenated along the batch
+            dimension, as returned by `prompt_to_embedding`.
+        timesteps: torch.Tensor
+            The timesteps to run the denoising loop for.
+        guidance_scale: Union[float, List[float], torch.Tensor]
+            Guidance scale encourages the model to generate images following the prompt
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per sample.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
+            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per sample.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start of the scheduler
+            timesteps, during which classifier-free guidance is applied. When
+            `timesteps` starts later in the schedule, as in image-to-image, the skipped
+            steps count towards the fraction. For the remaining steps, and for all
+            steps when `guidance_scale` is 1.0 and guidance has no effect, only the
+            conditional branch of the UNet is evaluated.
+        generator: Union[torch.Generator, List[torch.Generator]], optional
+            Random number generator(s) passed to the scheduler step, for schedulers
+            that add noise in every step.
+
+        Yields
+        ------
+        Tuple[int, torch.Tensor, torch.FloatTensor]
+            The step index, the timestep and the latent after the scheduler step.
+        """
+
+        call_model = self._get_model_call()
+        self.denoise_stats = {}
+        loop = self._denoise_loop(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            generator=generator,
+            scheduler=self.scheduler,
+            stats=self.denoise_stats,
+        )
+        for latent_model_input, timestep, embedding in loop:
+            yield loop.send(call_model(latent_model_input, timestep, embedding))
+
+    def _get_model_call(self) -> Callable:
+        """Return the UNet call of the denoising loop, wrapped by `model_call` hooks."""
+
+        def call_model(
+            latent_model_input: torch.FloatTensor,
+            timestep: torch.Tensor,
+            embedding: torch.FloatTensor,
+        ) -> torch.FloatTensor:
+            return self.predict_noise(latent_model_input, timestep, embedding)
+
+        for hook in self.denoise_hooks["model_call"]:
+            call_model = functools.partial(hook, call_model)
+        return call_model
+
+    def _denoise_loop(
+        self,
+        latent: torch.FloatTensor,
+        embedding: torch.FloatTensor,
+        timesteps: torch.Tensor,
+        guidance_scale: Union[float, List[float], torch.Tensor],
+        guidance_rescale: Union[float, List[float], torch.Tensor],
+        guidance_end: float,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]],
+        scheduler: Scheduler,
+        stats: Dict[str, int],
+    ) -> Generator[Tuple, torch.FloatTensor, None]:
+        """
+        Coroutine implementing the denoising loop without calling the UNet, so that
+        the caller decides how UNet calls are made. At every step, it first yields the
+        `(latent_model_input, timestep, embedding)` arguments of the UNet call and
+        expects the noise prediction to be sent back. It then yields the
+        `(step, timestep, latent)` tuple after the scheduler step. `denoise_steps`
+        makes one UNet call per step, while `ContinuousBatcher` batches the UNet calls
+        of many loops with different timesteps.
+
+        Arguments are the same as `denoise_steps`, with the scheduler to step, which
+        must already be configured with the desired number of inference steps, and
+        the dictionary to record UNet evaluations in.
+        """
+        latent_model_input = None
+        conditional_embedding = embedding.chunk(2)[1]
+        batch_size = latent.shape[0]
+
+        # Guidance is a no-op when guidance_scale is 1.0, so the unconditional branch
+        # is only evaluated for the steps where it has an effect
+        num_guided_steps = 0
+        if bool(torch.any(torch.as_tensor(guidance_scale) != 1.0)):
+            # The fraction is of the full schedule, so steps skipped by starting from
+            # a later timestep, as in image-to-image, count towards it. Rounding guards
+            # against floating point error, e.g. 0.3 * 10 > 3
+            num_skipped_steps = len(scheduler.timesteps) - len(timesteps)
+            num_guided_steps = (
+                math.ceil(round(guidance_end * len(scheduler.timesteps), 6))
+                - num_skipped_steps
+            )
+
+        extra_step_kwargs = {}
+        if (
+            generator is not None
+            and "generator" in inspect.signature(scheduler.step).parameters
+        ):
+            extra_step_kwargs["generator"] = generator
+
+        # Last two unconditional noise predictions as (step, noise) pairs
+        unconditional_history: List[Tuple[int, torch.FloatTensor]] = []
+        stats.update(unet_evaluations=0, unet_evaluations_saved=0)
+
+        for i, timestep in enumerate(timesteps):
+            for hook in self.denoise_hooks["pre_step"]:
+                result = hook(self, i, timestep, latent)
+                if result is not None:
+                    latent = result
+
+            refresh_unconditional = i < num_guided_steps and (
+                len(unconditional_history) == 0
+                or i - unconditional_history[-1][0] >= self.unconditional_reuse_interval
+            )
+
+            if refresh_unconditional:
+                # Duplicate latent to avoid two forward passes to perform classifier free guidance
+                if self.reuse_buffers:
+                    # Scaling is elementwise, so the latent is scaled once and written to
+                    # both halves of the preallocated buffer
+                    shape = (2 * batch_size, *latent.shape[1:])
+                    if (
+                        latent_model_input is None
+                        or latent_model_input.shape != shape
+                        or latent_model_input.dtype != latent.dtype
+                    ):
+                        latent_model_input = torch.empty(
+                            shape, dtype=latent.dtype, device=latent.device
+                        )
+                    scaled_latent = scheduler.scale_model_input(latent, timestep)
+                    torch.cat([scaled_latent] * 2, out=latent_model_input)
+                else:
+                    latent_model_input = torch.cat([latent] * 2)
+                    latent_model_input = scheduler.scale_model_input(
+                        latent_model_input, timestep
+                    )
+
+                # Predict noise
+                noise_prediction = yield latent_model_input, timestep, embedding
+                stats["unet_evaluations"] += 2 * batch_size
+
+                # Guidance only modifies the conditional half, so the unconditional
+                # half can be kept for reuse in later steps
+                unconditional_history = unconditional_history[-1:] + [
+                    (i, noise_prediction.chunk(2)[0])
+                ]
+
+                # Perform classifier free guidance
+                noise_prediction = self.classifier_free_guidance(
+                    noise_prediction,
+                    guidance_scale,
+                    guidance_rescale,
+                    inplace=self.reuse_buffers,
+                )
+            else:
+                # Predict noise with the conditional branch only
+                scaled_latent = scheduler.scale_model_input(latent, timestep)
+                noise_prediction = yield scaled_latent, timestep, conditional_embedding
+                stats["unet_evaluations"] += batch_size
+
+                if i < num_guided_steps:
+                    # Perform classifier free guidance with an estimate of the
+                    # unconditional noise prediction from previous steps
+                    noise_unconditional = self._estimate_unconditional_noise(
+                        unconditional_history, i
+                    )
+                    noise_prediction = self.classifier_free_guidance(
+                        torch.cat([noise_unconditional, noise_prediction]),
+                        guidance_scale,
+                        guidance_rescale,
+                        inplace=self.reuse_buffers,
+                    )
+
+            stats["unet_evaluations_saved"] = (
+                2 * batch_size * (i + 1) - stats["unet_evaluations"]
+            )
+
+            # Update latent
+            latent = scheduler.step(
+                noise_prediction,
+                timestep,
+                latent,
+                return_dict=False,
+                **extra_step_kwargs,
+            )[0]
+
+            for hook in self.denoise_hooks["post_step"]:
+                result = hook(self, i, timestep, latent)
+                if result is not None:
+                    latent = result
+
+            yield i, timestep, latent
+
+    def stream_denoise(
+        self,
+        latent: torch.FloatTensor,
+        embedding: torch.FloatTensor,
+        timesteps: torch.Tensor,
+        guidance_scale: Union[float, List[float], torch.Tensor],
+        guidance_rescale: Union[float, List[float], torch.Tensor],
+        guidance_end: float = 1.0,
+        preview_type: Optional[str] = None,
+        preview_interval: int = 1,
+        preview_decoder: Optional[str] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Iterator[DiffusionStepEvent]:
+        """
+        Run the denoising loop, yielding a `DiffusionStepEvent` after every step.
+
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Latent to start denoising from, already scaled as required by the scheduler.
+        embedding: torch.FloatTensor
+            Unconditional and conditional text embeddings concatenated along the batch
+            dimension, as returned by `prompt_to_embedding`.
+        timesteps: torch.Tensor
+            The timesteps to run the denoising loop for.
+        guidance_scale: Union[float, List[float], torch.Tensor]
+            Guidance scale encourages the model to generate images following the prompt
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per sample.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
+            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per sample.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start of the scheduler
+            timesteps, during which classifier-free guidance is applied.
+        preview_type: str, optional
+            Output format of previews. Should be one of [`pt`, `np`, `pil`]. If None,
+            no previews are decoded.
+        preview_interval: int
+            Decode a preview every `preview_interval` steps. A preview is always
+            decoded for the last step.
+        preview_decoder: str, optional
+            The decoder to use for previews. Should be one of [`vae`, `tiny`,
+            `linear`]. If None, it is chosen based on whether fast VAE mode is enabled.
+        generator: Union[torch.Generator, List[torch.Generator]], optional
+            Random number generator(s) passed to the scheduler step.
+
+        Yields
+        ------
+        DiffusionStepEvent
+            The step index, number of steps, timestep, latent and optional preview.
+        """
+        if preview_type not in [None, "pt", "np", "pil"]:
+            raise ValueError(
+                "`preview_type` must be one of [`pt`, `np`, `pil`] or None"
+            )
+        if preview_interval < 1:
+            raise ValueError(
+                f"`preview_interval` must be a positive integer, got {preview_interval}"
+            )
+
+        num_steps = len(timesteps)
+        for i, timestep, latent in self.denoise_steps(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            generator=generator,
+        ):
+            preview = None
+            if preview_type is not None and (
+                (i + 1) % preview_interval == 0 or i == num_steps - 1
+            ):
+                preview = self.latent_to_image(latent, preview_type, preview_decoder)
+            yield DiffusionStepEvent(i, num_steps, timestep, latent, preview)
+
+    def _estimate_unconditional_noise(
+        self,
+        unconditional_history: List[Tuple[int, torch.FloatTensor]],
+        step: int,
+    ) -> torch.FloatTensor:
+        """
+        Estimate the unconditional noise prediction at a step from the last computed
+        unconditional noise predictions.
+
+        Parameters
+        ----------
+        unconditional_history: List[Tuple[int, torch.FloatTensor]]
+            The last one or two (step, unconditional noise prediction) pairs.
+        step: int
+            The step to estimate the unconditional noise prediction for.
+
+        Returns
+        -------
+        torch.FloatTensor
+            The estimated unconditional noise prediction.
+        """
+        last_step, last_noise = unconditional_history[-1]
+        if self.unconditional_reuse_mode == "reuse" or len(unconditional_history) < 2:
+            return last_noise
+
+        previous_step, previous_noise = unconditional_history[-2]
+        weight = (step - last_step) / (last_step - previous_step)
+        return torch.lerp(last_noise, previous_noise, -weight)
+
+    def denoise(
+        self,
+        latent: torch.FloatTensor,
+        embedding: torch.FloatTensor,
+        timesteps: torch.Tensor,
+        guidance_scale: Union[float, List[float], torch.Tensor],
+        guidance_rescale: Union[float, List[float], torch.Tensor],
+        guidance_end: float = 1.0,
+        return_latent_history: bool = False,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Union[torch.FloatTensor, LatentHistory]:
+        """
+        Run the denoising loop to completion. See `denoise_steps` for details.
+
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Latent to start denoising from, already scaled as required by the scheduler.
+        embedding: torch.FloatTensor
+            Unconditional and conditional text embeddings concatenated along the batch
+            dimension, as returned by `prompt_to_embedding`.
+        timesteps: torch.Tensor
+            The timesteps to run the denoising loop for.
+        guidance_scale: Union[float, List[float], torch.Tensor]
+            Guidance scale encourages the model to generate images following the prompt
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per sample.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
+            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per sample.
+        guidance_end: float
+            Fraction of the timesteps, counted from the start, during which
+            classifier-free guidance is applied.
+        return_latent_history: bool
+            Whether to return the latent history. If True, the starting latent and the
+            latent after every step are stored along a new first dimension, as
+            configured by `set_latent_history_storage`.
+        generator: Union[torch.Generator, List[torch.Generator]], optional
+            Random number generator(s) passed to the scheduler step.
+
+        Returns
+        -------
+        Union[torch.FloatTensor, LatentHistory]
+            The denoised latent, or the latent history if requested. The history is a
+            tensor when stored on the compute device and a `LatentHistory` otherwise.
+        """
+        if return_latent_history:
+            latent_history = LatentHistory(
+                num_latents=len(timesteps) + 1,
+                latent_shape=tuple(latent.shape),
+                device=self.device,
+                dtype=latent.dtype,
+                storage=self.latent_history_storage,
+                stride=self.latent_history_stride,
+                directory=self.latent_history_directory,
+            )
+            latent_history.append(0, latent)
+
+        for i, _, latent in tqdm(
+            self.denoise_steps(
+                latent=latent,
+                embedding=embedding,
+                timesteps=timesteps,
+                guidance_scale=guidance_scale,
+                guidance_rescale=guidance_rescale,
+                guidance_end=guidance_end,
+                generator=generator,
+            ),
+            total=len(timesteps),
+        ):
+            if return_latent_history:
+                latent_history.append(i + 1, latent)
+
+        if not return_latent_history:
+            return latent
+        if latent_history.storage == "device":
+            return latent_history.buffer
+        return latent_history
+
     def latent_to_image(
-        self, latent: torch.FloatTensor, output_type: str
+        self,
+        latent: torch.FloatTensor,
+        output_type: str,
+        decoder: Optional[str] = None,
     ) -> Union[torch.Tensor, np.ndarray, Image.Image]:
         """
         Convert a latent tensor to an image in the specified output format.
@@ -405,6 +1718,12 @@ class BaseDiffusion(ABC):
             The latent tensor to convert into an image.
         output_type: str
             The desired output format for the image. Should be one of [`pt`, `np`, `pil`].
+        decoder: str, optional
+            The decoder to use. Should be one of [`vae`, `tiny`, `linear`]. `tiny` uses
+            the tiny autoencoder set with `set_fast_vae`. `linear` projects the latent
+            to RGB with a linear map calibrated against the VAE, which is orders of
+            magnitude cheaper but only suitable for previews. If None, `tiny` is used
+            when fast VAE mode is enabled and `vae` otherwise.
 
         Returns
         -------
@@ -413,11 +1732,25 @@ class BaseDiffusion(ABC):
         """
         if output_type not in ["pt", "np", "pil"]:
             raise ValueError("`output_type` must be one of [`pt`, `np`, `pil`]")
-
-        image = self.vae.decode(
-            latent / self.vae.config.scaling_factor, return_dict=False
-        )[0]
-        image = denormalize(image)
+        if decoder is None:
+            decoder = "tiny" if self.use_fast_vae else "vae"
+        if decoder not in ["vae", "tiny", "linear"]:
+            raise ValueError("`decoder` must be one of [`vae`, `tiny`, `linear`]")
+
+        if decoder == "linear":
+            image = self._get_linear_latent_decoder()(latent)
+        elif decoder == "tiny":
+            if self.fast_vae is None:
+                raise ValueError(
+                    "A tiny autoencoder must be set with `set_fast_vae` first"
+                )
+            image = denormalize(self.fast_vae.decode(latent))
+        else:
+            latent = latent.to(self.component_dtypes["vae"])
+            image = self.vae.decode(
+                latent / self.vae.config.scaling_factor, return_dict=False
+            )[0]
+            image = denormalize(image)
 
         if output_type == "pt":
             return image
@@ -430,9 +1763,20 @@ class BaseDiffusion(ABC):
         image = numpy_to_pil(image)
         return image
 
+    def _get_linear_latent_decoder(self) -> LinearLatentDecoder:
+        # Calibrate lazily on first use, unless a pipeline sharing the VAE has already
+        # done so. The decoder is looked up by the current VAE, so a replaced VAE is
+        # calibrated again
+        decoder = load_latent_decoder_from_cache(self.vae)
+        if decoder is None:
+            decoder = self.calibrate_linear_latent_decoder()
+        self.linear_latent_decoder = decoder
+        return decoder
+
     def image_to_latent(
         self,
         image: Union[Image.Image, List[Image.Image], np.ndarray, torch.Tensor],
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
     ) -> torch.FloatTensor:
         """
         Convert an image or a list of images into a latent tensor.
@@ -442,6 +1786,9 @@ class BaseDiffusion(ABC):
         image: Union[Image.Image, List[Image.Image], np.ndarray, torch.Tensor]
             The input image(s) to convert into a latent tensor. Supported types are
             `PIL.Image.Image`, `np.ndarray`, and `torch.Tensor`.
+        generator: Union[torch.Generator, List[torch.Generator]], optional
+            Random number generator(s) for sampling from the latent distribution of
+            the VAE, one per image if a list.
 
         Returns
         -------
@@ -466,32 +1813,103 @@ class BaseDiffusion(ABC):
         if isinstance(image[0], np.ndarray):
             image: torch.FloatTensor = numpy_to_pt(image)
 
-        image = image.to(self.device)
-        latent = (
-            self.vae.encode(image).latent_dist.sample() * self.vae.config.scaling_factor
-        )
+        image = image.to(device=self.device, dtype=self.component_dtypes["vae"])
+        if self.use_fast_vae:
+            latent = self.fast_vae.encode(image)
+        else:
+            latent = (
+                self.vae.encode(image).latent_dist.sample(generator)
+                * self.vae.config.scaling_factor
+            )
+
+        return latent.to(self.component_dtypes["latent"])
+
+    def iter_decode(
+        self,
+        latent: Union[torch.FloatTensor, LatentHistory],
+        output_type: str,
+        return_latent_history: bool = False,
+        decode_batch_size: Optional[int] = None,
+        decoder: Optional[str] = None,
+    ) -> Iterator[Tuple[int, Union[torch.Tensor, np.ndarray, List[Image.Image]]]]:
+        """
+        Decode latents into images in micro-batches, yielding each decoded batch as
+        soon as it is ready. Peak memory is bounded by the micro-batch size regardless
+        of the number of prompts and inference steps.
+
+        Parameters
+        ----------
+        latent: Union[torch.FloatTensor, LatentHistory]
+            The latents to decode.
+        output_type: str
+            The desired output format. Should be one of [`pt`, `np`, `pil`].
+        return_latent_history: bool
+            If True, `latent` contains a latent tensor for each stored inference step,
+            with shape [num_steps, batch_size, ...]. Images are yielded prompt by
+            prompt, with all steps of a prompt before the next prompt.
+        decode_batch_size: int, optional
+            Number of latents to decode at once. If None, `decode_batch_size` of the
+            model is used.
+        decoder: str, optional
+            The decoder to use. Should be one of [`vae`, `tiny`, `linear`]. If None,
+            it is chosen based on whether fast VAE mode is enabled.
+
+        Yields
+        ------
+        Tuple[int, Union[torch.Tensor, np.ndarray, List[Image.Image]]]
+            The flat index of the first image in the batch and the decoded images.
+        """
+        if decode_batch_size is None:
+            decode_batch_size = self.decode_batch_size
 
-        return latent
+        if return_latent_history:
+            num_steps, batch_size = latent.shape[:2]
+        else:
+            num_steps, batch_size = 1, latent.shape[0]
+        total = num_steps * batch_size
+
+        for start in range(0, total, decode_batch_size):
+            end = min(start + decode_batch_size, total)
+            if return_latent_history:
+                # Flat index i refers to step (i % num_steps) of prompt (i // num_steps)
+                latent_batch = latent[
+                    [i % num_steps for i in range(start, end)],
+                    [i // num_steps for i in range(start, end)],
+                ]
+            else:
+                latent_batch = latent[start:end]
+            yield start, self.latent_to_image(latent_batch, output_type, decoder)
 
     def resolve_output(
         self,
-        latent: torch.FloatTensor,
+        latent: Union[torch.FloatTensor, LatentHistory],
         output_type: str,
         return_latent_history: bool,
+        decode_batch_size: Optional[int] = None,
+        decoder: Optional[str] = None,
     ) -> Union[torch.Tensor, np.ndarray, Image.Image, List[Image.Image]]:
         """
         Resolve the output from the latent based on the provided output options.
 
         Parameters
         ----------
-        latent: torch.FloatTensor
+        latent: Union[torch.FloatTensor, LatentHistory]
             The latent tensor representing the content to be resolved.
         output_type: str
             The desired output format. Should be one of [`latent`, `pt`, `np`, `pil`].
         return_latent_history: bool
-            If True, it means that the input latent tensor contains a tensor of latent
-            tensor for each inference step. This requires decoding each latent tensor
-            and returning a list of images. If False, decoding occurs directly.
+            If True, it means that the input latent tensor or `LatentHistory` contains
+            a latent tensor for each stored inference step. This requires decoding each
+            latent tensor and returning a list of images. If False, decoding occurs
+            directly.
+        decode_batch_size: int, optional
+            Number of latents to decode at once. Latents of all prompts and steps are
+            decoded together in micro-batches of this size. If None,
+            `decode_batch_size` of the model is used.
+        decoder: str, optional
+            The decoder to use. Should be one of [`vae`, `tiny`, `linear`]. `linear`
+            gives cheap approximate previews of the latent history. If None, it is
+            chosen based on whether fast VAE mode is enabled.
 
         Returns
         -------
@@ -507,25 +1925,48 @@ class BaseDiffusion(ABC):
             return latent
 
         if return_latent_history:
-            # Transpose latent tensor from [num_steps, batch_size, *latent_dim] to
-            # [batch_size, num_steps, *latent_dim].
-            # This is done so that the history of latent vectors for each prompt
-            # is returned as a row instead of a column. It is what the user would
-            # intuitively expect.
-            latent = torch.transpose(latent, 0, 1)
-            image = [
-                self.latent_to_image(l, output_type)
-                for _, l in list(enumerate(tqdm(latent)))
-            ]
+            num_steps, batch_size = latent.shape[:2]
+        else:
+            num_steps, batch_size = 1, latent.shape[0]
+        decode_batch_size = decode_batch_size or self.decode_batch_size
+
+        # Decoded micro-batches are written into an output buffer allocated once the
+        # image size is known, instead of being collected and stacked
+        image = None
+        for start, decoded in tqdm(
+            self.iter_decode(
+                latent=latent,
+                output_type=output_type,
+                return_latent_history=return_latent_history,
+                decode_batch_size=decode_batch_size,
+                decoder=decoder,
+            ),
+            total=math.ceil(num_steps * batch_size / decode_batch_size),
+            disable=not return_latent_history,
+        ):
+            if output_type == "pil":
+                image = decoded if image is None else image + decoded
+                continue
+            if image is None:
+                shape = (num_steps * batch_size, *decoded.shape[1:])
+                if output_type == "pt":
+                    image = torch.empty(
+                        shape, dtype=decoded.dtype, device=decoded.device
+                    )
+                else:
+                    image = np.empty(shape, dtype=decoded.dtype)
+            image[start : start + len(decoded)] = decoded
 
-            if output_type == "pt":
-                image = torch.stack(image)
-            elif output_type == "np":
-                image = np.stack(image)
+        if return_latent_history:
+            # The history of images for each prompt is returned as a row of shape
+            # [batch_size, num_steps, ...] instead of a column. It is what the user
+            # would intuitively expect.
+            if output_type == "pil":
+                image = [
+                    image[i * num_steps : (i + 1) * num_steps]
+                    for i in range(batch_size)
+                ]
             else:
-                # output type is "pil" so we can just return as a python list
-                pass
-        else:
-            image = self.latent_to_image(latent, output_type)
+                image = image.reshape(batch_size, num_steps, *image.shape[1:])
 
         return image
@@ -3,11 +3,10 @@ import torch
 
 from PIL import Image
 from diffusers import AutoencoderKL
-from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
-from typing import List, Optional, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
-from stablefused.diffusion import BaseDiffusion
+from stablefused.diffusion import BaseDiffusion, DiffusionStepEvent
 from stablefused.typing import UNet, Scheduler
 
 
@@ -38,15 +37,61 @@ class ImageToImageDiffusion(BaseDiffusion):
             **kwargs
         )
 
+    def prepare_latent(
+        self,
+        num_inference_steps: int,
+        start_step: int,
+        latent: torch.FloatTensor,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Tuple[torch.FloatTensor, torch.Tensor]:
+        """
+        Add noise to the image latent based on the start step and prepare the timesteps
+        for the denoising loop.
+
+        Parameters
+        ----------
+        num_inference_steps: int
+            Number of diffusion steps to run.
+        start_step: int
+            Step to start diffusion from.
+        latent: torch.FloatTensor
+            Latent of the input image.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the added noise.
+
+        Returns
+        -------
+        Tuple[torch.FloatTensor, torch.Tensor]
+            The noised latent and the timesteps to denoise for.
+        """
+
+        latent = latent.to(self.device)
+
+        # Set number of inference steps
+        self.scheduler.set_timesteps(num_inference_steps)
+
+        # Add noise to latent based on start step
+        start_timestep = (
+            self.scheduler.timesteps[start_step].repeat(latent.shape[0]).long()
+        )
+        noise = self.random_tensor(latent.shape, generator)
+        latent = self.scheduler.add_noise(latent, noise, start_timestep)
+
+        timesteps = self.scheduler.timesteps[start_step:]
+
+        return latent, timesteps
+
     def embedding_to_latent(
         self,
         embedding: torch.FloatTensor,
         num_inference_steps: int,
         start_step: int,
-        guidance_scale: float,
-        guidance_rescale: float,
+        guidance_scale: Union[float, List[float], torch.Tensor],
+        guidance_rescale: Union[float, List[float], torch.Tensor],
         latent: torch.FloatTensor,
         return_latent_history: bool = False,
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
     ) -> Union[torch.FloatTensor, List[torch.FloatTensor]]:
         """
         Generate latent by conditioning on prompt embedding and input image using diffusion.
@@ -60,17 +105,27 @@ class ImageToImageDiffusion(BaseDiffusion):
         start_step: int
             Step to start diffusion from. The higher the value, the more similar the generated
             image will be to the input image.
-        guidance_scale: float
+        guidance_scale: Union[float, List[float], torch.Tensor]
             Guidance scale encourages the model to generate images following the prompt
-            closely, albeit at the cost of image quality.
-        guidance_rescale: float
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per prompt.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
             Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
-            Flawed](https://arxiv.org/pdf/2305.08891.pdf).
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per prompt.
         latent: torch.FloatTensor
             Latent to start diffusion from.
         return_latent_history: bool
             Whether to return the latent history. If True, return list of all latents
             generated during diffusion steps.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start and including the
+            `start_step` skipped steps, during which classifier-free guidance is
+            applied. The unconditional branch is skipped for the remaining steps.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the added noise and the scheduler. Pass one
+            generator per prompt to make every sample reproducible independently of
+            the other prompts in the batch.
 
         Returns
         -------
@@ -79,51 +134,24 @@ class ImageToImageDiffusion(BaseDiffusion):
             all latents generated during diffusion steps.
         """
 
-        latent = latent.to(self.device)
-
-        # Set number of inference steps
-        self.scheduler.set_timesteps(num_inference_steps)
-
-        # Add noise to latent based on start step
-        start_timestep = (
-            self.scheduler.timesteps[start_step].repeat(latent.shape[0]).long()
+        latent, timesteps = self.prepare_latent(
+            num_inference_steps=num_inference_steps,
+            start_step=start_step,
+            latent=latent,
+            generator=generator,
         )
-        noise = self.random_tensor(latent.shape)
-        latent = self.scheduler.add_noise(latent, noise, start_timestep)
 
-        timesteps = self.scheduler.timesteps[start_step:]
-        latent_history = [latent]
-
-        # Diffusion inference loop
-        for i, timestep in tqdm(list(enumerate(timesteps))):
-            # Duplicate latent to avoid two forward passes to perform classifier free guidance
-            latent_model_input = torch.cat([latent] * 2)
-            latent_model_input = self.scheduler.scale_model_input(
-                latent_model_input, timestep
-            )
-
-            # Predict noise
-            noise_prediction = self.unet(
-                latent_model_input,
-                timestep,
-                encoder_hidden_states=embedding,
-                return_dict=False,
-            )[0]
-
-            # Perform classifier free guidance
-            noise_prediction = self.classifier_free_guidance(
-                noise_prediction, guidance_scale, guidance_rescale
-            )
-
-            # Update latent
-            latent = self.scheduler.step(
-                noise_prediction, timestep, latent, return_dict=False
-            )[0]
-
-            if return_latent_history:
-                latent_history.append(latent)
-
-        return torch.stack(latent_history) if return_latent_history else latent
+        # Run diffusion inference loop
+        return self.denoise(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            return_latent_history=return_latent_history,
+            generator=generator,
+        )
 
     @torch.no_grad()
     def __call__(
@@ -132,11 +160,13 @@ class ImageToImageDiffusion(BaseDiffusion):
         prompt: Union[str, List[str]],
         num_inference_steps: int = 50,
         start_step: int = 0,
-        guidance_scale: float = 7.5,
-        guidance_rescale: float = 0.7,
+        guidance_scale: Union[float, List[float], torch.Tensor] = 7.5,
+        guidance_rescale: Union[float, List[float], torch.Tensor] = 0.7,
         negative_prompt: Optional[Union[str, List[str]]] = None,
         output_type: str = "pil",
         return_latent_history: bool = False,
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
     ) -> Union[torch.Tensor, np.ndarray, List[Image.Image]]:
         """
         Run inference by conditioning on input image and text prompt.
@@ -152,12 +182,14 @@ class ImageToImageDiffusion(BaseDiffusion):
         start_step: int
             Step to start diffusion from. The higher the value, the more similar the generated
             image will be to the input image.
-        guidance_scale: float
+        guidance_scale: Union[float, List[float], torch.Tensor]
             Guidance scale encourages the model to generate images following the prompt
-            closely, albeit at the cost of image quality.
-        guidance_rescale: float
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per prompt.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
             Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
-            Flawed](https://arxiv.org/pdf/2305.08891.pdf).
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per prompt.
         negative_prompt: Optional[Union[str, List[str]]]
             Negative text prompt to uncondition on.
         output_type: str
@@ -165,6 +197,15 @@ class ImageToImageDiffusion(BaseDiffusion):
         return_latent_history: bool
             Whether to return the latent history. If True, return list of all latents
             generated during diffusion steps.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start and including the
+            `start_step` skipped steps, during which classifier-free guidance is
+            applied. The unconditional branch is skipped for the remaining steps,
+            roughly halving their UNet compute.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for encoding the image, the added noise and
+            the scheduler. Pass one generator per prompt to make every sample
+            reproducible independently of the other prompts in the batch.
 
         Returns
         -------
@@ -178,6 +219,7 @@ class ImageToImageDiffusion(BaseDiffusion):
             negative_prompt=negative_prompt,
             start_step=start_step,
             num_inference_steps=num_inference_steps,
+            guidance_end=guidance_end,
         )
 
         # Generate embedding to condition on prompt and uncondition on negative prompt
@@ -187,7 +229,7 @@ class ImageToImageDiffusion(BaseDiffusion):
         )
 
         # Generate latent from input image
-        image_latent = self.image_to_latent(image)
+        image_latent = self.image_to_latent(image, generator)
 
         # Run inference
         latent = self.embedding_to_latent(
@@ -196,8 +238,10 @@ class ImageToImageDiffusion(BaseDiffusion):
             start_step=start_step,
             guidance_scale=guidance_scale,
             guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
             latent=image_latent,
             return_latent_history=return_latent_history,
+            generator=generator,
         )
 
         return self.resolve_output(
@@ -207,3 +251,109 @@ class ImageToImageDiffusion(BaseDiffusion):
         )
 
     generate = __call__
+
+    @torch.no_grad()
+    def generate_stream(
+        self,
+        image: Image.Image,
+        prompt: Union[str, List[str]],
+        num_inference_steps: int = 50,
+        start_step: int = 0,
+        guidance_scale: Union[float, List[float], torch.Tensor] = 7.5,
+        guidance_rescale: Union[float, List[float], torch.Tensor] = 0.7,
+        negative_prompt: Optional[Union[str, List[str]]] = None,
+        guidance_end: float = 1.0,
+        preview_type: Optional[str] = None,
+        preview_interval: int = 1,
+        preview_decoder: Optional[str] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Iterator[DiffusionStepEvent]:
+        """
+        Run inference by conditioning on input image and text prompt, yielding an event
+        after every denoising step instead of blocking until generation is complete.
+        The latent of the last event can be decoded with `resolve_output`.
+
+        Parameters
+        ----------
+        image: Image.Image
+            Input image to condition on.
+        prompt: Union[str, List[str]]
+            Text prompt to condition on.
+        num_inference_steps: int
+            Number of diffusion steps to run.
+        start_step: int
+            Step to start diffusion from. The higher the value, the more similar the generated
+            image will be to the input image.
+        guidance_scale: Union[float, List[float], torch.Tensor]
+            Guidance scale encourages the model to generate images following the prompt
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per prompt.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
+            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per prompt.
+        negative_prompt: Optional[Union[str, List[str]]]
+            Negative text prompt to uncondition on.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start and including the
+            `start_step` skipped steps, during which classifier-free guidance is
+            applied.
+        preview_type: Optional[str]
+            Type of preview to decode from the latent. One of ["pil", "pt", "np"]. If
+            None, no previews are decoded.
+        preview_interval: int
+            Decode a preview every `preview_interval` steps. A preview is always
+            decoded for the last step.
+        preview_decoder: Optional[str]
+            The decoder to use for previews. One of ["vae", "tiny", "linear"]. The
+            linear decoder is calibrated against the VAE once per model and is much
+            cheaper. If None, it is chosen based on whether fast VAE mode is enabled.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for encoding the image, the added noise and
+            the scheduler. Pass one generator per prompt to make every sample
+            reproducible independently of the other prompts in the batch.
+
+        Yields
+        ------
+        DiffusionStepEvent
+            The step index, number of steps, timestep, latent and optional preview.
+        """
+
+        # Validate input
+        self.validate_input(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            start_step=start_step,
+            num_inference_steps=num_inference_steps,
+            guidance_end=guidance_end,
+        )
+
+        # Generate embedding to condition on prompt and uncondition on negative prompt
+        embedding = self.prompt_to_embedding(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+        )
+
+        # Generate latent from input image
+        image_latent = self.image_to_latent(image, generator)
+
+        latent, timesteps = self.prepare_latent(
+            num_inference_steps=num_inference_steps,
+            start_step=start_step,
+            latent=image_latent,
+            generator=generator,
+        )
+
+        # Run diffusion inference loop, one step at a time
+        yield from self.stream_denoise(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            preview_type=preview_type,
+            preview_interval=preview_interval,
+            preview_decoder=preview_decoder,
+            generator=generator,
+        )
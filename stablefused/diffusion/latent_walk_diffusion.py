@@ -3,11 +3,10 @@ import torch
 
 from PIL import Image
 from diffusers import AutoencoderKL
-from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
-from typing import List, Optional, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
-from stablefused.diffusion import BaseDiffusion
+from stablefused.diffusion import BaseDiffusion, DiffusionStepEvent
 from stablefused.typing import UNet, Scheduler
 from stablefused.utils import lerp, slerp
 
@@ -43,6 +42,7 @@ class LatentWalkDiffusion(BaseDiffusion):
         self,
         latent: torch.FloatTensor,
         strength: float,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
     ) -> torch.FloatTensor:
         """
         Modify a latent vector by adding noise.
@@ -53,17 +53,56 @@ class LatentWalkDiffusion(BaseDiffusion):
             The input latent vector to modify.
         strength: float
             The strength of the modification, controlling the amount of noise added.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the added noise, one per latent if a list.
 
         Returns
         -------
         torch.FloatTensor
             Modified latent vector.
         """
-        noise = self.random_tensor(latent.shape)
+        noise = self.random_tensor(latent.shape, generator)
         new_latent = (1 - strength) * latent + strength * noise
-        new_latent = (new_latent - new_latent.mean()) / new_latent.std()
+        # Normalize every latent on its own, so that a latent does not depend on the
+        # others in the batch
+        dims = tuple(range(1, new_latent.ndim))
+        new_latent = (new_latent - new_latent.mean(dim=dims, keepdim=True)) / (
+            new_latent.std(dim=dims, keepdim=True)
+        )
         return new_latent
 
+    def prepare_latent(
+        self,
+        num_inference_steps: int,
+        latent: torch.FloatTensor,
+    ) -> Tuple[torch.FloatTensor, torch.Tensor]:
+        """
+        Prepare the initial latent and the timesteps for the denoising loop.
+
+        Parameters
+        ----------
+        num_inference_steps: int
+            Number of diffusion steps to run.
+        latent: torch.FloatTensor
+            Latent to start from.
+
+        Returns
+        -------
+        Tuple[torch.FloatTensor, torch.Tensor]
+            The scaled initial latent and the timesteps to denoise for.
+        """
+
+        latent = latent.to(self.device)
+
+        # Set number of inference steps
+        self.scheduler.set_timesteps(num_inference_steps)
+        timesteps = self.scheduler.timesteps
+
+        # Scale the latent noise by the standard deviation required by the scheduler
+        latent = latent * self.scheduler.init_noise_sigma
+
+        return latent, timesteps
+
     def embedding_to_latent(
         self,
         embedding: torch.FloatTensor,
@@ -72,6 +111,8 @@ class LatentWalkDiffusion(BaseDiffusion):
         guidance_rescale: float,
         latent: torch.FloatTensor,
         return_latent_history: bool = False,
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
     ) -> Union[torch.FloatTensor, List[torch.FloatTensor]]:
         """
         Generate latent by conditioning on prompt embedding using diffusion.
@@ -93,6 +134,12 @@ class LatentWalkDiffusion(BaseDiffusion):
         return_latent_history: bool
             Whether to return latent history. If True, return list of all latents
             generated during diffusion steps.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied. The unconditional branch is skipped
+            for the remaining steps.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the scheduler.
 
         Returns
         -------
@@ -101,46 +148,22 @@ class LatentWalkDiffusion(BaseDiffusion):
             all latents generated during diffusion steps.
         """
 
-        latent = latent.to(self.device)
-
-        # Set number of inference steps
-        self.scheduler.set_timesteps(num_inference_steps)
-        timesteps = self.scheduler.timesteps
-
-        # Scale the latent noise by the standard deviation required by the scheduler
-        latent = latent * self.scheduler.init_noise_sigma
-        latent_history = [latent]
-
-        # Diffusion inference loop
-        for i, timestep in tqdm(list(enumerate(timesteps))):
-            # Duplicate latent to avoid two forward passes to perform classifier free guidance
-            latent_model_input = torch.cat([latent] * 2)
-            latent_model_input = self.scheduler.scale_model_input(
-                latent_model_input, timestep
-            )
-
-            # Predict noise
-            noise_prediction = self.unet(
-                latent_model_input,
-                timestep,
-                encoder_hidden_states=embedding,
-                return_dict=False,
-            )[0]
-
-            # Perform classifier free guidance
-            noise_prediction = self.classifier_free_guidance(
-                noise_prediction, guidance_scale, guidance_rescale
-            )
-
-            # Update latent
-            latent = self.scheduler.step(
-                noise_prediction, timestep, latent, return_dict=False
-            )[0]
-
-            if return_latent_history:
-                latent_history.append(latent)
+        latent, timesteps = self.prepare_latent(
+            num_inference_steps=num_inference_steps,
+            latent=latent,
+        )
 
-        return torch.stack(latent_history) if return_latent_history else latent
+        # Run diffusion inference loop
+        return self.denoise(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            return_latent_history=return_latent_history,
+            generator=generator,
+        )
 
     def interpolate_embedding(
         self,
@@ -263,6 +286,8 @@ class LatentWalkDiffusion(BaseDiffusion):
         negative_prompt: Optional[Union[str, List[str]]] = None,
         output_type: str = "pil",
         return_latent_history: bool = False,
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
     ) -> Union[torch.Tensor, np.ndarray, List[Image.Image]]:
         """
         Run inference by conditioning on text prompt starting from provided latent tensor.
@@ -290,6 +315,13 @@ class LatentWalkDiffusion(BaseDiffusion):
         return_latent_history: bool
             Whether to return the latent history. If True, return list of all latents
             generated during diffusion steps.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied. The unconditional branch is skipped
+            for the remaining steps, roughly halving their UNet compute.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the added noise and the scheduler. Pass one
+            generator per prompt to make every sample reproducible.
 
         Returns
         -------
@@ -302,6 +334,7 @@ class LatentWalkDiffusion(BaseDiffusion):
             prompt=prompt,
             negative_prompt=negative_prompt,
             strength=strength,
+            guidance_end=guidance_end,
         )
 
         # Generate embedding to condition on prompt and uncondition on negative prompt
@@ -311,7 +344,7 @@ class LatentWalkDiffusion(BaseDiffusion):
         )
 
         # Modify latent
-        latent = self.modify_latent(latent, strength)
+        latent = self.modify_latent(latent, strength, generator)
 
         # Run inference
         latent = self.embedding_to_latent(
@@ -319,8 +352,10 @@ class LatentWalkDiffusion(BaseDiffusion):
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
             guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
             latent=latent,
             return_latent_history=return_latent_history,
+            generator=generator,
         )
 
         return self.resolve_output(
@@ -331,6 +366,105 @@ class LatentWalkDiffusion(BaseDiffusion):
 
     generate = __call__
 
+    @torch.no_grad()
+    def generate_stream(
+        self,
+        prompt: Union[str, List[str]],
+        latent: torch.FloatTensor,
+        strength: float = 0.2,
+        num_inference_steps: int = 50,
+        guidance_scale: float = 7.5,
+        guidance_rescale: float = 0.7,
+        negative_prompt: Optional[Union[str, List[str]]] = None,
+        guidance_end: float = 1.0,
+        preview_type: Optional[str] = None,
+        preview_interval: int = 1,
+        preview_decoder: Optional[str] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Iterator[DiffusionStepEvent]:
+        """
+        Run inference by conditioning on text prompt starting from provided latent
+        tensor, yielding an event after every denoising step instead of blocking until
+        generation is complete. The latent of the last event can be decoded with
+        `resolve_output`.
+
+        Parameters
+        ----------
+        prompt: Union[str, List[str]]
+            Text prompt to condition on.
+        latent: torch.FloatTensor
+            Latent to start from.
+        strength: float
+            The strength of the latent modification, controlling the amount of noise added.
+        num_inference_steps: int
+            Number of diffusion steps to run.
+        guidance_scale: float
+            Guidance scale encourages the model to generate images following the prompt
+            closely, albeit at the cost of image quality.
+        guidance_rescale: float
+            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf).
+        negative_prompt: Optional[Union[str, List[str]]]
+            Negative text prompt to uncondition on.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied.
+        preview_type: Optional[str]
+            Type of preview to decode from the latent. One of ["pil", "pt", "np"]. If
+            None, no previews are decoded.
+        preview_interval: int
+            Decode a preview every `preview_interval` steps. A preview is always
+            decoded for the last step.
+        preview_decoder: Optional[str]
+            The decoder to use for previews. One of ["vae", "tiny", "linear"]. The
+            linear decoder is calibrated against the VAE once per model and is much
+            cheaper. If None, it is chosen based on whether fast VAE mode is enabled.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the added noise and the scheduler. Pass one
+            generator per prompt to make every sample reproducible.
+
+        Yields
+        ------
+        DiffusionStepEvent
+            The step index, number of steps, timestep, latent and optional preview.
+        """
+
+        # Validate input
+        self.validate_input(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            strength=strength,
+            guidance_end=guidance_end,
+        )
+
+        # Generate embedding to condition on prompt and uncondition on negative prompt
+        embedding = self.prompt_to_embedding(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+        )
+
+        # Modify latent
+        latent = self.modify_latent(latent, strength, generator)
+
+        latent, timesteps = self.prepare_latent(
+            num_inference_steps=num_inference_steps,
+            latent=latent,
+        )
+
+        # Run diffusion inference loop, one step at a time
+        yield from self.stream_denoise(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            preview_type=preview_type,
+            preview_interval=preview_interval,
+            preview_decoder=preview_decoder,
+            generator=generator,
+        )
+
     @torch.no_grad()
     def interpolate(
         self,
@@ -347,6 +481,7 @@ class LatentWalkDiffusion(BaseDiffusion):
         return_latent_history: bool = False,
         embedding_interpolation_type: str = "lerp",
         latent_interpolation_type: str = "slerp",
+        guidance_end: float = 1.0,
     ) -> Union[torch.Tensor, np.ndarray, List[Image.Image]]:
         """
         Run inference by conditioning on text prompts and interpolating between them.
@@ -383,6 +518,10 @@ class LatentWalkDiffusion(BaseDiffusion):
             Type of interpolation to run for text embeddings. One of ["lerp", "slerp"].
         latent_interpolation_type: str
             Type of interpolation to run for latents. One of ["lerp", "slerp"].
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied. The unconditional branch is skipped
+            for the remaining steps, roughly halving their UNet compute.
 
         Returns
         -------
@@ -396,6 +535,7 @@ class LatentWalkDiffusion(BaseDiffusion):
             negative_prompt=negative_prompt,
             image_height=image_height,
             image_width=image_width,
+            guidance_end=guidance_end,
         )
 
         # There should be atleast 2 prompts to run interpolation
@@ -460,6 +600,7 @@ class LatentWalkDiffusion(BaseDiffusion):
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
             guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
             latent=interpolated_latent,
             return_latent_history=return_latent_history,
         )
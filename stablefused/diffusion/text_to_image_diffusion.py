@@ -3,11 +3,10 @@ import torch
 
 from PIL import Image
 from diffusers import AutoencoderKL
-from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
-from typing import List, Optional, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
-from stablefused.diffusion import BaseDiffusion
+from stablefused.diffusion import BaseDiffusion, DiffusionStepEvent
 from stablefused.typing import UNet, Scheduler
 
 
@@ -38,19 +37,17 @@ class TextToImageDiffusion(BaseDiffusion):
             **kwargs
         )
 
-    def embedding_to_latent(
+    def prepare_latent(
         self,
         embedding: torch.FloatTensor,
         image_height: int,
         image_width: int,
         num_inference_steps: int,
-        guidance_scale: float,
-        guidance_rescale: float,
         latent: Optional[torch.FloatTensor] = None,
-        return_latent_history: bool = False,
-    ) -> Union[torch.FloatTensor, List[torch.FloatTensor]]:
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Tuple[torch.FloatTensor, torch.Tensor]:
         """
-        Generate latent by conditioning on prompt embedding using diffusion.
+        Prepare the initial latent and the timesteps for the denoising loop.
 
         Parameters
         ----------
@@ -62,23 +59,15 @@ class TextToImageDiffusion(BaseDiffusion):
             Width of image to generate.
         num_inference_steps: int
             Number of diffusion steps to run.
-        guidance_scale: float
-            Guidance scale encourages the model to generate images following the prompt
-            closely, albeit at the cost of image quality.
-        guidance_rescale: float
-            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
-            Flawed](https://arxiv.org/pdf/2305.08891.pdf).
         latent: Optional[torch.FloatTensor]
             Latent to start from. If None, generate latent from noise.
-        return_latent_history: bool
-            Whether to return latent history. If True, return list of all latents
-            generated during diffusion steps.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the initial noise.
 
         Returns
         -------
-        Union[torch.FloatTensor, List[torch.FloatTensor]]
-            Latent generated by diffusion. If return_latent_history is True, return
-            list of all latents generated during diffusion steps.
+        Tuple[torch.FloatTensor, torch.Tensor]
+            The scaled initial latent and the timesteps to denoise for.
         """
 
         # Generate latent from noise if not provided
@@ -89,7 +78,7 @@ class TextToImageDiffusion(BaseDiffusion):
                 image_height // self.vae_scale_factor,
                 image_width // self.vae_scale_factor,
             )
-            latent = self.random_tensor(shape)
+            latent = self.random_tensor(shape, generator)
         latent = latent.to(self.device)
 
         # Set number of inference steps
@@ -98,38 +87,84 @@ class TextToImageDiffusion(BaseDiffusion):
 
         # Scale the latent noise by the standard deviation required by the scheduler
         latent = latent * self.scheduler.init_noise_sigma
-        latent_history = [latent]
-
-        # Diffusion inference loop
-        for i, timestep in tqdm(list(enumerate(timesteps))):
-            # Duplicate latent to avoid two forward passes to perform classifier free guidance
-            latent_model_input = torch.cat([latent] * 2)
-            latent_model_input = self.scheduler.scale_model_input(
-                latent_model_input, timestep
-            )
 
-            # Predict noise
-            noise_prediction = self.unet(
-                latent_model_input,
-                timestep,
-                encoder_hidden_states=embedding,
-                return_dict=False,
-            )[0]
-
-            # Perform classifier free guidance
-            noise_prediction = self.classifier_free_guidance(
-                noise_prediction, guidance_scale, guidance_rescale
-            )
+        return latent, timesteps
 
-            # Update latent
-            latent = self.scheduler.step(
-                noise_prediction, timestep, latent, return_dict=False
-            )[0]
+    def embedding_to_latent(
+        self,
+        embedding: torch.FloatTensor,
+        image_height: int,
+        image_width: int,
+        num_inference_steps: int,
+        guidance_scale: Union[float, List[float], torch.Tensor],
+        guidance_rescale: Union[float, List[float], torch.Tensor],
+        latent: Optional[torch.FloatTensor] = None,
+        return_latent_history: bool = False,
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Union[torch.FloatTensor, List[torch.FloatTensor]]:
+        """
+        Generate latent by conditioning on prompt embedding using diffusion.
 
-            if return_latent_history:
-                latent_history.append(latent)
+        Parameters
+        ----------
+        embedding: torch.FloatTensor
+            Embedding of text prompt.
+        image_height: int
+            Height of image to generate.
+        image_width: int
+            Width of image to generate.
+        num_inference_steps: int
+            Number of diffusion steps to run.
+        guidance_scale: Union[float, List[float], torch.Tensor]
+            Guidance scale encourages the model to generate images following the prompt
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per prompt.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
+            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per prompt.
+        latent: Optional[torch.FloatTensor]
+            Latent to start from. If None, generate latent from noise.
+        return_latent_history: bool
+            Whether to return latent history. If True, return list of all latents
+            generated during diffusion steps.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied. The unconditional branch is skipped
+            for the remaining steps.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the initial noise and the scheduler. Pass one
+            generator per prompt to make every sample reproducible independently of
+            the other prompts in the batch.
 
-        return torch.stack(latent_history) if return_latent_history else latent
+        Returns
+        -------
+        Union[torch.FloatTensor, List[torch.FloatTensor]]
+            Latent generated by diffusion. If return_latent_history is True, return
+            list of all latents generated during diffusion steps.
+        """
+
+        latent, timesteps = self.prepare_latent(
+            embedding=embedding,
+            image_height=image_height,
+            image_width=image_width,
+            num_inference_steps=num_inference_steps,
+            latent=latent,
+            generator=generator,
+        )
+
+        # Run diffusion inference loop
+        return self.denoise(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            return_latent_history=return_latent_history,
+            generator=generator,
+        )
 
     @torch.no_grad()
     def __call__(
@@ -138,12 +173,14 @@ class TextToImageDiffusion(BaseDiffusion):
         image_height: int = 512,
         image_width: int = 512,
         num_inference_steps: int = 50,
-        guidance_scale: float = 7.5,
-        guidance_rescale: float = 0.7,
+        guidance_scale: Union[float, List[float], torch.Tensor] = 7.5,
+        guidance_rescale: Union[float, List[float], torch.Tensor] = 0.7,
         negative_prompt=None,
         latent: Optional[torch.FloatTensor] = None,
         output_type: str = "pil",
         return_latent_history: bool = False,
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
     ) -> Union[torch.Tensor, np.ndarray, List[Image.Image]]:
         """
         Run inference by conditioning on text prompt.
@@ -158,12 +195,14 @@ class TextToImageDiffusion(BaseDiffusion):
             Width of image to generate.
         num_inference_steps: int
             Number of diffusion steps to run.
-        guidance_scale: float
+        guidance_scale: Union[float, List[float], torch.Tensor]
             Guidance scale encourages the model to generate images following the prompt
-            closely, albeit at the cost of image quality.
-        guidance_rescale: float
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per prompt.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
             Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
-            Flawed](https://arxiv.org/pdf/2305.08891.pdf).
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per prompt.
         negative_prompt: Optional[Union[str, List[str]]]
             Negative text prompt to uncondition on.
         latent: Optional[torch.FloatTensor]
@@ -173,6 +212,14 @@ class TextToImageDiffusion(BaseDiffusion):
         return_latent_history: bool
             Whether to return the latent history. If True, return list of all latents
             generated during diffusion steps.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied. The unconditional branch is skipped
+            for the remaining steps, roughly halving their UNet compute.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the initial noise and the scheduler. Pass one
+            generator per prompt to make every sample reproducible independently of
+            the other prompts in the batch.
 
         Returns
         -------
@@ -186,6 +233,7 @@ class TextToImageDiffusion(BaseDiffusion):
             negative_prompt=negative_prompt,
             image_height=image_height,
             image_width=image_width,
+            guidance_end=guidance_end,
         )
 
         # Generate embedding to condition on prompt and uncondition on negative prompt
@@ -202,8 +250,10 @@ class TextToImageDiffusion(BaseDiffusion):
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
             guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
             latent=latent,
             return_latent_history=return_latent_history,
+            generator=generator,
         )
 
         return self.resolve_output(
@@ -213,3 +263,109 @@ class TextToImageDiffusion(BaseDiffusion):
         )
 
     generate = __call__
+
+    @torch.no_grad()
+    def generate_stream(
+        self,
+        prompt: Union[str, List[str]],
+        image_height: int = 512,
+        image_width: int = 512,
+        num_inference_steps: int = 50,
+        guidance_scale: Union[float, List[float], torch.Tensor] = 7.5,
+        guidance_rescale: Union[float, List[float], torch.Tensor] = 0.7,
+        negative_prompt=None,
+        latent: Optional[torch.FloatTensor] = None,
+        guidance_end: float = 1.0,
+        preview_type: Optional[str] = None,
+        preview_interval: int = 1,
+        preview_decoder: Optional[str] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Iterator[DiffusionStepEvent]:
+        """
+        Run inference by conditioning on text prompt, yielding an event after every
+        denoising step instead of blocking until generation is complete. The latent of
+        the last event can be decoded with `resolve_output`.
+
+        Parameters
+        ----------
+        prompt: Union[str, List[str]]
+            Text prompt to condition on.
+        image_height: int
+            Height of image to generate.
+        image_width: int
+            Width of image to generate.
+        num_inference_steps: int
+            Number of diffusion steps to run.
+        guidance_scale: Union[float, List[float], torch.Tensor]
+            Guidance scale encourages the model to generate images following the prompt
+            closely, albeit at the cost of image quality. Either a scalar, or one value
+            per prompt.
+        guidance_rescale: Union[float, List[float], torch.Tensor]
+            Guidance rescale from [Common Diffusion Noise Schedules and Sample Steps are
+            Flawed](https://arxiv.org/pdf/2305.08891.pdf). Either a scalar, or one value
+            per prompt.
+        negative_prompt: Optional[Union[str, List[str]]]
+            Negative text prompt to uncondition on.
+        latent: Optional[torch.FloatTensor]
+            Latent to start from. If None, latent is generated from noise.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied.
+        preview_type: Optional[str]
+            Type of preview to decode from the latent. One of ["pil", "pt", "np"]. If
+            None, no previews are decoded.
+        preview_interval: int
+            Decode a preview every `preview_interval` steps. A preview is always
+            decoded for the last step.
+        preview_decoder: Optional[str]
+            The decoder to use for previews. One of ["vae", "tiny", "linear"]. The
+            linear decoder is calibrated against the VAE once per model and is much
+            cheaper. If None, it is chosen based on whether fast VAE mode is enabled.
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]]
+            Random number generator(s) for the initial noise and the scheduler. Pass one
+            generator per prompt to make every sample reproducible independently of
+            the other prompts in the batch.
+
+        Yields
+        ------
+        DiffusionStepEvent
+            The step index, number of steps, timestep, latent and optional preview.
+        """
+
+        # Validate input
+        self.validate_input(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            image_height=image_height,
+            image_width=image_width,
+            guidance_end=guidance_end,
+        )
+
+        # Generate embedding to condition on prompt and uncondition on negative prompt
+        embedding = self.prompt_to_embedding(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+        )
+
+        latent, timesteps = self.prepare_latent(
+            embedding=embedding,
+            image_height=image_height,
+            image_width=image_width,
+            num_inference_steps=num_inference_steps,
+            latent=latent,
+            generator=generator,
+        )
+
+        # Run diffusion inference loop, one step at a time
+        yield from self.stream_denoise(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            preview_type=preview_type,
+            preview_interval=preview_interval,
+            preview_decoder=preview_decoder,
+            generator=generator,
+        )
@@ -3,12 +3,12 @@ import torch
 
 from PIL import Image
 from diffusers import AutoencoderKL
-from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
-from typing import List, Optional, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
 from stablefused.diffusion import BaseDiffusion
 from stablefused.typing import UNet, Scheduler
+from stablefused.utils import numpy_to_uint8
 
 
 class TextToVideoDiffusion(BaseDiffusion):
@@ -48,6 +48,7 @@ class TextToVideoDiffusion(BaseDiffusion):
         guidance_scale: float,
         guidance_rescale: float,
         latent: Optional[torch.FloatTensor] = None,
+        guidance_end: float = 1.0,
     ) -> Union[torch.FloatTensor, List[torch.FloatTensor]]:
         """
         Generate latent by conditioning on prompt embedding using diffusion.
@@ -72,6 +73,10 @@ class TextToVideoDiffusion(BaseDiffusion):
             Flawed](https://arxiv.org/pdf/2305.08891.pdf).
         latent: Optional[torch.FloatTensor]
             Latent to start from. If None, generate latent from noise.
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied. The unconditional branch is skipped
+            for the remaining steps.
 
         Returns
         -------
@@ -97,38 +102,21 @@ class TextToVideoDiffusion(BaseDiffusion):
         # Scale the latent noise by the standard deviation required by the scheduler
         latent = latent * self.scheduler.init_noise_sigma
 
-        # Diffusion inference loop
-        for i, timestep in tqdm(list(enumerate(timesteps))):
-            # Duplicate latent to avoid two forward passes to perform classifier free guidance
-            latent_model_input = torch.cat([latent] * 2)
-            latent_model_input = self.scheduler.scale_model_input(
-                latent_model_input, timestep
-            )
-
-            # Predict noise
-            noise_prediction = self.unet(
-                latent_model_input,
-                timestep,
-                encoder_hidden_states=embedding,
-                return_dict=False,
-            )[0]
-
-            # Perform classifier free guidance
-            noise_prediction = self.classifier_free_guidance(
-                noise_prediction, guidance_scale, guidance_rescale
-            )
-
-            # Update latent
-            latent = self.scheduler.step(
-                noise_prediction, timestep, latent, return_dict=False
-            )[0]
-
-        return latent
+        # Run diffusion inference loop
+        return self.denoise(
+            latent=latent,
+            embedding=embedding,
+            timesteps=timesteps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+        )
 
     def resolve_output(
         self,
         latent: torch.FloatTensor,
         output_type: str,
+        decode_batch_size: Optional[int] = None,
     ) -> Union[torch.Tensor, np.ndarray, List[Image.Image]]:
         """
         Resolve output type from latent.
@@ -139,6 +127,9 @@ class TextToVideoDiffusion(BaseDiffusion):
             Latent to resolve output from.
         output_type: str
             Output type to resolve. Must be one of [`latent`, `pt`, `np`, `pil`].
+        decode_batch_size: int, optional
+            Number of frames to decode at once. Micro-batches span video boundaries.
+            If None, `decode_batch_size` of the model is used.
 
         Returns
         -------
@@ -154,24 +145,128 @@ class TextToVideoDiffusion(BaseDiffusion):
         if output_type == "latent":
             return latent
 
-        # B, C, F, H, W => B, F, C, H, W
-        latent = latent.permute(0, 2, 1, 3, 4)
-        video = []
+        # B, C, F, H, W => F, B, C, H, W
+        # Frames play the role of inference steps in a latent history, so that frames
+        # are decoded in micro-batches across videos into a preallocated output
+        return super().resolve_output(
+            latent=latent.permute(2, 0, 1, 3, 4),
+            output_type=output_type,
+            return_latent_history=True,
+            decode_batch_size=decode_batch_size,
+        )
 
-        # Decode each batch
-        # TODO: There can be many frames in a video, so this is not memory efficient
-        #       and should be improved. There should be batching here, when processing
-        #       the batches.
-        for i in tqdm(range(latent.shape[0])):
-            video.append(self.latent_to_image(latent[i], output_type))
+    def iter_frames(
+        self,
+        latent: torch.FloatTensor,
+        decode_batch_size: Optional[int] = None,
+    ) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """
+        Decode video latents in micro-batches of frames, yielding frames as uint8
+        arrays as soon as they are decoded. Frames of each video are yielded in order,
+        one video after another.
 
-        if output_type == "pt":
-            video = torch.stack(video)
-        elif output_type == "np":
-            video = np.stack(video)
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Video latent of shape (batch_size, channels, frames, height, width).
+        decode_batch_size: int, optional
+            Number of frames to decode at once. Micro-batches span video boundaries.
+            If None, `decode_batch_size` of the model is used.
+
+        Yields
+        ------
+        Tuple[int, int, np.ndarray]
+            The video index, the frame index and the frame of shape (H, W, C).
+        """
+        num_frames = latent.shape[2]
+
+        for start, frames in self.iter_decode(
+            latent=latent.permute(2, 0, 1, 3, 4),
+            output_type="np",
+            return_latent_history=True,
+            decode_batch_size=decode_batch_size,
+        ):
+            frames = numpy_to_uint8(frames)
+            for i, frame in enumerate(frames, start=start):
+                yield i // num_frames, i % num_frames, frame
+
+    def decode_video(
+        self,
+        latent: torch.FloatTensor,
+        decode_batch_size: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        Decode video latents into a preallocated uint8 array. This needs a quarter of
+        the memory of float32 `np` output and is suitable for long, high resolution
+        videos.
 
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Video latent of shape (batch_size, channels, frames, height, width).
+        decode_batch_size: int, optional
+            Number of frames to decode at once. Micro-batches span video boundaries.
+            If None, `decode_batch_size` of the model is used.
+
+        Returns
+        -------
+        np.ndarray
+            Videos as a uint8 array of shape (batch_size, frames, H, W, C).
+        """
+        video = None
+        for i, j, frame in self.iter_frames(latent, decode_batch_size):
+            if video is None:
+                shape = (latent.shape[0], latent.shape[2], *frame.shape)
+                video = np.empty(shape, dtype=np.uint8)
+            video[i, j] = frame
         return video
 
+    def save_video(
+        self,
+        latent: torch.FloatTensor,
+        filename: Union[str, List[str]],
+        fps: int = 8,
+        decode_batch_size: Optional[int] = None,
+    ) -> None:
+        """
+        Decode video latents and write frames straight to video files as they are
+        decoded, without keeping the decoded videos in memory.
+
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Video latent of shape (batch_size, channels, frames, height, width).
+        filename: Union[str, List[str]]
+            Filename to save the video to, or a list of filenames with one filename
+            per video in the batch.
+        fps: int
+            Frames per second of the videos.
+        decode_batch_size: int, optional
+            Number of frames to decode at once. Micro-batches span video boundaries.
+            If None, `decode_batch_size` of the model is used.
+        """
+        # imageio is slow to import and only needed here
+        import imageio
+
+        if isinstance(filename, str):
+            filename = [filename]
+        if len(filename) != latent.shape[0]:
+            raise ValueError(
+                f"Expected {latent.shape[0]} filenames, one per video, got {len(filename)}"
+            )
+
+        video_writer = None
+        try:
+            for i, j, frame in self.iter_frames(latent, decode_batch_size):
+                if j == 0:
+                    if video_writer is not None:
+                        video_writer.close()
+                    video_writer = imageio.get_writer(filename[i], fps=fps)
+                video_writer.append_data(frame)
+        finally:
+            if video_writer is not None:
+                video_writer.close()
+
     @torch.no_grad()
     def __call__(
         self,
@@ -185,6 +280,7 @@ class TextToVideoDiffusion(BaseDiffusion):
         negative_prompt: Optional[Union[str, List[str]]] = None,
         latent: Optional[torch.FloatTensor] = None,
         output_type: str = "pil",
+        guidance_end: float = 1.0,
     ) -> Union[torch.Tensor, np.ndarray, List[Image.Image]]:
         """
         Run inference by conditioning on text prompt.
@@ -213,6 +309,10 @@ class TextToVideoDiffusion(BaseDiffusion):
             Latent to start from. If None, latent is generated from noise.
         output_type: str
             Type of output to return. One of ["latent", "pil", "pt", "np"].
+        guidance_end: float
+            Fraction of the inference steps, counted from the start, during which
+            classifier-free guidance is applied. The unconditional branch is skipped
+            for the remaining steps, roughly halving their UNet compute.
 
         Returns
         -------
@@ -227,6 +327,7 @@ class TextToVideoDiffusion(BaseDiffusion):
             image_height=video_height,
             image_width=video_width,
             num_inference_steps=num_inference_steps,
+            guidance_end=guidance_end,
         )
 
         # Generate embedding to condition on prompt and uncondition on negative prompt
@@ -244,6 +345,7 @@ class TextToVideoDiffusion(BaseDiffusion):
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
             guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
             latent=latent,
         )
 
@@ -0,0 +1 @@
+from .tiny_autoencoder import TinyAutoencoder
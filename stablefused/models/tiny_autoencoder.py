@@ -0,0 +1,225 @@
+import os
+import torch
+import torch.nn as nn
+
+from safetensors.torch import load_file, save_file
+from typing import Dict, Optional
+
+
+def conv(n_in: int, n_out: int, **kwargs) -> nn.Conv2d:
+    return nn.Conv2d(n_in, n_out, 3, padding=1, **kwargs)
+
+
+class Clamp(nn.Module):
+    """Softly clamp latents to the range [-3, 3]."""
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.tanh(x / 3) * 3
+
+
+class Block(nn.Module):
+    """Residual block of three convolutions."""
+
+    def __init__(self, n_in: int, n_out: int) -> None:
+        super().__init__()
+        self.conv = nn.Sequential(
+            conv(n_in, n_out),
+            nn.ReLU(),
+            conv(n_out, n_out),
+            nn.ReLU(),
+            conv(n_out, n_out),
+        )
+        self.skip = (
+            nn.Conv2d(n_in, n_out, 1, bias=False) if n_in != n_out else nn.Identity()
+        )
+        self.fuse = nn.ReLU()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.fuse(self.conv(x) + self.skip(x))
+
+
+class TinyAutoencoder(nn.Module):
+    """
+    A tiny autoencoder in the style of [TAESD](https://github.com/madebyollin/taesd).
+    It approximates the encoder and decoder of the Stable Diffusion VAE with a few
+    plain convolutions, which makes decoding an order of magnitude cheaper at a small
+    cost in quality. Latents are in the same scaled space as the diffusion latents, so
+    no scaling factor is applied.
+
+    The module layout matches the original TAESD release, so its `taesd_encoder.pth`
+    and `taesd_decoder.pth` weights can be loaded with `from_pretrained`.
+
+    Parameters
+    ----------
+    latent_channels: int
+        Number of latent channels.
+    channels: int
+        Number of channels of the hidden layers.
+    num_scales: int
+        Number of times the encoder downsamples, and the decoder upsamples, by 2. It
+        must match the scale factor of the VAE being replaced, which is 8 for Stable
+        Diffusion.
+    blocks_per_scale: int
+        Number of residual blocks at every scale.
+    """
+
+    encoder_filename = "taesd_encoder"
+    decoder_filename = "taesd_decoder"
+
+    def __init__(
+        self,
+        latent_channels: int = 4,
+        channels: int = 64,
+        num_scales: int = 3,
+        blocks_per_scale: int = 3,
+    ) -> None:
+        super().__init__()
+        self.latent_channels = latent_channels
+        self.scale_factor = 2**num_scales
+
+        encoder = [conv(3, channels), Block(channels, channels)]
+        for _ in range(num_scales):
+            encoder.append(conv(channels, channels, stride=2, bias=False))
+            encoder.extend(Block(channels, channels) for _ in range(blocks_per_scale))
+        encoder.append(conv(channels, latent_channels))
+        self.encoder = nn.Sequential(*encoder)
+
+        decoder = [Clamp(), conv(latent_channels, channels), nn.ReLU()]
+        for _ in range(num_scales):
+            decoder.extend(Block(channels, channels) for _ in range(blocks_per_scale))
+            decoder.append(nn.Upsample(scale_factor=2))
+            decoder.append(conv(channels, channels, bias=False))
+        decoder.extend([Block(channels, channels), conv(channels, 3)])
+        self.decoder = nn.Sequential(*decoder)
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.parameters()).device
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return next(self.parameters()).dtype
+
+    def encode(self, image: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Encode images in the range [-1.0, 1.0] into scaled latents.
+
+        Parameters
+        ----------
+        image: torch.FloatTensor
+            Images of shape [batch_size, 3, height, width].
+
+        Returns
+        -------
+        torch.FloatTensor
+            Latents of shape [batch_size, latent_channels, height / scale_factor,
+            width / scale_factor].
+        """
+        # TAESD works with images in the range [0.0, 1.0]
+        return self.encoder(image.to(self.dtype) / 2 + 0.5)
+
+    def decode(self, latent: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Decode scaled latents into images in the range [-1.0, 1.0].
+
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Latents of shape [batch_size, latent_channels, height, width].
+
+        Returns
+        -------
+        torch.FloatTensor
+            Images of shape [batch_size, 3, height * scale_factor, width *
+            scale_factor].
+        """
+        image = self.decoder(latent.to(self.dtype)).clamp(0, 1)
+        return image * 2 - 1
+
+    def forward(self, image: torch.FloatTensor) -> torch.FloatTensor:
+        return self.decode(self.encode(image))
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        path: str,
+        torch_dtype: torch.dtype = torch.float32,
+        load_encoder: bool = True,
+        load_decoder: bool = True,
+        **kwargs,
+    ) -> "TinyAutoencoder":
+        """
+        Load a tiny autoencoder from a local directory containing `taesd_encoder` and
+        `taesd_decoder` weights, as `.safetensors` or `.pth` files.
+
+        Parameters
+        ----------
+        path: str
+            Directory to load the weights from.
+        torch_dtype: torch.dtype
+            Dtype to load the model in.
+        load_encoder: bool
+            Whether to load the encoder weights. If False, the encoder keeps its random
+            initialization, which is enough when the model is only used for decoding.
+        load_decoder: bool
+            Whether to load the decoder weights. If False, the decoder keeps its random
+            initialization.
+        kwargs
+            Arguments passed to the constructor, such as `latent_channels` and
+            `num_scales`.
+
+        Returns
+        -------
+        TinyAutoencoder
+            The loaded model.
+        """
+        if not os.path.isdir(path):
+            raise ValueError(f"`path` must be a directory, got {path}")
+        if not load_encoder and not load_decoder:
+            raise ValueError(
+                "At least one of `load_encoder` and `load_decoder` must be True"
+            )
+
+        model = cls(**kwargs)
+        for name, module, load in [
+            (cls.encoder_filename, model.encoder, load_encoder),
+            (cls.decoder_filename, model.decoder, load_decoder),
+        ]:
+            if not load:
+                continue
+            state_dict = cls._load_state_dict(path, name)
+            if state_dict is None:
+                raise FileNotFoundError(
+                    f"No `{name}.safetensors` or `{name}.pth` weights found in {path}"
+                )
+            module.load_state_dict(state_dict)
+
+        return model.to(dtype=torch_dtype).eval()
+
+    def save_pretrained(self, path: str) -> None:
+        """
+        Save the encoder and decoder weights to a local directory as `.safetensors`
+        files, which can be loaded with `from_pretrained`.
+
+        Parameters
+        ----------
+        path: str
+            Directory to save the weights in. It is created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, module in [
+            (self.encoder_filename, self.encoder),
+            (self.decoder_filename, self.decoder),
+        ]:
+            state_dict = {k: v.contiguous() for k, v in module.state_dict().items()}
+            save_file(state_dict, os.path.join(path, f"{name}.safetensors"))
+
+    @staticmethod
+    def _load_state_dict(path: str, name: str) -> Optional[Dict[str, torch.Tensor]]:
+        filename = os.path.join(path, f"{name}.safetensors")
+        if os.path.exists(filename):
+            return load_file(filename)
+        filename = os.path.join(path, f"{name}.pth")
+        if os.path.exists(filename):
+            return torch.load(filename, map_location="cpu")
+        return None
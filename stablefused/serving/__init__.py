@@ -0,0 +1,4 @@
+from .continuous_batcher import ContinuousBatcher
+from .micro_batcher import MicroBatcher
+from .output_utils import scatter_outputs
+from .staged_executor import StagedExecutor
@@ -0,0 +1,379 @@
+import numbers
+import threading
+import time
+import torch
+
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Deque, Dict, Generator, List, Optional, Tuple, Union
+
+from stablefused.diffusion import TextToImageDiffusion
+
+from .output_utils import scatter_outputs
+
+
+class _Sequence:
+    def __init__(
+        self,
+        prompt: List[str],
+        negative_prompt: Optional[List[str]],
+        latent: Optional[torch.FloatTensor],
+        latent_shape: Tuple[int, ...],
+        num_inference_steps: int,
+        guidance_scale: float,
+        guidance_rescale: float,
+        guidance_end: float,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]],
+        output_type: str,
+    ) -> None:
+        self.future = Future()
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.latent = latent
+        self.latent_shape = latent_shape
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        self.guidance_rescale = guidance_rescale
+        self.guidance_end = guidance_end
+        self.generator = generator
+        self.output_type = output_type
+        self.arrival = time.perf_counter()
+
+        # Set on admission to the running batch. The denoising loop of the sequence
+        # yields the arguments of its next UNet call, or finishes when it is done.
+        self.loop: Optional[Generator] = None
+        self.model_call: Optional[Tuple] = None
+        self.done = False
+
+
+class ContinuousBatcher:
+    """
+    Step-level continuous batching for concurrent text-to-image requests. Requests
+    join the running UNet batch at any step boundary and leave it as soon as their
+    last step is done, similar to continuous batching in LLM servers. Every request
+    keeps its own scheduler instance and denoising loop, the same loop as the
+    pipelines, and the UNet calls of all loops are evaluated as one batch with
+    per-sample timesteps. A 20-step request is not held up by a 50-step request
+    sharing the batch, and denoising hooks, buffer reuse, unconditional reuse and
+    autocast behave as in the pipelines.
+
+    Requests in the running batch must have the same resolution, since their latents
+    are stacked. They may differ in number of inference steps and guidance
+    parameters. Requests are admitted in submission order; a request with a
+    different resolution waits until the running batch drains, and blocks the
+    requests behind it so it cannot be starved.
+
+    Parameters
+    ----------
+    model: TextToImageDiffusion
+        The diffusion pipeline whose components are used. A fresh scheduler of the
+        same type and configuration as `model.scheduler` is created for every request.
+    max_batch_size: int
+        Maximum number of prompts in the running batch. With classifier-free
+        guidance, the UNet batch is up to twice as large.
+    """
+
+    def __init__(self, model: TextToImageDiffusion, max_batch_size: int = 8) -> None:
+        if max_batch_size < 1:
+            raise ValueError(
+                f"`max_batch_size` must be a positive integer, got {max_batch_size}"
+            )
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+
+        self._pending: Deque[_Sequence] = deque()
+        self._active: List[_Sequence] = []
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._stats = {
+            "requests": 0,
+            "steps": 0,
+            "samples": 0,
+            "unet_evaluations": 0,
+            "total_queue_delay": 0.0,
+            "max_queue_delay": 0.0,
+        }
+
+        self._thread = threading.Thread(
+            target=self._worker, name="stablefused-continuous-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt: Union[str, List[str]],
+        image_height: int = 512,
+        image_width: int = 512,
+        num_inference_steps: int = 50,
+        guidance_scale: float = 7.5,
+        guidance_rescale: float = 0.7,
+        negative_prompt: Optional[Union[str, List[str]]] = None,
+        latent: Optional[torch.FloatTensor] = None,
+        output_type: str = "pil",
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Future:
+        """
+        Submit a request. Arguments are the same as the `__call__` method of
+        `TextToImageDiffusion`, except for `return_latent_history`, which is not
+        supported, and `guidance_scale` and `guidance_rescale`, which must be scalars.
+        Invalid requests are rejected here, so they never fail the running batch.
+
+        Returns
+        -------
+        Future
+            A future resolved with the output of the request, as `__call__` would
+            return it, or with the exception raised while running it.
+        """
+        self.model.validate_input(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            image_height=image_height,
+            image_width=image_width,
+            guidance_end=guidance_end,
+        )
+        if output_type not in ["latent", "pt", "np", "pil"]:
+            raise ValueError(
+                "`output_type` must be one of [`latent`, `pt`, `np`, `pil`]"
+            )
+
+        if isinstance(prompt, str):
+            prompt = [prompt]
+        if isinstance(negative_prompt, str):
+            negative_prompt = [negative_prompt]
+        if len(prompt) > self.max_batch_size:
+            raise ValueError(
+                f"Number of prompts ({len(prompt)}) exceeds `max_batch_size` ({self.max_batch_size})"
+            )
+        for name, value in [
+            ("guidance_scale", guidance_scale),
+            ("guidance_rescale", guidance_rescale),
+        ]:
+            if not isinstance(value, numbers.Real):
+                raise ValueError(f"`{name}` must be a scalar, got {type(value)}")
+        if isinstance(generator, list) and len(generator) != len(prompt):
+            raise ValueError("Number of generators must match the number of prompts")
+
+        latent_shape = (
+            self.model.unet.config.in_channels,
+            image_height // self.model.vae_scale_factor,
+            image_width // self.model.vae_scale_factor,
+        )
+        if latent is not None and tuple(latent.shape) != (len(prompt), *latent_shape):
+            raise ValueError(
+                f"Shape of `latent` must be {(len(prompt), *latent_shape)}, got {tuple(latent.shape)}"
+            )
+        sequence = _Sequence(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            latent=latent,
+            latent_shape=latent_shape,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            guidance_end=guidance_end,
+            generator=generator,
+            output_type=output_type,
+        )
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit requests after shutdown")
+            self._pending.append(sequence)
+            self._condition.notify()
+        return sequence.future
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        Return batching statistics.
+
+        Returns
+        -------
+        Dict[str, float]
+            Number of requests admitted, batched steps run and UNet evaluations, the
+            mean number of prompts in the running batch per step, the batch fill rate
+            (mean number of prompts divided by `max_batch_size`), and the mean and
+            maximum queueing delay in seconds between submission and admission.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+        steps = max(stats["steps"], 1)
+        requests = max(stats["requests"], 1)
+        return {
+            "requests": stats["requests"],
+            "steps": stats["steps"],
+            "unet_evaluations": stats["unet_evaluations"],
+            "mean_batch_size": stats["samples"] / steps,
+            "batch_fill_rate": stats["samples"] / (steps * self.max_batch_size),
+            "mean_queue_delay": stats["total_queue_delay"] / requests,
+            "max_queue_delay": stats["max_queue_delay"],
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop accepting requests. Requests already submitted are completed.
+
+        Parameters
+        ----------
+        wait: bool
+            Whether to block until all submitted requests are completed.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify()
+        if wait:
+            self._thread.join()
+
+    def __enter__(self) -> "ContinuousBatcher":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown(wait=True)
+
+    def _worker(self) -> None:
+        # Gradient mode is thread local
+        with torch.no_grad():
+            while True:
+                admitted = self._admit()
+                if admitted is None:
+                    return
+
+                for sequence in admitted:
+                    try:
+                        self._prepare(sequence)
+                        self._active.append(sequence)
+                    except Exception as e:
+                        sequence.future.set_exception(e)
+
+                if not self._active:
+                    continue
+
+                try:
+                    self._step()
+                    self._retire()
+                except Exception as e:
+                    for sequence in self._active:
+                        sequence.future.set_exception(e)
+                    self._active.clear()
+
+    def _admit(self) -> Optional[List[_Sequence]]:
+        with self._condition:
+            while not self._active and not self._pending and not self._shutdown:
+                self._condition.wait()
+            if not self._active and not self._pending:
+                return None
+
+            # Admit waiting requests in order while they fit in the running batch
+            num_samples = sum(len(s.prompt) for s in self._active)
+            latent_shape = self._active[0].latent_shape if self._active else None
+            admitted = []
+            while self._pending:
+                sequence = self._pending[0]
+                if latent_shape is None:
+                    latent_shape = sequence.latent_shape
+                if (
+                    sequence.latent_shape != latent_shape
+                    or num_samples + len(sequence.prompt) > self.max_batch_size
+                ):
+                    break
+                self._pending.popleft()
+                admitted.append(sequence)
+                num_samples += len(sequence.prompt)
+
+            now = time.perf_counter()
+            for sequence in admitted:
+                delay = now - sequence.arrival
+                self._stats["total_queue_delay"] += delay
+                self._stats["max_queue_delay"] = max(
+                    self._stats["max_queue_delay"], delay
+                )
+            self._stats["requests"] += len(admitted)
+            return admitted
+
+    def _prepare(self, sequence: _Sequence) -> None:
+        model = self.model
+        embedding = model.prompt_to_embedding(
+            prompt=sequence.prompt, negative_prompt=sequence.negative_prompt
+        )
+
+        scheduler = type(model.scheduler).from_config(model.scheduler.config)
+        scheduler.set_timesteps(sequence.num_inference_steps)
+
+        latent = sequence.latent
+        if latent is None:
+            latent = model.random_tensor(
+                (len(sequence.prompt), *sequence.latent_shape), sequence.generator
+            )
+        latent = latent.to(model.device)
+
+        # Scale the latent noise by the standard deviation required by the scheduler
+        latent = latent * scheduler.init_noise_sigma
+
+        sequence.loop = model._denoise_loop(
+            latent=latent,
+            embedding=embedding,
+            timesteps=scheduler.timesteps,
+            guidance_scale=sequence.guidance_scale,
+            guidance_rescale=sequence.guidance_rescale,
+            guidance_end=sequence.guidance_end,
+            generator=sequence.generator,
+            scheduler=scheduler,
+            stats={},
+        )
+        sequence.model_call = next(sequence.loop)
+
+    def _step(self) -> None:
+        model = self.model
+
+        # Every sequence contributes the rows of its UNet call, with the current
+        # timestep of the sequence for each of them
+        calls = [sequence.model_call for sequence in self._active]
+        latent_model_input = torch.cat([call[0] for call in calls])
+        timesteps = torch.cat([call[1].expand(call[0].shape[0]) for call in calls])
+        embedding = torch.cat([call[2] for call in calls])
+
+        # Predict noise for the whole running batch with per-sample timesteps
+        noise_prediction = model._get_model_call()(
+            latent_model_input, timesteps.to(model.device), embedding
+        )
+
+        with self._condition:
+            self._stats["steps"] += 1
+            self._stats["samples"] += sum(len(s.prompt) for s in self._active)
+            self._stats["unet_evaluations"] += latent_model_input.shape[0]
+
+        # Every loop performs classifier free guidance and steps its scheduler, then
+        # prepares its next UNet call
+        start = 0
+        for sequence, call in zip(self._active, calls):
+            rows = call[0].shape[0]
+            noise = noise_prediction[start : start + rows]
+            start += rows
+            _, _, sequence.latent = sequence.loop.send(noise)
+            try:
+                sequence.model_call = next(sequence.loop)
+            except StopIteration:
+                sequence.done = True
+
+    def _retire(self) -> None:
+        finished = [sequence for sequence in self._active if sequence.done]
+        if not finished:
+            return
+        self._active = [sequence for sequence in self._active if not sequence.done]
+
+        # Decode the requests that finished at this step together. A decoding error
+        # fails only these requests, while the others keep denoising
+        try:
+            outputs = scatter_outputs(
+                model=self.model,
+                latent=torch.cat([sequence.latent for sequence in finished]),
+                batch_sizes=[len(sequence.prompt) for sequence in finished],
+                output_types=[sequence.output_type for sequence in finished],
+            )
+        except Exception as e:
+            for sequence in finished:
+                sequence.future.set_exception(e)
+            return
+        for sequence, output in zip(finished, outputs):
+            sequence.future.set_result(output)
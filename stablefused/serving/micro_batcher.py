@@ -0,0 +1,359 @@
+import numbers
+import threading
+import time
+import torch
+
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Deque, Dict, Hashable, List, Optional, Union
+
+from stablefused.diffusion import TextToImageDiffusion
+
+from .output_utils import scatter_outputs
+
+
+class _Request:
+    def __init__(
+        self,
+        prompt: List[str],
+        negative_prompt: Optional[List[str]],
+        latent: Optional[torch.FloatTensor],
+        guidance_scale: float,
+        guidance_rescale: float,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]],
+        output_type: str,
+        key: Hashable,
+        params: Dict[str, Any],
+    ) -> None:
+        self.future = Future()
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.latent = latent
+        self.guidance_scale = guidance_scale
+        self.guidance_rescale = guidance_rescale
+        self.generator = generator
+        self.output_type = output_type
+        self.key = key
+        self.params = params
+        self.arrival = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    A batching front end for concurrent text-to-image requests. Requests are collected
+    for a short time window, or until a batch is full, and requests that are
+    compatible are run together in a single `embedding_to_latent` call. The outputs are
+    scattered back to the future of every caller. This keeps the UNet busy with large
+    batches when many small requests arrive at the same time.
+
+    Requests are compatible when they have the same resolution, number of inference
+    steps, `guidance_end` and scheduler. Requests with different `guidance_scale`,
+    `guidance_rescale` and generators share a batch through per-sample guidance
+    parameters and generators. Prompts with and without negative prompts can share a
+    batch, since a missing negative prompt is encoded as the empty string. Batches
+    are formed from the oldest waiting request, so requests are never starved by a
+    stream of requests with a different configuration.
+
+    Parameters
+    ----------
+    model: TextToImageDiffusion
+        The diffusion pipeline to run requests with.
+    max_batch_size: int
+        Maximum number of prompts in a batch.
+    max_wait: float
+        Maximum time in seconds the oldest waiting request waits for the batch to
+        fill up before it is run.
+    """
+
+    def __init__(
+        self,
+        model: TextToImageDiffusion,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError(
+                f"`max_batch_size` must be a positive integer, got {max_batch_size}"
+            )
+        if max_wait < 0:
+            raise ValueError(f"`max_wait` must be non-negative, got {max_wait}")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._pending: Deque[_Request] = deque()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._stats = {
+            "requests": 0,
+            "samples": 0,
+            "batches": 0,
+            "total_queue_delay": 0.0,
+            "max_queue_delay": 0.0,
+        }
+
+        self._thread = threading.Thread(
+            target=self._worker, name="stablefused-micro-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt: Union[str, List[str]],
+        image_height: int = 512,
+        image_width: int = 512,
+        num_inference_steps: int = 50,
+        guidance_scale: float = 7.5,
+        guidance_rescale: float = 0.7,
+        negative_prompt: Optional[Union[str, List[str]]] = None,
+        latent: Optional[torch.FloatTensor] = None,
+        output_type: str = "pil",
+        guidance_end: float = 1.0,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+    ) -> Future:
+        """
+        Submit a request. Arguments are the same as the `__call__` method of
+        `TextToImageDiffusion`, except for `return_latent_history`, which is not
+        supported, and `guidance_scale` and `guidance_rescale`, which must be scalars.
+        Schedulers that add noise in every step are only seeded when every request
+        in the batch passes one generator per prompt.
+
+        Returns
+        -------
+        Future
+            A future resolved with the output of the request, as `__call__` would
+            return it, or with the exception raised while running it.
+        """
+        self.model.validate_input(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            image_height=image_height,
+            image_width=image_width,
+            guidance_end=guidance_end,
+        )
+        if output_type not in ["latent", "pt", "np", "pil"]:
+            raise ValueError(
+                "`output_type` must be one of [`latent`, `pt`, `np`, `pil`]"
+            )
+
+        if isinstance(prompt, str):
+            prompt = [prompt]
+        if isinstance(negative_prompt, str):
+            negative_prompt = [negative_prompt]
+        if len(prompt) > self.max_batch_size:
+            raise ValueError(
+                f"Number of prompts ({len(prompt)}) exceeds `max_batch_size` ({self.max_batch_size})"
+            )
+        for name, value in [
+            ("guidance_scale", guidance_scale),
+            ("guidance_rescale", guidance_rescale),
+        ]:
+            if not isinstance(value, numbers.Real):
+                raise ValueError(f"`{name}` must be a scalar, got {type(value)}")
+        if latent is not None and latent.shape[0] != len(prompt):
+            raise ValueError("Batch size of `latent` must match the number of prompts")
+        if isinstance(generator, list) and len(generator) != len(prompt):
+            raise ValueError("Number of generators must match the number of prompts")
+        if isinstance(generator, torch.Generator) and len(prompt) == 1:
+            generator = [generator]
+
+        params = dict(
+            image_height=image_height,
+            image_width=image_width,
+            num_inference_steps=num_inference_steps,
+            guidance_end=guidance_end,
+        )
+        key = (type(self.model.scheduler).__name__, *params.values())
+        request = _Request(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            latent=latent,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            generator=generator,
+            output_type=output_type,
+            key=key,
+            params=params,
+        )
+
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit requests after shutdown")
+            self._pending.append(request)
+            self._condition.notify()
+        return request.future
+
+    def metrics(self) -> Dict[str, float]:
+        """
+        Return batching statistics.
+
+        Returns
+        -------
+        Dict[str, float]
+            Number of requests, prompts and batches run, the mean batch size, the
+            batch fill rate (mean batch size divided by `max_batch_size`), and the mean
+            and maximum queueing delay in seconds between submission and the start of
+            the batch.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+        batches = max(stats["batches"], 1)
+        requests = max(stats["requests"], 1)
+        return {
+            "requests": stats["requests"],
+            "samples": stats["samples"],
+            "batches": stats["batches"],
+            "mean_batch_size": stats["samples"] / batches,
+            "batch_fill_rate": stats["samples"] / (batches * self.max_batch_size),
+            "mean_queue_delay": stats["total_queue_delay"] / requests,
+            "max_queue_delay": stats["max_queue_delay"],
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop accepting requests. Requests already submitted are completed.
+
+        Parameters
+        ----------
+        wait: bool
+            Whether to block until all submitted requests are completed.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify()
+        if wait:
+            self._thread.join()
+
+    def __enter__(self) -> "MicroBatcher":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown(wait=True)
+
+    def _num_samples(self, key: Hashable) -> int:
+        return sum(len(r.prompt) for r in self._pending if r.key == key)
+
+    def _next_batch(self) -> Optional[List[_Request]]:
+        with self._condition:
+            while not self._pending and not self._shutdown:
+                self._condition.wait()
+            if not self._pending:
+                return None
+
+            # Wait for the batch of the oldest request to fill up, at most until its
+            # deadline. Pending requests are flushed immediately on shutdown.
+            oldest = self._pending[0]
+            deadline = oldest.arrival + self.max_wait
+            while (
+                not self._shutdown
+                and self._num_samples(oldest.key) < self.max_batch_size
+            ):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch, num_samples = [], 0
+            for request in list(self._pending):
+                if request.key != oldest.key:
+                    continue
+                if num_samples + len(request.prompt) > self.max_batch_size:
+                    break
+                batch.append(request)
+                num_samples += len(request.prompt)
+            for request in batch:
+                self._pending.remove(request)
+
+            now = time.perf_counter()
+            for request in batch:
+                delay = now - request.arrival
+                self._stats["total_queue_delay"] += delay
+                self._stats["max_queue_delay"] = max(
+                    self._stats["max_queue_delay"], delay
+                )
+            self._stats["requests"] += len(batch)
+            self._stats["samples"] += num_samples
+            self._stats["batches"] += 1
+            return batch
+
+    def _worker(self) -> None:
+        # Gradient mode is thread local
+        with torch.no_grad():
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                try:
+                    self._run(batch)
+                except Exception as e:
+                    for request in batch:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+
+    def _run(self, batch: List[_Request]) -> None:
+        model = self.model
+        params = batch[0].params
+
+        prompt = [p for request in batch for p in request.prompt]
+        negative_prompt = None
+        if any(request.negative_prompt is not None for request in batch):
+            negative_prompt = [
+                p
+                for request in batch
+                for p in (request.negative_prompt or [""] * len(request.prompt))
+            ]
+        embedding = model.prompt_to_embedding(
+            prompt=prompt, negative_prompt=negative_prompt
+        )
+
+        # Every request draws its initial noise from its own generator, if it has one
+        latent = None
+        if any(r.latent is not None or r.generator is not None for r in batch):
+            shape = (
+                model.unet.config.in_channels,
+                params["image_height"] // model.vae_scale_factor,
+                params["image_width"] // model.vae_scale_factor,
+            )
+            latent = torch.cat(
+                [
+                    request.latent.to(model.device)
+                    if request.latent is not None
+                    else model.random_tensor(
+                        (len(request.prompt), *shape), request.generator
+                    )
+                    for request in batch
+                ]
+            )
+
+        # Guidance parameters and scheduler generators are passed per sample when the
+        # requests in the batch differ
+        guidance_scale, guidance_rescale = [
+            values[0] if len(set(values)) == 1 else values
+            for values in (
+                [r.guidance_scale for r in batch for _ in r.prompt],
+                [r.guidance_rescale for r in batch for _ in r.prompt],
+            )
+        ]
+        generator = None
+        if all(isinstance(r.generator, list) for r in batch):
+            generator = [g for r in batch for g in r.generator]
+
+        latent = model.embedding_to_latent(
+            embedding=embedding,
+            latent=latent,
+            guidance_scale=guidance_scale,
+            guidance_rescale=guidance_rescale,
+            generator=generator,
+            **params,
+        )
+
+        # Decode once for all requests that need images, and scatter the results
+        outputs = scatter_outputs(
+            model=model,
+            latent=latent,
+            batch_sizes=[len(request.prompt) for request in batch],
+            output_types=[request.output_type for request in batch],
+        )
+        for request, output in zip(batch, outputs):
+            request.future.set_result(output)
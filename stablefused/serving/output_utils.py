@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+from PIL import Image
+from typing import List, Sequence, Union
+
+from stablefused.diffusion import BaseDiffusion
+from stablefused.utils import numpy_to_pil, pt_to_numpy
+
+
+def scatter_outputs(
+    model: BaseDiffusion,
+    latent: torch.FloatTensor,
+    batch_sizes: Sequence[int],
+    output_types: Sequence[str],
+) -> List[Union[torch.Tensor, np.ndarray, List[Image.Image]]]:
+    """
+    Split the latents of a batch of requests into the outputs of every request. The
+    latents are decoded once for all requests that need images, and every output is
+    converted to the output type of its request.
+
+    Parameters
+    ----------
+    model: BaseDiffusion
+        The diffusion pipeline used to decode the latents.
+    latent: torch.FloatTensor
+        Latents of all requests concatenated along the batch dimension.
+    batch_sizes: Sequence[int]
+        Number of latents of every request.
+    output_types: Sequence[str]
+        Output type of every request. One of [`latent`, `pt`, `np`, `pil`].
+
+    Returns
+    -------
+    List[Union[torch.Tensor, np.ndarray, List[Image.Image]]]
+        The output of every request.
+    """
+    image = None
+    if any(output_type != "latent" for output_type in output_types):
+        image = model.resolve_output(
+            latent=latent, output_type="pt", return_latent_history=False
+        )
+
+    outputs = []
+    start = 0
+    for batch_size, output_type in zip(batch_sizes, output_types):
+        end = start + batch_size
+        if output_type == "latent":
+            output = latent[start:end]
+        elif output_type == "pt":
+            output = image[start:end]
+        else:
+            output = pt_to_numpy(image[start:end])
+            if output_type == "pil":
+                output = numpy_to_pil(output)
+        outputs.append(output)
+        start = end
+    return outputs
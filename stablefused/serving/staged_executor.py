@@ -0,0 +1,240 @@
+import inspect
+import queue
+import threading
+import time
+import torch
+
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from stablefused.diffusion import (
+    BaseDiffusion,
+    ImageToImageDiffusion,
+    LatentWalkDiffusion,
+    TextToImageDiffusion,
+)
+from stablefused.utils import numpy_to_pil
+
+
+_STOP = object()
+
+
+class _Job:
+    def __init__(self, future: Future, params: Dict[str, Any]) -> None:
+        self.future = future
+        self.params = params
+        self.output_type: str = params.pop("output_type")
+        self.return_latent_history: bool = params["return_latent_history"]
+        self.embedding: Optional[torch.FloatTensor] = None
+        self.result: Any = None
+
+
+class StagedExecutor:
+    """
+    Run generation jobs as a pipeline of concurrent stages connected by bounded
+    queues. Every stage runs in its own thread:
+
+    1. encode: validate the input and compute text embeddings, and encode the input
+       image for `ImageToImageDiffusion`
+    2. denoise: run the diffusion loop with `embedding_to_latent`
+    3. decode: decode latents with the VAE
+    4. postprocess: convert images to PIL and resolve the job's future
+
+    PyTorch releases the GIL inside its operators, so while the UNet works on one job
+    the text encoder can encode the prompts of the next job and the VAE can decode
+    the images of the previous job. This improves throughput of bulk jobs, while the
+    latency of a single job stays the same.
+
+    Jobs take the same keyword arguments as the `__call__` method of the model.
+    `TextToImageDiffusion`, `ImageToImageDiffusion` and `LatentWalkDiffusion` are
+    supported. Only the denoise stage uses the scheduler, so jobs are denoised one
+    at a time in submission order.
+
+    Parameters
+    ----------
+    model: BaseDiffusion
+        The diffusion pipeline to run jobs with.
+    max_queue_size: int
+        Maximum number of jobs waiting between two stages. `submit` blocks when the
+        first queue is full.
+    """
+
+    stages = ["encode", "denoise", "decode", "postprocess"]
+
+    def __init__(self, model: BaseDiffusion, max_queue_size: int = 2) -> None:
+        if not isinstance(
+            model, (TextToImageDiffusion, ImageToImageDiffusion, LatentWalkDiffusion)
+        ):
+            raise TypeError(
+                f"`model` of type {type(model).__name__} is not supported by StagedExecutor"
+            )
+        if max_queue_size < 1:
+            raise ValueError(
+                f"`max_queue_size` must be a positive integer, got {max_queue_size}"
+            )
+
+        self.model = model
+        self.stage_times: Dict[str, float] = {stage: 0.0 for stage in self.stages}
+        self._signature = inspect.signature(model.__call__)
+        self._validate_parameters = inspect.signature(model.validate_input).parameters
+        self._queues: List[queue.Queue] = [
+            queue.Queue(maxsize=max_queue_size) for _ in self.stages
+        ]
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._threads = []
+
+        handlers = [self._encode, self._denoise, self._decode, self._postprocess]
+        for i, (stage, handler) in enumerate(zip(self.stages, handlers)):
+            output = self._queues[i + 1] if i + 1 < len(self.stages) else None
+            thread = threading.Thread(
+                target=self._worker,
+                args=(stage, handler, self._queues[i], output),
+                name=f"stablefused-{stage}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, **kwargs: Any) -> Future:
+        """
+        Submit a job. Blocks while the encode stage has `max_queue_size` jobs waiting.
+
+        Parameters
+        ----------
+        kwargs
+            Keyword arguments of the `__call__` method of the model.
+
+        Returns
+        -------
+        Future
+            A future resolved with the output of the job, as `__call__` would return
+            it, or with the exception raised while running it.
+        """
+        # Bind eagerly so that invalid arguments are raised to the caller
+        arguments = self._signature.bind(**kwargs)
+        arguments.apply_defaults()
+
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit jobs after shutdown")
+            self._queues[0].put(_Job(future, dict(arguments.arguments)))
+        return future
+
+    def map(self, jobs: Iterable[Dict[str, Any]]) -> Iterator[Any]:
+        """
+        Run jobs and yield their outputs in order.
+
+        Parameters
+        ----------
+        jobs: Iterable[Dict[str, Any]]
+            Keyword arguments of the `__call__` method of the model for every job.
+
+        Yields
+        ------
+        Any
+            The output of every job.
+        """
+        futures = [self.submit(**job) for job in jobs]
+        for future in futures:
+            yield future.result()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop accepting jobs. Jobs already submitted are completed.
+
+        Parameters
+        ----------
+        wait: bool
+            Whether to block until all submitted jobs are completed.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            self._queues[0].put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self) -> "StagedExecutor":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.shutdown(wait=True)
+
+    def _worker(
+        self,
+        stage: str,
+        handler: Callable[[_Job], None],
+        input: queue.Queue,
+        output: Optional[queue.Queue],
+    ) -> None:
+        # Gradient mode is thread local, so every stage disables it for itself
+        with torch.no_grad():
+            while True:
+                job = input.get()
+                if job is _STOP:
+                    if output is not None:
+                        output.put(_STOP)
+                    return
+
+                # Jobs that failed in an earlier stage are passed through, so that
+                # the order of jobs is preserved
+                if not job.future.done():
+                    start = time.perf_counter()
+                    try:
+                        handler(job)
+                    except Exception as e:
+                        job.future.set_exception(e)
+                    self.stage_times[stage] += time.perf_counter() - start
+
+                if output is not None:
+                    output.put(job)
+
+    def _encode(self, job: _Job) -> None:
+        params = job.params
+        self.model.validate_input(
+            **{k: v for k, v in params.items() if k in self._validate_parameters}
+        )
+
+        job.embedding = self.model.prompt_to_embedding(
+            prompt=params.pop("prompt"),
+            negative_prompt=params.pop("negative_prompt"),
+        )
+
+        # The generator is used here first, then by the denoise stage, in the same
+        # order as `__call__` uses it
+        if isinstance(self.model, ImageToImageDiffusion):
+            params["latent"] = self.model.image_to_latent(
+                params.pop("image"), params["generator"]
+            )
+        elif isinstance(self.model, LatentWalkDiffusion):
+            params["latent"] = self.model.modify_latent(
+                params.pop("latent"), params.pop("strength"), params["generator"]
+            )
+
+    def _denoise(self, job: _Job) -> None:
+        job.result = self.model.embedding_to_latent(
+            embedding=job.embedding, **job.params
+        )
+        job.embedding = None
+
+    def _decode(self, job: _Job) -> None:
+        if job.output_type == "latent":
+            return
+        # Conversion to PIL images is left to the postprocess stage
+        job.result = self.model.resolve_output(
+            latent=job.result,
+            output_type="np" if job.output_type == "pil" else job.output_type,
+            return_latent_history=job.return_latent_history,
+        )
+
+    def _postprocess(self, job: _Job) -> None:
+        if job.output_type == "pil":
+            if job.return_latent_history:
+                job.result = [numpy_to_pil(images) for images in job.result]
+            else:
+                job.result = numpy_to_pil(job.result)
+        job.future.set_result(job.result)
@@ -1 +1,6 @@
-from .type_hints import UNet, Scheduler
+from stablefused.utils.lazy_import import attach as _attach
+
+
+__getattr__, __dir__, __all__ = _attach(
+    __name__, {".type_hints": ["UNet", "Scheduler"]}
+)
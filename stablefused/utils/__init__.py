@@ -1,18 +1,65 @@
-from .diffusion_utils import (
-    lerp,
-    slerp,
-)
-from .image_utils import (
-    denormalize,
-    image_grid,
-    normalize,
-    numpy_to_pil,
-    numpy_to_pt,
-    pil_to_numpy,
-    pil_to_video,
-    pt_to_numpy,
-)
-from .model_cache import (
-    save_model_to_cache,
-    load_model_from_cache,
+from .lazy_import import attach as _attach
+
+
+__getattr__, __dir__, __all__ = _attach(
+    __name__,
+    {
+        ".diffusion_utils": [
+            "lerp",
+            "slerp",
+        ],
+        ".embedding_cache": [
+            "EmbeddingCache",
+        ],
+        ".image_utils": [
+            "denormalize",
+            "image_grid",
+            "normalize",
+            "numpy_to_pil",
+            "numpy_to_pt",
+            "numpy_to_uint8",
+            "pil_to_numpy",
+            "pil_to_video",
+            "pt_to_numpy",
+        ],
+        ".latent_history": [
+            "LatentHistory",
+        ],
+        ".latent_preview": [
+            "LinearLatentDecoder",
+            "load_latent_decoder_from_cache",
+            "save_latent_decoder_to_cache",
+        ],
+        ".model_loader": [
+            "LAZY_COMPONENTS",
+            "PIPELINE_COMPONENTS",
+            "SNAPSHOT_FILENAME",
+            "LazyComponent",
+            "find_weights_file",
+            "is_snapshot",
+            "load_component",
+            "load_component_classes",
+            "load_component_config",
+            "load_safetensors_tensors",
+            "load_snapshot_component",
+            "load_snapshot_tensors",
+            "load_weights_component",
+            "run_parallel",
+            "save_snapshot",
+        ],
+        ".quantization": [
+            "QUANTIZATION_MODES",
+            "quantize_dynamic_int8",
+        ],
+        ".model_cache": [
+            "ModelCache",
+            "clear_model_cache",
+            "load_model_from_cache",
+            "model_cache_info",
+            "refresh_model_in_cache",
+            "replace_model_in_cache",
+            "resize_model_cache",
+            "save_model_to_cache",
+        ],
+    },
 )
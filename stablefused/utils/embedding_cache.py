@@ -0,0 +1,134 @@
+import threading
+import torch
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class EmbeddingCache:
+    """
+    A least-recently-used cache for text embeddings. It is a mapping from (model_id,
+    token ids, attention mask setting) to the embedding produced by the text encoder
+    for a single prompt. This allows us to skip the text encoder forward pass for
+    prompts that have already been encoded. A cache is shared by all diffusion
+    pipelines that share their components.
+
+    Parameters
+    ----------
+    max_entries: int
+        Maximum number of embeddings to keep in the cache.
+    max_bytes: int, optional
+        Maximum total size of cached embeddings in bytes. If None, only the number
+        of entries is bounded.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None) -> None:
+        self.cache: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(
+        model_id: str, input_ids: torch.Tensor, use_attention_mask: bool
+    ) -> Tuple[Any, ...]:
+        """
+        Build a cache key for a single tokenized prompt.
+
+        Parameters
+        ----------
+        model_id: str
+            The model id of the text encoder that produces the embedding.
+        input_ids: torch.Tensor
+            One dimensional tensor of token ids of the prompt.
+        use_attention_mask: bool
+            Whether the text encoder uses an attention mask.
+
+        Returns
+        -------
+        Tuple[Any, ...]
+            A hashable key identifying the embedding.
+        """
+        return (model_id, tuple(input_ids.tolist()), use_attention_mask)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self.cache:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+    def set(self, key: Hashable, embedding: torch.Tensor) -> None:
+        size = self._size_of(embedding)
+        with self._lock:
+            if key in self.cache:
+                self.size_bytes -= self._size_of(self.cache.pop(key))
+            if self.max_entries <= 0 or (
+                self.max_bytes is not None and size > self.max_bytes
+            ):
+                return
+            self.cache[key] = embedding
+            self.size_bytes += size
+            self._evict()
+
+    def resize(self, max_entries: int, max_bytes: Optional[int] = None) -> None:
+        """
+        Change the budget of the cache, evicting least recently used embeddings if
+        required.
+
+        Parameters
+        ----------
+        max_entries: int
+            Maximum number of embeddings to keep in the cache.
+        max_bytes: int, optional
+            Maximum total size of cached embeddings in bytes.
+        """
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self) -> None:
+        """Remove all embeddings from the cache. Statistics are preserved."""
+        with self._lock:
+            self.cache.clear()
+            self.size_bytes = 0
+
+    def info(self) -> Dict[str, int]:
+        """
+        Return cache statistics.
+
+        Returns
+        -------
+        Dict[str, int]
+            Number of hits, misses, cached entries and cached bytes.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.cache),
+                "bytes": self.size_bytes,
+            }
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.cache
+
+    def _evict(self) -> None:
+        while len(self.cache) > max(self.max_entries, 0) or (
+            self.max_bytes is not None and self.size_bytes > self.max_bytes
+        ):
+            _, embedding = self.cache.popitem(last=False)
+            self.size_bytes -= self._size_of(embedding)
+
+    @staticmethod
+    def _size_of(embedding: torch.Tensor) -> int:
+        return embedding.numel() * embedding.element_size()
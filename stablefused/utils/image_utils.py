@@ -1,4 +1,3 @@
-import imageio
 import numpy as np
 import torch
 
@@ -42,6 +41,23 @@ def numpy_to_pt(images: np.ndarray) -> torch.FloatTensor:
     return torch.from_numpy(images.transpose(0, 3, 1, 2))
 
 
+def numpy_to_uint8(images: np.ndarray) -> np.ndarray:
+    """
+    Convert numpy image in the range [0.0, 1.0] to uint8.
+
+    Parameters
+    ----------
+    images: np.ndarray
+        Image represented as a numpy array (N, H, W, C).
+
+    Returns
+    -------
+    np.ndarray
+        Image represented as a uint8 numpy array (N, H, W, C).
+    """
+    return (images * 255).round().astype("uint8")
+
+
 def numpy_to_pil(images: np.ndarray) -> Image.Image:
     """
     Convert numpy image to PIL image.
@@ -58,7 +74,7 @@ def numpy_to_pil(images: np.ndarray) -> Image.Image:
     """
     if images.ndim == 3:
         images = images[None, ...]
-    images = (images * 255).round().astype("uint8")
+    images = numpy_to_uint8(images)
     if images.shape[-1] == 1:
         pil_images = [Image.fromarray(image.squeeze(), mode="L") for image in images]
     else:
@@ -138,6 +154,9 @@ def pil_to_video(images: List[Image.Image], filename: str, fps: int = 60) -> Non
     fps: int
         Frames per second of video.
     """
+    # imageio is slow to import and only needed here
+    import imageio
+
     frames = [np.array(image) for image in images]
     with imageio.get_writer(filename, fps=fps) as video_writer:
         for frame in frames:
@@ -0,0 +1,125 @@
+import numpy as np
+import os
+import tempfile
+import torch
+import weakref
+
+from typing import Any, List, Optional, Tuple, Union
+
+
+class LatentHistory:
+    """
+    A preallocated store for the latents produced during the denoising loop. Latents
+    are written into a single buffer as they are produced, instead of being collected
+    in a list and stacked at the end, which briefly doubles memory usage. The buffer
+    can live on the compute device, in host memory as float16, or in a numpy memmap
+    on disk as float16. Only every `stride`-th latent is kept, along with the final
+    latent.
+
+    Indexing returns torch tensors on the compute device with the dtype of the model,
+    so a history can be decoded lazily, a few latents at a time.
+
+    Parameters
+    ----------
+    num_latents: int
+        Total number of latents that will be appended, including the initial latent.
+    latent_shape: Tuple[int, ...]
+        Shape of a single latent, including the batch dimension.
+    device: str
+        Compute device of the model. Indexing moves latents to this device.
+    dtype: torch.dtype
+        Dtype of the model. Indexing casts latents to this dtype.
+    storage: str
+        Where to keep the history. Must be one of [`device`, `host`, `memmap`].
+    stride: int
+        Keep only every `stride`-th latent. The final latent is always kept.
+    directory: str, optional
+        Directory to create the memmap file in. If None, the system temporary
+        directory is used. Only used when `storage` is `memmap`.
+    """
+
+    def __init__(
+        self,
+        num_latents: int,
+        latent_shape: Tuple[int, ...],
+        device: str,
+        dtype: torch.dtype,
+        storage: str = "device",
+        stride: int = 1,
+        directory: Optional[str] = None,
+    ) -> None:
+        if storage not in ["device", "host", "memmap"]:
+            raise ValueError(
+                f"`storage` must be one of ['device', 'host', 'memmap'], got {storage}"
+            )
+        if stride < 1:
+            raise ValueError(f"`stride` must be a positive integer, got {stride}")
+
+        self.device = device
+        self.dtype = dtype
+        self.storage = storage
+        self.steps: List[int] = list(range(0, num_latents, stride))
+        if self.steps[-1] != num_latents - 1:
+            self.steps.append(num_latents - 1)
+        self._slots = {step: slot for slot, step in enumerate(self.steps)}
+
+        shape = (len(self.steps), *latent_shape)
+        self.buffer: Union[torch.Tensor, np.ndarray]
+        self.filename: Optional[str] = None
+
+        if storage == "device":
+            self.buffer = torch.empty(shape, device=device, dtype=dtype)
+        elif storage == "host":
+            self.buffer = torch.empty(shape, dtype=torch.float16)
+        else:
+            fd, self.filename = tempfile.mkstemp(suffix=".latents", dir=directory)
+            os.close(fd)
+            self.buffer = np.memmap(
+                self.filename, dtype=np.float16, mode="w+", shape=shape
+            )
+            weakref.finalize(self, LatentHistory._remove_file, self.filename)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(self.buffer.shape)
+
+    def append(self, step: int, latent: torch.FloatTensor) -> None:
+        """
+        Write the latent produced at a step into the history. Latents for steps that
+        are skipped due to the stride are ignored.
+
+        Parameters
+        ----------
+        step: int
+            Index of the latent, where 0 is the initial latent.
+        latent: torch.FloatTensor
+            The latent to store.
+        """
+        if step not in self._slots:
+            return
+        slot = self._slots[step]
+        if self.storage == "memmap":
+            self.buffer[slot] = latent.detach().to(torch.float16).cpu().numpy()
+        else:
+            self.buffer[slot].copy_(latent.detach())
+
+    def to_tensor(self) -> torch.FloatTensor:
+        """Load the full history as a single tensor on the compute device."""
+        return self[:]
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def __getitem__(self, index: Any) -> torch.FloatTensor:
+        latent = self.buffer[index]
+        if isinstance(latent, np.ndarray):
+            latent = torch.from_numpy(np.ascontiguousarray(latent))
+        return latent.to(device=self.device, dtype=self.dtype)
+
+    @staticmethod
+    def _remove_file(filename: str) -> None:
+        # The file may still be mapped on platforms that do not allow removing it
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
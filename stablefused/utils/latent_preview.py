@@ -0,0 +1,145 @@
+import threading
+import torch
+import torch.nn.functional as F
+import weakref
+
+from diffusers import AutoencoderKL
+from typing import Optional
+
+from .image_utils import denormalize
+
+
+class LinearLatentDecoder:
+    """
+    A cheap approximation of the VAE decoder for previews. Every latent pixel is
+    projected to RGB with an affine map, and the result is upsampled to the image
+    resolution. The map is fitted with least squares against images decoded by the
+    real VAE, so it only needs to be calibrated once per VAE.
+
+    Parameters
+    ----------
+    weight: torch.FloatTensor
+        Projection from latent channels to RGB, of shape [latent_channels, 3].
+    bias: torch.FloatTensor
+        RGB bias of shape [3].
+    scale_factor: int
+        Upsampling factor from latent resolution to image resolution.
+    """
+
+    def __init__(
+        self, weight: torch.FloatTensor, bias: torch.FloatTensor, scale_factor: int
+    ) -> None:
+        self.weight = weight
+        self.bias = bias
+        self.scale_factor = scale_factor
+
+    @classmethod
+    @torch.no_grad()
+    def calibrate(
+        cls,
+        vae: AutoencoderKL,
+        scale_factor: int,
+        latent: Optional[torch.FloatTensor] = None,
+        num_samples: int = 4,
+        latent_size: int = 16,
+    ) -> "LinearLatentDecoder":
+        """
+        Fit the affine map against images decoded by the VAE.
+
+        Parameters
+        ----------
+        vae: AutoencoderKL
+            The VAE whose decoder is approximated.
+        scale_factor: int
+            Upsampling factor from latent resolution to image resolution.
+        latent: torch.FloatTensor, optional
+            Latents, scaled as in the diffusion loop, to calibrate on. If None, random
+            latents are used. Latents of real images give a better fit.
+        num_samples: int
+            Number of random latents to calibrate on when `latent` is None.
+        latent_size: int
+            Height and width of random latents used when `latent` is None.
+
+        Returns
+        -------
+        LinearLatentDecoder
+            The calibrated decoder.
+        """
+        device = next(vae.parameters()).device
+        dtype = next(vae.parameters()).dtype
+        if latent is None:
+            # A private generator keeps calibration deterministic without consuming
+            # the global random state used for generation
+            generator = torch.Generator().manual_seed(0)
+            latent = torch.randn(
+                (num_samples, vae.config.latent_channels, latent_size, latent_size),
+                generator=generator,
+            )
+        latent = latent.to(device=device, dtype=dtype)
+
+        image = vae.decode(latent / vae.config.scaling_factor, return_dict=False)[0]
+        image = denormalize(image)
+
+        # Average the decoded pixels covered by every latent pixel, and solve for the
+        # affine map from latent channels to RGB in float32
+        image = F.avg_pool2d(image.float(), scale_factor)
+        x = latent.float().permute(0, 2, 3, 1).reshape(-1, latent.shape[1])
+        x = torch.cat([x, torch.ones_like(x[:, :1])], dim=1)
+        y = image.permute(0, 2, 3, 1).reshape(-1, 3)
+        solution = torch.linalg.lstsq(x.cpu(), y.cpu()).solution
+
+        return cls(solution[:-1], solution[-1], scale_factor)
+
+    def __call__(self, latent: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Decode latents into approximate images.
+
+        Parameters
+        ----------
+        latent: torch.FloatTensor
+            Latents of shape [batch_size, latent_channels, height, width].
+
+        Returns
+        -------
+        torch.FloatTensor
+            Images of shape [batch_size, 3, height * scale_factor, width *
+            scale_factor] in the range [0.0, 1.0].
+        """
+        weight = self.weight.to(device=latent.device, dtype=latent.dtype)
+        bias = self.bias.to(device=latent.device, dtype=latent.dtype)
+        image = torch.einsum("bchw,cr->brhw", latent, weight)
+        image = image + bias[None, :, None, None]
+        image = F.interpolate(
+            image, scale_factor=self.scale_factor, mode="bilinear", align_corners=False
+        )
+        return image.clamp(0, 1)
+
+
+class LatentDecoderCache:
+    """
+    A cache of calibrated linear latent decoders. It is a mapping from the VAE a
+    decoder was calibrated against to `LinearLatentDecoder`, so that calibration runs
+    once per VAE, and pipelines sharing a VAE through the model cache share the
+    decoder. VAEs are held by weak reference, so entries go away with their VAE.
+    """
+
+    def __init__(self) -> None:
+        self.cache: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get(
+        self, vae: AutoencoderKL, default: Optional[LinearLatentDecoder] = None
+    ) -> Optional[LinearLatentDecoder]:
+        with self._lock:
+            return self.cache.get(vae, default)
+
+    def set(self, vae: AutoencoderKL, decoder: LinearLatentDecoder) -> None:
+        with self._lock:
+            self.cache[vae] = decoder
+
+
+_latent_decoder_cache = LatentDecoderCache()
+
+
+load_latent_decoder_from_cache = _latent_decoder_cache.get
+save_latent_decoder_to_cache = _latent_decoder_cache.set
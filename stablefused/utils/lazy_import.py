@@ -0,0 +1,46 @@
+import importlib
+import sys
+
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def attach(
+    package: str, import_structure: Dict[str, List[str]]
+) -> Tuple[Callable[[str], Any], Callable[[], List[str]], List[str]]:
+    """
+    Make the attributes of a package load their submodule on first access, following
+    PEP 562. This keeps `import stablefused` cheap, since heavy dependencies such as
+    diffusers and transformers are only imported by the submodules that need them.
+
+    Usage, in the `__init__.py` of a package:
+
+        __getattr__, __dir__, __all__ = attach(__name__, {".module": ["name"]})
+
+    Parameters
+    ----------
+    package: str
+        Name of the package, usually `__name__`.
+    import_structure: Dict[str, List[str]]
+        Mapping from submodule, relative to the package, to the names it provides.
+
+    Returns
+    -------
+    Tuple[Callable[[str], Any], Callable[[], List[str]], List[str]]
+        The module level `__getattr__` and `__dir__` functions, and `__all__`.
+    """
+    attributes = {
+        name: module for module, names in import_structure.items() for name in names
+    }
+
+    def __getattr__(name: str) -> Any:
+        if name not in attributes:
+            raise AttributeError(f"module {package!r} has no attribute {name!r}")
+        value = getattr(importlib.import_module(attributes[name], package), name)
+        # Cache the attribute, so that `__getattr__` is only called once per name
+        setattr(sys.modules[package], name, value)
+        return value
+
+    def __dir__() -> List[str]:
+        return sorted(set(vars(sys.modules[package])) | set(attributes))
+
+    return __getattr__, __dir__, sorted(attributes)
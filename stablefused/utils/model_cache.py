@@ -1,24 +1,283 @@
-from typing import Any, Dict
+import threading
+import torch
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
 
 
 class ModelCache:
     """
-    A cache for diffusion models. This class should not be instantiated by the user.
-    You should use the load_model function instead. It is a mapping from model_id to
-    diffusion model. This allows us to avoid loading the same model components multiple
-    times.
+    A least-recently-used cache for diffusion models. This class should not be
+    instantiated by the user. You should use the load_model_from_cache and
+    save_model_to_cache functions instead. It is a mapping from (model_id, dtype,
+    device, variant, quantization) to a diffusion model, whose component set (text
+    encoder, VAE, UNet, ...) is shared with every new pipeline created with the same
+    key. This allows us to avoid loading the same model components multiple times.
+
+    The size of a cached model is the total size of the parameters and buffers of its
+    components. When the cache exceeds its budget, least recently used models are
+    evicted as a whole. Eviction only drops the reference held by the cache, so the
+    memory is released once no pipeline uses the components anymore.
+
+    Parameters
+    ----------
+    max_bytes: int, optional
+        Maximum total size of cached models in bytes. If None, the cache is unbounded.
+    max_entries: int, optional
+        Maximum number of cached models. If None, only the size in bytes is bounded.
     """
 
-    def __init__(self) -> None:
-        self.cache = dict()
+    components = ["text_encoder", "vae", "unet", "fast_vae"]
+
+    def __init__(
+        self, max_bytes: Optional[int] = None, max_entries: Optional[int] = None
+    ) -> None:
+        self.cache: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.component_bytes: Dict[Hashable, Dict[str, int]] = dict()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def make_key(
+        model_id: str,
+        torch_dtype: torch.dtype = torch.float32,
+        device: Union[str, torch.device] = "cpu",
+        variant: Optional[str] = None,
+        quantization: Optional[str] = None,
+        component_dtypes: Optional[Dict[str, torch.dtype]] = None,
+    ) -> Tuple[Any, ...]:
+        """
+        Build a cache key for a model.
+
+        Parameters
+        ----------
+        model_id: str
+            The model id the components were loaded from.
+        torch_dtype: torch.dtype
+            The dtype of the components.
+        device: Union[str, torch.device]
+            The device of the components.
+        variant: str, optional
+            The variant of the weights, such as `fp16`.
+        quantization: str, optional
+            The quantization mode of the components, such as `dynamic_int8`.
+        component_dtypes: Dict[str, torch.dtype], optional
+            Dtypes of components that differ from `torch_dtype`, such as a bfloat16
+            UNet in a float32 model.
+
+        Returns
+        -------
+        Tuple[Any, ...]
+            A hashable key identifying the model.
+        """
+        return (
+            model_id,
+            str(torch_dtype),
+            str(torch.device(device)),
+            variant,
+            quantization,
+            tuple(
+                sorted(
+                    (name, str(dtype))
+                    for name, dtype in (component_dtypes or {}).items()
+                    if dtype != torch_dtype
+                )
+            ),
+        )
+
+    @classmethod
+    def key_of(cls, model: Any) -> Tuple[Any, ...]:
+        """Build the cache key of a diffusion model from its attributes."""
+        return cls.make_key(
+            model.model_id,
+            model.torch_dtype,
+            model.device,
+            getattr(model, "variant", None),
+            getattr(model, "quantization", None),
+            getattr(model, "component_dtypes", None),
+        )
+
+    @classmethod
+    def size_of(cls, model: Any) -> Dict[str, int]:
+        """
+        Compute the size of the parameters and buffers of every component of a model.
+
+        Parameters
+        ----------
+        model: Any
+            The diffusion model.
+
+        Returns
+        -------
+        Dict[str, int]
+            Mapping from component name to its size in bytes.
+        """
+        sizes = {}
+        for name in cls.components:
+            # Lazy components are only accounted for once they are loaded
+            is_loaded = getattr(model, "is_component_loaded", None)
+            if is_loaded is not None and not is_loaded(name):
+                continue
+            module = getattr(model, name, None)
+            if not isinstance(module, torch.nn.Module):
+                continue
+            tensors = list(module.parameters()) + list(module.buffers())
+            # Weights of quantized layers are packed, and not parameters or buffers
+            for submodule in module.modules():
+                if isinstance(submodule, torch.ao.nn.quantized.dynamic.Linear):
+                    tensors.extend(t for t in submodule._weight_bias() if t is not None)
+            sizes[name] = sum(t.numel() * t.element_size() for t in tensors)
+        return sizes
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self.cache:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+    def set(self, model: Any, key: Optional[Hashable] = None) -> None:
+        """
+        Cache a model. A model is cached under a single key, so caching it again after
+        moving it to another device replaces its previous entry.
+
+        Parameters
+        ----------
+        model: Any
+            The diffusion model.
+        key: Hashable, optional
+            The cache key. If None, it is built from the attributes of the model.
+        """
+        if key is None:
+            key = self.key_of(model)
+        sizes = self.size_of(model)
+        size = sum(sizes.values())
+
+        with self._lock:
+            for k in [k for k, m in self.cache.items() if m is model or k == key]:
+                self._remove(k)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            if self.max_entries is not None and self.max_entries <= 0:
+                return
+            self.cache[key] = model
+            self.component_bytes[key] = sizes
+            self.size_bytes += size
+            self._evict()
+
+    def refresh(self, model: Any) -> None:
+        """
+        Update the key and size of a model if it is cached. Cache statistics are not
+        affected.
+
+        Parameters
+        ----------
+        model: Any
+            The diffusion model.
+        """
+        with self._lock:
+            if any(m is model for m in self.cache.values()):
+                self.set(model)
+
+    def replace(self, model: Any, new_model: Any) -> None:
+        """
+        Cache another model in place of a model, under the same key, if it is cached.
+        This keeps an entry alive when the cached pipeline itself is about to change,
+        for example when it is quantized.
+
+        Parameters
+        ----------
+        model: Any
+            The cached diffusion model.
+        new_model: Any
+            The diffusion model to cache in its place. It must have the same key and
+            components.
+        """
+        with self._lock:
+            for key in [k for k, m in self.cache.items() if m is model]:
+                self.cache[key] = new_model
+
+    def remove(self, key: Hashable) -> None:
+        """Remove a model from the cache, if present. Statistics are preserved."""
+        with self._lock:
+            if key in self.cache:
+                self._remove(key)
+
+    def resize(
+        self, max_bytes: Optional[int] = None, max_entries: Optional[int] = None
+    ) -> None:
+        """
+        Change the budget of the cache, evicting least recently used models if
+        required.
+
+        Parameters
+        ----------
+        max_bytes: int, optional
+            Maximum total size of cached models in bytes. If None, the cache is
+            unbounded.
+        max_entries: int, optional
+            Maximum number of cached models.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_entries = max_entries
+            self._evict()
+
+    def clear(self) -> None:
+        """Remove all models from the cache. Statistics are preserved."""
+        with self._lock:
+            self.cache.clear()
+            self.component_bytes.clear()
+            self.size_bytes = 0
+
+    def keys(self) -> List[Hashable]:
+        """Return the keys of the cached models, from least to most recently used."""
+        with self._lock:
+            return list(self.cache.keys())
+
+    def info(self) -> Dict[str, Any]:
+        """
+        Return cache statistics.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Number of hits, misses, evictions, cached entries and cached bytes, and
+            the size in bytes of every component of every cached model.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.cache),
+                "bytes": self.size_bytes,
+                "components": {k: dict(v) for k, v in self.component_bytes.items()},
+            }
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.cache
 
-    def get(self, model_id: str, default: Any = None) -> Any:
-        if model_id not in self.cache.keys():
-            return default
-        return self.cache[model_id]
+    def _remove(self, key: Hashable) -> None:
+        self.cache.pop(key)
+        self.size_bytes -= sum(self.component_bytes.pop(key).values())
 
-    def set(self, model: Any) -> None:
-        self.cache[model.model_id] = model
+    def _evict(self) -> None:
+        while (
+            self.max_entries is not None and len(self.cache) > max(self.max_entries, 0)
+        ) or (self.max_bytes is not None and self.size_bytes > self.max_bytes):
+            self._remove(next(iter(self.cache)))
+            self.evictions += 1
 
 
 _model_cache = ModelCache()
@@ -26,3 +285,8 @@ _model_cache = ModelCache()
 
 load_model_from_cache = _model_cache.get
 save_model_to_cache = _model_cache.set
+refresh_model_in_cache = _model_cache.refresh
+replace_model_in_cache = _model_cache.replace
+resize_model_cache = _model_cache.resize
+clear_model_cache = _model_cache.clear
+model_cache_info = _model_cache.info
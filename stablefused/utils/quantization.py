@@ -0,0 +1,66 @@
+import copy
+import itertools
+import torch
+import torch.nn as nn
+
+from typing import List, Tuple
+
+
+QUANTIZATION_MODES = ["dynamic_int8"]
+
+
+def quantize_dynamic_int8(module: nn.Module) -> Tuple[nn.Module, List[str]]:
+    """
+    Quantize the linear layers of a module to int8 with dynamic quantization. Weights
+    are quantized ahead of time and activations are quantized on the fly, which speeds
+    up matrix multiplications on CPU. The module itself is not modified: a copy is
+    returned, which shares all other parameters and buffers with the module.
+
+    Parameters
+    ----------
+    module: nn.Module
+        The module to quantize. It must be on CPU in float32.
+
+    Returns
+    -------
+    Tuple[nn.Module, List[str]]
+        The quantized copy of the module, and the names of the converted layers.
+    """
+    # Copy the structure of the module without copying its weights
+    memo = {id(t): t for t in itertools.chain(module.parameters(), module.buffers())}
+    module = copy.deepcopy(module, memo)
+
+    names = []
+    for name, child in list(module.named_modules()):
+        if not isinstance(child, nn.Linear):
+            continue
+        if type(child) is not nn.Linear:
+            # Subclasses, such as `LoRACompatibleLinear` of diffusers, are only
+            # converted by `quantize_dynamic` when replaced by a plain linear layer
+            if getattr(child, "lora_layer", None) is not None:
+                continue
+            _set_submodule(module, name, _to_linear(child))
+        names.append(name)
+
+    module = torch.ao.quantization.quantize_dynamic(
+        module, {nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+    return module, names
+
+
+def _to_linear(module: nn.Linear) -> nn.Linear:
+    linear = nn.Linear(
+        module.in_features,
+        module.out_features,
+        bias=module.bias is not None,
+        device="meta",
+    )
+    linear.weight = module.weight
+    linear.bias = module.bias
+    return linear
+
+
+def _set_submodule(module: nn.Module, name: str, submodule: nn.Module) -> None:
+    parent_name, _, child_name = name.rpartition(".")
+    parent = module.get_submodule(parent_name) if parent_name else module
+    setattr(parent, child_name, submodule)
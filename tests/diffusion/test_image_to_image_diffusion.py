@@ -116,5 +116,42 @@ def test_no_classifier_free_guidance(
     assert images.shape == (1, dim, dim, 3)
 
 
+def test_guidance_end(model: ImageToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if `guidance_end` is a fraction of all inference steps, with the
+    steps skipped by `start_step` counted towards it.
+
+    Raises
+    ------
+    AssertionError
+        If the UNet is not called with the expected batch size at each step.
+    """
+    dim = config.get("image_dim")
+    image = model.random_tensor((1, 3, dim, dim))
+    batch_sizes = []
+
+    def model_call(call_model, latent_model_input, timestep, embedding):
+        batch_sizes.append(latent_model_input.shape[0])
+        return call_model(latent_model_input, timestep, embedding)
+
+    model.add_denoise_hook("model_call", model_call)
+    kwargs = dict(
+        image=image,
+        prompt=config.get("prompt"),
+        num_inference_steps=4,
+        guidance_end=0.5,
+        output_type="latent",
+    )
+
+    model(**kwargs, start_step=1)
+    assert batch_sizes == [2, 1, 1]
+
+    batch_sizes.clear()
+    model(**kwargs, start_step=2)
+    assert batch_sizes == [1, 1]
+
+    model.remove_denoise_hook("model_call", model_call)
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
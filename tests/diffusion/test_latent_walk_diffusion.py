@@ -98,6 +98,50 @@ def test_no_classifier_free_guidance(model: LatentWalkDiffusion, config: dict) -
     assert images.shape == (1, dim, dim, 3)
 
 
+def test_per_sample_generator(model: LatentWalkDiffusion, config: dict) -> None:
+    """
+    Test case to check if a sample generated with its own generator gives the same
+    result on its own as in a larger batch.
+
+    Raises
+    ------
+    AssertionError
+        If the sample differs from the matching sample of the batch.
+    """
+    dim = config.get("image_dim")
+    latent = model.image_to_latent(model.random_tensor((3, 3, dim, dim)))
+    kwargs = dict(
+        num_inference_steps=config.get("num_inference_steps"),
+        output_type="latent",
+    )
+
+    batch = model(
+        **kwargs,
+        prompt=[config.get("prompt")] * 3,
+        latent=latent,
+        generator=[torch.Generator().manual_seed(seed) for seed in range(3)],
+    )
+    single = model(
+        **kwargs,
+        prompt=[config.get("prompt")],
+        latent=latent[1:2],
+        generator=[torch.Generator().manual_seed(1)],
+    )
+    # Batched matrix multiplications may round differently than unbatched ones
+    torch.testing.assert_close(single[0], batch[1], rtol=1e-4, atol=1e-4)
+
+    # The modified latent itself does not depend on the batch
+    modified = model.modify_latent(
+        latent, 0.2, [torch.Generator().manual_seed(seed) for seed in range(3)]
+    )
+    torch.testing.assert_close(
+        model.modify_latent(latent[1:2], 0.2, [torch.Generator().manual_seed(1)]),
+        modified[1:2],
+        rtol=0,
+        atol=0,
+    )
+
+
 def test_interpolate(model: LatentWalkDiffusion, config_interpolate: dict) -> None:
     """
     Test case to check if the LatentWalkDiffusion is working correctly.
@@ -1,8 +1,18 @@
+import accelerate
+import copy
+import math
 import numpy as np
 import torch
 import pytest
 
-from stablefused import TextToImageDiffusion
+from stablefused import LatentWalkDiffusion, TextToImageDiffusion, TinyAutoencoder
+from stablefused.diffusion import base_diffusion
+from stablefused.utils import (
+    ModelCache,
+    clear_model_cache,
+    find_weights_file,
+    model_cache_info,
+)
 
 
 @pytest.fixture
@@ -87,6 +97,78 @@ def test_return_latent_history(model: TextToImageDiffusion, config: dict) -> Non
     assert images.shape == (1, config.get("num_inference_steps") + 1, 3, dim, dim)
 
 
+@pytest.mark.parametrize("storage", ["host", "memmap"])
+def test_latent_history_storage(
+    model: TextToImageDiffusion, config: dict, storage: str
+) -> None:
+    """
+    Test case to check if the latent history can be kept off the compute device with a
+    stride.
+
+    Raises
+    ------
+    AssertionError
+        If the generated image is not of type torch.Tensor.
+        If the generated image does not have the expected shape.
+    """
+    dim = config.get("image_dim")
+    model.set_latent_history_storage(storage=storage, stride=2)
+
+    images = model(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=3,
+        output_type="pt",
+        return_latent_history=True,
+    )
+    model.set_latent_history_storage()
+
+    # Latents of steps 0, 2 and the final step 3 are kept
+    assert type(images) is torch.Tensor
+    assert images.shape == (1, 3, 3, dim, dim)
+
+
+def test_batched_history_decoding(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if the latent history is decoded in micro-batches spanning
+    prompts and steps, in the expected order.
+
+    Raises
+    ------
+    AssertionError
+        If the decoded images do not have the expected shape.
+        If the images differ from images decoded one prompt at a time.
+    """
+    dim = config.get("image_dim")
+    num_inference_steps = 2
+
+    latent = model(
+        prompt=[config.get("prompt"), "a photo of a dog"],
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=num_inference_steps,
+        output_type="latent",
+        return_latent_history=True,
+    )
+
+    with torch.no_grad():
+        images = model.resolve_output(
+            latent, output_type="np", return_latent_history=True, decode_batch_size=4
+        )
+        pil_images = model.resolve_output(
+            latent, output_type="pil", return_latent_history=True, decode_batch_size=4
+        )
+        expected = model.latent_to_image(latent[:, 1], output_type="np")
+
+    assert images.shape == (2, num_inference_steps + 1, dim, dim, 3)
+    assert len(pil_images) == 2
+    assert len(pil_images[1]) == num_inference_steps + 1
+    # Convolutions may round differently depending on the batch size, so images
+    # decoded in micro-batches only match up to floating point tolerance
+    np.testing.assert_allclose(images[1], expected, rtol=1e-4, atol=1e-4)
+
+
 def test_no_classifier_free_guidance(model: TextToImageDiffusion, config: dict) -> None:
     """
     Test case to check if the TextToImageDiffusion is working correctly when classifier
@@ -113,5 +195,850 @@ def test_no_classifier_free_guidance(model: TextToImageDiffusion, config: dict)
     assert images.shape == (1, dim, dim, 3)
 
 
+def test_embedding_cache(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if prompt embeddings are reused from the embedding cache.
+
+    Raises
+    ------
+    AssertionError
+        If the cached embedding differs from the freshly computed embedding.
+        If the repeated prompt is not served from the cache.
+    """
+    model.embedding_cache.clear()
+
+    with torch.no_grad():
+        embedding = model.prompt_to_embedding(config.get("prompt"))
+        hits = model.embedding_cache.info()["hits"]
+        cached_embedding = model.prompt_to_embedding(config.get("prompt"))
+
+    assert model.embedding_cache.info()["hits"] == hits + 2
+    assert torch.equal(embedding, cached_embedding)
+
+
+def test_prompt_deduplication(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if duplicate prompts in a batch produce the same embeddings as
+    prompts encoded one at a time.
+
+    Raises
+    ------
+    AssertionError
+        If the embedding does not have the expected batch size.
+        If the embeddings of duplicate prompts differ.
+    """
+    prompt = config.get("prompt")
+    prompts = [prompt, "a photo of a dog", prompt]
+    model.embedding_cache.clear()
+
+    with torch.no_grad():
+        embedding = model.prompt_to_embedding(prompts)
+        single_embedding = model.prompt_to_embedding(prompt)
+
+    assert embedding.shape[0] == 2 * len(prompts)
+    torch.testing.assert_close(embedding[3], embedding[5])
+    torch.testing.assert_close(embedding[0], embedding[2])
+    torch.testing.assert_close(embedding[3], single_embedding[1])
+    torch.testing.assert_close(embedding[0], single_embedding[0])
+
+
+def test_chunked_text_encoding(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if encoding prompts in chunks matches a single text encoder pass.
+
+    Raises
+    ------
+    AssertionError
+        If the chunked embedding differs from the embedding computed in one pass.
+    """
+    prompts = [config.get("prompt"), "a photo of a dog", "a photo of a bird"]
+    negative_prompts = ["blurry", "", "low quality"]
+    model.disable_embedding_cache()
+
+    with torch.no_grad():
+        embedding = model.prompt_to_embedding(prompts, negative_prompts)
+        model.text_encoder_batch_size = 2
+        chunked_embedding = model.prompt_to_embedding(prompts, negative_prompts)
+
+    assert chunked_embedding.shape == embedding.shape
+    torch.testing.assert_close(chunked_embedding, embedding)
+
+
+def test_denoise_hooks(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if denoising loop hooks are called at every step.
+
+    Raises
+    ------
+    AssertionError
+        If a hook is not called once per denoising step.
+        If an unknown hook type is accepted.
+    """
+    dim = config.get("image_dim")
+    num_inference_steps = 2
+    calls = {"pre_step": [], "model_call": 0, "post_step": []}
+
+    def pre_step(pipeline, step, timestep, latent):
+        calls["pre_step"].append(step)
+
+    def model_call(call_model, latent_model_input, timestep, embedding):
+        calls["model_call"] += 1
+        return call_model(latent_model_input, timestep, embedding)
+
+    def post_step(pipeline, step, timestep, latent):
+        calls["post_step"].append(step)
+
+    model.add_denoise_hook("pre_step", pre_step)
+    model.add_denoise_hook("model_call", model_call)
+    model.add_denoise_hook("post_step", post_step)
+
+    images = model(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=num_inference_steps,
+        output_type="np",
+    )
+
+    model.remove_denoise_hook("pre_step", pre_step)
+    model.remove_denoise_hook("model_call", model_call)
+    model.remove_denoise_hook("post_step", post_step)
+
+    assert images.shape == (1, dim, dim, 3)
+    assert calls["pre_step"] == list(range(num_inference_steps))
+    assert calls["post_step"] == list(range(num_inference_steps))
+    assert calls["model_call"] == num_inference_steps
+
+    with pytest.raises(ValueError):
+        model.add_denoise_hook("unknown", pre_step)
+
+
+def test_buffer_reuse(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if reusing preallocated buffers in the denoising loop produces
+    the same latents as the default path.
+
+    Raises
+    ------
+    AssertionError
+        If the latents generated with buffer reuse differ from the default latents.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    latent = model.random_tensor(
+        (2, model.unet.config.in_channels, latent_dim, latent_dim)
+    )
+    kwargs = dict(
+        prompt=[config.get("prompt"), "a photo of a dog"],
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=2,
+        latent=latent,
+        output_type="latent",
+    )
+
+    expected = model(**kwargs)
+    model.enable_buffer_reuse()
+    result = model(**kwargs)
+    model.disable_buffer_reuse()
+
+    torch.testing.assert_close(result, expected)
+
+
+def test_guidance_end(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if the unconditional branch is skipped after `guidance_end` and
+    when guidance has no effect.
+
+    Raises
+    ------
+    AssertionError
+        If the UNet is not called with the expected batch size at each step.
+        If an invalid `guidance_end` is accepted.
+    """
+    dim = config.get("image_dim")
+    batch_sizes = []
+
+    def model_call(call_model, latent_model_input, timestep, embedding):
+        batch_sizes.append(latent_model_input.shape[0])
+        return call_model(latent_model_input, timestep, embedding)
+
+    model.add_denoise_hook("model_call", model_call)
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=4,
+        output_type="latent",
+    )
+
+    model(**kwargs, guidance_end=0.5)
+    assert batch_sizes == [2, 2, 1, 1]
+
+    batch_sizes.clear()
+    model(**kwargs, guidance_scale=1.0)
+    assert batch_sizes == [1, 1, 1, 1]
+
+    model.remove_denoise_hook("model_call", model_call)
+
+    with pytest.raises(ValueError):
+        model(**kwargs, guidance_end=1.5)
+
+
+def test_per_sample_guidance(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if per-sample guidance parameters and generators give every
+    sample the same result as generating it on its own.
+
+    Raises
+    ------
+    AssertionError
+        If per-sample classifier-free guidance differs from scalar guidance.
+        If per-sample generators do not reproduce the noise of a single sample.
+        If a batched call differs from separate calls.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    shape = (2, 4, latent_dim, latent_dim)
+    guidance_scale = [3.0, 9.0]
+    guidance_rescale = [0.0, 0.7]
+
+    noise_prediction = torch.randn((4, *shape[1:]))
+    per_sample = model.classifier_free_guidance(
+        noise_prediction.clone(), guidance_scale, guidance_rescale
+    )
+    for i in range(2):
+        expected = model.classifier_free_guidance(
+            noise_prediction[[i, i + 2]].clone(),
+            guidance_scale[i],
+            guidance_rescale[i],
+        )
+        assert torch.equal(per_sample[i : i + 1], expected)
+
+    generator = [torch.Generator().manual_seed(seed) for seed in [1, 2]]
+    noise = model.random_tensor(shape, generator)
+    for i, seed in enumerate([1, 2]):
+        expected = model.random_tensor(
+            (1, *shape[1:]), torch.Generator().manual_seed(seed)
+        )
+        assert torch.equal(noise[i : i + 1], expected)
+
+    kwargs = dict(
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=2,
+        output_type="latent",
+    )
+    prompts = [f"{config.get('prompt')} {i}" for i in range(2)]
+    latent = model(
+        prompt=prompts,
+        guidance_scale=guidance_scale,
+        guidance_rescale=torch.tensor(guidance_rescale),
+        generator=[torch.Generator().manual_seed(seed) for seed in [1, 2]],
+        **kwargs,
+    )
+    for i, seed in enumerate([1, 2]):
+        expected = model(
+            prompt=prompts[i],
+            guidance_scale=guidance_scale[i],
+            guidance_rescale=guidance_rescale[i],
+            generator=torch.Generator().manual_seed(seed),
+            **kwargs,
+        )
+        # Matrix multiplications may round differently depending on the batch size,
+        # so samples of a batch only match solo runs up to floating point tolerance
+        torch.testing.assert_close(latent[i : i + 1], expected, atol=1e-4, rtol=1e-4)
+
+    # With a batch of one, per-sample parameters take the same path as scalars and
+    # results are identical
+    latent = model(
+        prompt=prompts[:1],
+        guidance_scale=guidance_scale[:1],
+        guidance_rescale=torch.tensor(guidance_rescale[:1]),
+        generator=[torch.Generator().manual_seed(1)],
+        **kwargs,
+    )
+    expected = model(
+        prompt=prompts[0],
+        guidance_scale=guidance_scale[0],
+        guidance_rescale=guidance_rescale[0],
+        generator=torch.Generator().manual_seed(1),
+        **kwargs,
+    )
+    assert torch.equal(latent, expected)
+
+    with pytest.raises(ValueError):
+        model.random_tensor(shape, generator[:1])
+    with pytest.raises(ValueError):
+        model(prompt=prompts, guidance_scale=[1.0, 2.0, 3.0], **kwargs)
+
+
+def test_unconditional_reuse(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if the unconditional branch is only evaluated every few steps
+    when unconditional reuse is enabled.
+
+    Raises
+    ------
+    AssertionError
+        If the generated latent does not have the expected shape.
+        If the number of saved UNet evaluations is not reported correctly.
+    """
+    dim = config.get("image_dim")
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=4,
+        output_type="latent",
+    )
+
+    model(**kwargs)
+    assert model.denoise_stats == {"unet_evaluations": 8, "unet_evaluations_saved": 0}
+
+    for mode in ["reuse", "extrapolate"]:
+        model.enable_unconditional_reuse(interval=2, mode=mode)
+        latent = model(**kwargs)
+        assert latent.shape[0] == 1
+        assert model.denoise_stats == {
+            "unet_evaluations": 6,
+            "unet_evaluations_saved": 2,
+        }
+
+    model.disable_unconditional_reuse()
+
+    with pytest.raises(ValueError):
+        model.enable_unconditional_reuse(interval=0)
+
+
+def test_generate_stream(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if the streaming API yields one event per denoising step and
+    produces the same latent as the blocking API.
+
+    Raises
+    ------
+    AssertionError
+        If the number of events or their contents are not as expected.
+        If the final latent differs from the one returned by the blocking API.
+    """
+    dim = config.get("image_dim")
+    num_inference_steps = 3
+    latent = model.random_tensor(
+        (1, 4, dim // model.vae_scale_factor, dim // model.vae_scale_factor)
+    )
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=num_inference_steps,
+        latent=latent,
+    )
+
+    expected = model(**kwargs, output_type="latent")
+    events = list(model.generate_stream(**kwargs, preview_type="np"))
+
+    assert len(events) == num_inference_steps
+    assert [event.step for event in events] == list(range(num_inference_steps))
+    assert all(event.num_steps == num_inference_steps for event in events)
+    assert type(events[0].preview) is np.ndarray
+    assert events[0].preview.shape == (1, dim, dim, 3)
+    assert torch.allclose(events[-1].latent, expected)
+
+    events = list(
+        model.generate_stream(**kwargs, preview_type="pt", preview_interval=2)
+    )
+    assert [event.preview is None for event in events] == [True, False, False]
+
+    events = list(model.generate_stream(**kwargs))
+    assert all(event.preview is None for event in events)
+
+    with pytest.raises(ValueError):
+        next(model.generate_stream(**kwargs, preview_type="latent"))
+
+
+def test_linear_latent_decoder(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if the linear latent decoder produces previews of the same
+    shape as the VAE, and is calibrated once per VAE and shared between pipelines.
+
+    Raises
+    ------
+    AssertionError
+        If the previews do not have the expected type or shape.
+        If the calibrated decoder is not reused.
+        If a decoder calibrated against another VAE is used.
+    """
+    dim = config.get("image_dim")
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=2,
+    )
+
+    history = model(**kwargs, output_type="latent", return_latent_history=True)
+    images = model.resolve_output(history, "np", True)
+    previews = model.resolve_output(history, "np", True, decoder="linear")
+
+    assert type(previews) is np.ndarray
+    assert previews.shape == images.shape
+    assert previews.min() >= 0 and previews.max() <= 1
+
+    decoder = model.linear_latent_decoder
+    assert decoder is not None
+    assert decoder.weight.shape == (model.unet.config.in_channels, 3)
+
+    events = list(
+        model.generate_stream(**kwargs, preview_type="pil", preview_decoder="linear")
+    )
+    assert events[-1].preview[0].size == (dim, dim)
+    assert model.linear_latent_decoder is decoder
+
+    shared = TextToImageDiffusion(model_id=model.model_id, device="cpu")
+    shared.resolve_output(history, "pt", True, decoder="linear")
+    assert shared.linear_latent_decoder is decoder
+
+    # Pipelines without a model_id, or with a replaced VAE, calibrate against their VAE
+    vae = copy.deepcopy(model.vae)
+    with torch.no_grad():
+        vae.post_quant_conv.bias.add_(1.0)
+    explicit = TextToImageDiffusion(
+        tokenizer=model.tokenizer,
+        text_encoder=model.text_encoder,
+        vae=vae,
+        unet=model.unet,
+        scheduler=model.scheduler,
+        device="cpu",
+    )
+    explicit.resolve_output(history, "pt", True, decoder="linear")
+    assert explicit.linear_latent_decoder is not decoder
+    assert not torch.allclose(explicit.linear_latent_decoder.bias, decoder.bias)
+
+    shared.vae = vae
+    shared.resolve_output(history, "pt", True, decoder="linear")
+    assert shared.linear_latent_decoder is explicit.linear_latent_decoder
+    model.resolve_output(history, "pt", True, decoder="linear")
+    assert model.linear_latent_decoder is decoder
+
+    with pytest.raises(ValueError):
+        model.resolve_output(history, "np", True, decoder="taesd")
+
+
+def test_fast_vae(model: TextToImageDiffusion, config: dict, tmp_path) -> None:
+    """
+    Test case to check if a tiny autoencoder can be swapped in and out for decoding.
+
+    Raises
+    ------
+    AssertionError
+        If the decoded images do not have the expected type or shape.
+        If the tiny autoencoder is not used when fast VAE mode is enabled.
+    """
+    dim = config.get("image_dim")
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+    )
+    latent = model(**kwargs, output_type="latent")
+    expected = model.resolve_output(latent, "np", False)
+
+    with pytest.raises(ValueError):
+        model.enable_fast_vae()
+
+    fast_vae = TinyAutoencoder(
+        latent_channels=model.vae.config.latent_channels,
+        num_scales=int(math.log2(model.vae_scale_factor)),
+    )
+    fast_vae.save_pretrained(str(tmp_path))
+    model.set_fast_vae(str(tmp_path))
+
+    images = model.resolve_output(latent, "np", False)
+    assert type(images) is np.ndarray
+    assert images.shape == (1, dim, dim, 3)
+    assert not np.allclose(images, expected)
+
+    image_latent = model.image_to_latent(model.latent_to_image(latent, "pt"))
+    assert image_latent.shape == latent.shape
+
+    model.disable_fast_vae()
+    np.testing.assert_array_equal(model.resolve_output(latent, "np", False), expected)
+    assert model.resolve_output(latent, "np", False, decoder="tiny").shape == (
+        1,
+        dim,
+        dim,
+        3,
+    )
+
+    model.set_fast_vae(None)
+    assert model.fast_vae is None
+
+    with pytest.raises(ValueError):
+        model.set_fast_vae(TinyAutoencoder(num_scales=5))
+
+
+def test_cache_first_construction(
+    model: TextToImageDiffusion, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Test case to check if pipelines are created from cached components without
+    loading weights.
+
+    Raises
+    ------
+    AssertionError
+        If the weights are loaded again for a cached model.
+        If the components are not shared with the cached model.
+    """
+
+    def from_pretrained(*args, **kwargs):
+        raise AssertionError("Weights must not be loaded for a cached model")
+
+    monkeypatch.setattr(base_diffusion, "load_component", from_pretrained)
+    other = LatentWalkDiffusion(model_id=model.model_id, device=model.device)
+
+    assert other.unet is model.unet
+    assert other.vae is model.vae
+    assert other.text_encoder is model.text_encoder
+    assert other.vae_scale_factor == model.vae_scale_factor
+
+    with pytest.raises(AssertionError):
+        LatentWalkDiffusion(
+            model_id=model.model_id, device=model.device, torch_dtype=torch.float16
+        )
+
+
+def test_lazy_components(config: dict) -> None:
+    """
+    Test case to check if lazy components are only loaded on first use.
+
+    Raises
+    ------
+    AssertionError
+        If the VAE is loaded before it is used.
+        If the VAE is loaded more than once for pipelines sharing it.
+    """
+    dim = config.get("image_dim")
+    model = TextToImageDiffusion(
+        model_id="hf-internal-testing/tiny-stable-diffusion-pipe",
+        device="cpu",
+        use_cache=False,
+        lazy_components=["vae"],
+    )
+    other = LatentWalkDiffusion(model_id=model.model_id, device="cpu", use_cache=False)
+    other.share_components_with(model)
+
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+    )
+    latent = model(**kwargs, output_type="latent")
+    assert not model.is_component_loaded("vae")
+    assert model.vae_scale_factor == other.vae_scale_factor
+
+    images = model(**kwargs, output_type="np")
+    assert images.shape == (1, dim, dim, 3)
+    assert latent.shape[-1] == dim // model.vae_scale_factor
+    assert model.is_component_loaded("vae")
+    assert other.is_component_loaded("vae")
+    assert other.vae is model.vae
+
+    with pytest.raises(ValueError):
+        TextToImageDiffusion(
+            model_id=model.model_id,
+            device="cpu",
+            use_cache=False,
+            lazy_components=["tokenizer"],
+        )
+
+
+def test_snapshot(model: TextToImageDiffusion, config: dict, tmp_path) -> None:
+    """
+    Test case to check if a pipeline loaded from a snapshot matches the pipeline it
+    was saved from.
+
+    Raises
+    ------
+    AssertionError
+        If the snapshot does not restore all weights in the saved dtype.
+        If the generated images differ from the original pipeline.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    model.save_snapshot(str(tmp_path / "fp32"))
+    snapshot = TextToImageDiffusion.from_snapshot(
+        str(tmp_path / "fp32"), device="cpu", use_cache=False
+    )
+
+    for name in ["text_encoder", "vae", "unet"]:
+        expected = dict(getattr(model, name).state_dict())
+        for key, tensor in getattr(snapshot, name).state_dict().items():
+            assert torch.equal(tensor, expected[key])
+
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+        latent=model.random_tensor((1, 4, latent_dim, latent_dim)),
+        output_type="np",
+    )
+    np.testing.assert_array_equal(snapshot(**kwargs), model(**kwargs))
+
+    model.save_snapshot(str(tmp_path / "bf16"), torch_dtype=torch.bfloat16)
+    snapshot = TextToImageDiffusion.from_snapshot(
+        str(tmp_path / "bf16"), device="cpu", use_cache=False
+    )
+    assert snapshot.torch_dtype == torch.bfloat16
+    assert snapshot.unet.dtype == torch.bfloat16
+
+    with pytest.raises(ValueError):
+        TextToImageDiffusion.from_snapshot(str(tmp_path), device="cpu")
+
+
+def test_loader_arguments(model: TextToImageDiffusion) -> None:
+    """
+    Test case to check if pipeline arguments that do not apply to components are not
+    passed to their `from_pretrained` method, and unexpected positional arguments are
+    rejected.
+
+    Raises
+    ------
+    AssertionError
+        If pipeline arguments are passed to components.
+        If unexpected positional arguments are accepted.
+    """
+    pipeline = TextToImageDiffusion(
+        model_id=model.model_id,
+        device="cpu",
+        use_cache=False,
+        safety_checker=None,
+        requires_safety_checker=False,
+    )
+    assert not hasattr(pipeline.unet.config, "requires_safety_checker")
+
+    with pytest.raises(TypeError):
+        TextToImageDiffusion(
+            model.model_id, None, None, None, None, None, torch.float32, "cpu", False, 1
+        )
+
+
+def test_parallel_loading(model: TextToImageDiffusion) -> None:
+    """
+    Test case to check if components loaded concurrently match components loaded one
+    after another.
+
+    Raises
+    ------
+    AssertionError
+        If load timings are not reported for every component.
+        If the weights differ between parallel and sequential loading, or from
+        `from_pretrained`.
+        If the meta device initialization of accelerate is left patched.
+        If components are not loaded in the requested dtype, or the default dtype
+        is left changed.
+    """
+    init_empty_weights = accelerate.init_empty_weights
+    kwargs = dict(model_id=model.model_id, device="cpu", use_cache=False)
+    parallel = TextToImageDiffusion(**kwargs)
+    sequential = TextToImageDiffusion(**kwargs, num_load_workers=1)
+
+    assert set(parallel.load_timings.keys()) == {
+        "tokenizer",
+        "text_encoder",
+        "vae",
+        "unet",
+        "scheduler",
+        "total",
+    }
+    assert accelerate.init_empty_weights is init_empty_weights
+
+    for name in ["text_encoder", "vae", "unet"]:
+        expected = getattr(sequential, name).state_dict()
+        for key, tensor in getattr(parallel, name).state_dict().items():
+            assert torch.equal(tensor, expected[key])
+
+        # Weights are bound outside of the lock, and match `from_pretrained`
+        cls = type(getattr(parallel, name))
+        assert find_weights_file(model.model_id, name, cls) is not None
+        expected = cls.from_pretrained(model.model_id, subfolder=name).state_dict()
+        for key, tensor in getattr(parallel, name).state_dict().items():
+            assert torch.equal(tensor, expected[key])
+
+    half = TextToImageDiffusion(**kwargs, torch_dtype=torch.float16)
+    assert half.text_encoder.dtype == torch.float16
+    assert half.unet.dtype == torch.float16
+    assert torch.get_default_dtype() == torch.float32
+
+
+def test_quantize(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if dynamic int8 quantization converts the linear layers of the
+    UNet and text encoder, without affecting pipelines sharing the original
+    components.
+
+    Raises
+    ------
+    AssertionError
+        If the converted layers are not recorded or the VAE is quantized.
+        If the original pipeline is affected by quantization.
+        If quantized components are not shared through the model cache.
+        If invalid quantization settings are accepted.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    quantized = TextToImageDiffusion(model_id=model.model_id, device="cpu")
+    quantized.quantize("dynamic_int8")
+
+    assert quantized.quantization == "dynamic_int8"
+    assert set(quantized.quantized_modules.keys()) == {"unet", "text_encoder"}
+    quantized_unet_layers = [
+        name
+        for name, module in quantized.unet.named_modules()
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear)
+    ]
+    assert quantized_unet_layers == quantized.quantized_modules["unet"]
+    assert quantized.vae is model.vae
+    assert quantized.unet is not model.unet
+    assert not any(
+        isinstance(module, torch.ao.nn.quantized.dynamic.Linear)
+        for module in model.unet.modules()
+    )
+
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+        latent=model.random_tensor((1, 4, latent_dim, latent_dim)),
+        output_type="np",
+    )
+    images = quantized(**kwargs)
+    assert images.shape == (1, dim, dim, 3)
+    np.testing.assert_allclose(images, model(**kwargs), atol=0.1)
+
+    other = TextToImageDiffusion(model_id=model.model_id, device="cpu")
+    other.quantize()
+    assert other.unet is quantized.unet
+    assert other.text_encoder is quantized.text_encoder
+
+    with pytest.raises(ValueError):
+        quantized.quantize()
+    with pytest.raises(ValueError):
+        model.quantize("static_int4")
+
+
+def test_quantize_keeps_float_model_cached(model: TextToImageDiffusion) -> None:
+    """
+    Test case to check if quantizing the pipeline that is cached as the float
+    pipeline keeps the float pipeline in the model cache.
+
+    Raises
+    ------
+    AssertionError
+        If the float pipeline is evicted from the model cache by quantization.
+        If new float pipelines do not reuse the cached float components.
+    """
+    clear_model_cache()
+    cached = TextToImageDiffusion(model_id=model.model_id, device="cpu")
+    float_key = ModelCache.key_of(cached)
+    unet = cached.unet
+    cached.quantize()
+    quantized_key = ModelCache.key_of(cached)
+
+    assert quantized_key != float_key
+    assert set(model_cache_info()["components"].keys()) == {float_key, quantized_key}
+
+    other = TextToImageDiffusion(model_id=model.model_id, device="cpu")
+    assert other.quantization is None
+    assert other.unet is unet
+    assert other.load_timings == {}
+
+
+def test_component_dtypes(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if a per-component dtype policy loads a bfloat16 UNet and text
+    encoder next to a float32 VAE, and keeps latents and scheduler math in float32.
+
+    Raises
+    ------
+    AssertionError
+        If components are not loaded in their dtype.
+        If latents or images are not in float32, or differ too much from float32.
+        If pipelines with different dtype policies share components.
+        If invalid component names are accepted.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    mixed = TextToImageDiffusion(
+        model_id=model.model_id,
+        device="cpu",
+        component_dtypes={"unet": torch.bfloat16, "text_encoder": torch.bfloat16},
+    )
+
+    assert mixed.unet.dtype == torch.bfloat16
+    assert mixed.text_encoder.dtype == torch.bfloat16
+    assert mixed.vae.dtype == torch.float32
+    assert mixed.random_tensor((1, 4, latent_dim, latent_dim)).dtype == torch.float32
+    assert mixed.unet is not model.unet
+    assert mixed.vae is not model.vae
+
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+        latent=model.random_tensor((1, 4, latent_dim, latent_dim)),
+        output_type="pt",
+    )
+    images = mixed(**kwargs)
+    assert images.dtype == torch.float32
+    assert torch.isfinite(images).all()
+    torch.testing.assert_close(images, model(**kwargs), atol=0.1, rtol=0)
+
+    mixed.disable_autocast()
+    torch.testing.assert_close(mixed(**kwargs), images, atol=0.1, rtol=0)
+
+    with pytest.raises(ValueError):
+        TextToImageDiffusion(
+            model_id=model.model_id,
+            device="cpu",
+            component_dtypes={"scheduler": torch.float16},
+        )
+
+
+def test_component_dtypes_explicit_components(model: TextToImageDiffusion) -> None:
+    """
+    Test case to check if components passed explicitly are cast to the dtypes
+    requested for them, and others keep their dtype.
+
+    Raises
+    ------
+    AssertionError
+        If explicit components are not in their requested dtype.
+        If the autocast flag is not set from the constructor.
+    """
+    unet = copy.deepcopy(model.unet)
+    mixed = TextToImageDiffusion(
+        tokenizer=model.tokenizer,
+        text_encoder=model.text_encoder,
+        vae=model.vae,
+        unet=unet,
+        scheduler=model.scheduler,
+        device="cpu",
+        component_dtypes={"unet": torch.bfloat16},
+        use_autocast=False,
+    )
+    assert mixed.unet.dtype == torch.bfloat16
+    assert mixed.vae.dtype == torch.float32
+    assert mixed.text_encoder.dtype == torch.float32
+    assert model.unet.dtype == torch.float32
+    assert not mixed.use_autocast
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,106 @@
+import imageio
+import numpy as np
+import torch
+import pytest
+
+from stablefused import TextToVideoDiffusion
+
+
+@pytest.fixture
+def model():
+    """
+    Fixture to initialize the TextToVideoDiffusion model and set random seeds for reproducibility.
+
+    Returns
+    -------
+    TextToVideoDiffusion
+        The initialized TextToVideoDiffusion model.
+    """
+    seed = 1337
+    model_id = "hf-internal-testing/tiny-stable-diffusion-pipe"
+    device = "cpu"
+
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    model = TextToVideoDiffusion(model_id=model_id, device=device)
+    return model
+
+
+@pytest.fixture
+def config():
+    return {
+        "num_videos": 2,
+        "video_frames": 3,
+        "video_dim": 32,
+    }
+
+
+def random_video_latent(model: TextToVideoDiffusion, config: dict) -> torch.Tensor:
+    latent_dim = config.get("video_dim") // model.vae_scale_factor
+    return model.random_tensor(
+        (
+            config.get("num_videos"),
+            model.vae.config.latent_channels,
+            config.get("video_frames"),
+            latent_dim,
+            latent_dim,
+        )
+    )
+
+
+def test_resolve_output(model: TextToVideoDiffusion, config: dict) -> None:
+    """
+    Test case to check if video latents are decoded in frame micro-batches that span
+    video boundaries.
+
+    Raises
+    ------
+    AssertionError
+        If the decoded video does not have the expected shape.
+        If the frames differ from frames decoded one video at a time.
+    """
+    dim = config.get("video_dim")
+    latent = random_video_latent(model, config)
+
+    with torch.no_grad():
+        video = model.resolve_output(latent, output_type="np", decode_batch_size=2)
+        pil_video = model.resolve_output(latent, output_type="pil", decode_batch_size=2)
+        expected = model.latent_to_image(latent[1].permute(1, 0, 2, 3), "np")
+
+    assert video.shape == (2, config.get("video_frames"), dim, dim, 3)
+    assert len(pil_video) == 2
+    assert len(pil_video[1]) == config.get("video_frames")
+    np.testing.assert_allclose(video[1], expected, rtol=1e-4, atol=1e-4)
+
+
+def test_decode_video(model: TextToVideoDiffusion, config: dict, tmp_path) -> None:
+    """
+    Test case to check if video latents can be decoded to a uint8 array and written
+    straight to video files.
+
+    Raises
+    ------
+    AssertionError
+        If the decoded video is not a uint8 array of the expected shape.
+        If the written video does not contain the expected number of frames.
+    """
+    pytest.importorskip("imageio_ffmpeg")
+
+    dim = config.get("video_dim")
+    latent = random_video_latent(model, config)
+    filenames = [str(tmp_path / f"video_{i}.mp4") for i in range(2)]
+
+    with torch.no_grad():
+        video = model.decode_video(latent, decode_batch_size=2)
+        model.save_video(latent, filenames, fps=4, decode_batch_size=2)
+
+    assert video.dtype == np.uint8
+    assert video.shape == (2, config.get("video_frames"), dim, dim, 3)
+    for filename in filenames:
+        with imageio.get_reader(filename) as reader:
+            assert reader.count_frames() == config.get("video_frames")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from stablefused.models import TinyAutoencoder
+
+
+@pytest.mark.parametrize("num_scales", [1, 3])
+def test_tiny_autoencoder(num_scales):
+    model = TinyAutoencoder(channels=8, num_scales=num_scales, blocks_per_scale=1)
+    image = torch.rand(2, 3, 32, 32) * 2 - 1
+    dim = 32 // 2**num_scales
+
+    with torch.no_grad():
+        latent = model.encode(image)
+        decoded = model.decode(latent)
+
+    assert model.scale_factor == 2**num_scales
+    assert latent.shape == (2, 4, dim, dim)
+    assert decoded.shape == image.shape
+    assert decoded.min() >= -1 and decoded.max() <= 1
+
+
+def test_save_and_load(tmp_path):
+    model = TinyAutoencoder(channels=8, num_scales=1, blocks_per_scale=1)
+    model.save_pretrained(str(tmp_path))
+
+    loaded = TinyAutoencoder.from_pretrained(
+        str(tmp_path), channels=8, num_scales=1, blocks_per_scale=1
+    )
+    for expected, actual in zip(model.parameters(), loaded.parameters()):
+        torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+
+    # The original TAESD weights are distributed as separate .pth files
+    torch.save(model.decoder.state_dict(), str(tmp_path / "taesd_decoder.pth"))
+    (tmp_path / "taesd_encoder.safetensors").unlink()
+    (tmp_path / "taesd_decoder.safetensors").unlink()
+    loaded = TinyAutoencoder.from_pretrained(
+        str(tmp_path), load_encoder=False, channels=8, num_scales=1, blocks_per_scale=1
+    )
+    torch.testing.assert_close(
+        loaded.decoder[1].weight, model.decoder[1].weight, rtol=0, atol=0
+    )
+
+    # A requested half without weights is an error, rather than left random
+    with pytest.raises(FileNotFoundError):
+        TinyAutoencoder.from_pretrained(
+            str(tmp_path), channels=8, num_scales=1, blocks_per_scale=1
+        )
+    with pytest.raises(ValueError):
+        TinyAutoencoder.from_pretrained(
+            str(tmp_path), load_encoder=False, load_decoder=False
+        )
+    with pytest.raises(ValueError):
+        TinyAutoencoder.from_pretrained(str(tmp_path / "missing"))
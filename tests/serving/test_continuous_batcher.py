@@ -0,0 +1,249 @@
+import numpy as np
+import torch
+import pytest
+
+from stablefused import ContinuousBatcher, TextToImageDiffusion
+
+
+@pytest.fixture
+def model():
+    """
+    Fixture to initialize the TextToImageDiffusion model and set random seeds for reproducibility.
+
+    Returns
+    -------
+    TextToImageDiffusion
+        The initialized TextToImageDiffusion model.
+    """
+    seed = 1337
+    model_id = "hf-internal-testing/tiny-stable-diffusion-pipe"
+    device = "cpu"
+
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    model = TextToImageDiffusion(model_id=model_id, device=device)
+    return model
+
+
+@pytest.fixture
+def config():
+    return {
+        "prompt": "a photo of a cat",
+        "image_dim": 32,
+    }
+
+
+def test_continuous_batcher(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if requests with different step counts and guidance share the
+    running batch and produce the same outputs as calling the model directly.
+
+    Raises
+    ------
+    AssertionError
+        If the outputs do not match the outputs of the model.
+        If the requests do not share batched steps.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    requests = [
+        dict(num_inference_steps=2, output_type="np"),
+        dict(num_inference_steps=4, output_type="latent", guidance_end=0.5),
+        dict(num_inference_steps=3, output_type="pt", guidance_scale=1.0),
+    ]
+    for i, request in enumerate(requests):
+        request.update(
+            prompt=[f"{config.get('prompt')} {i}"] * 2,
+            image_height=dim,
+            image_width=dim,
+            latent=model.random_tensor((2, 4, latent_dim, latent_dim)),
+        )
+    expected = [model(**request) for request in requests]
+
+    batcher = ContinuousBatcher(model, max_batch_size=6)
+    # Hold the worker so that all requests are admitted at the same step boundary
+    with batcher._condition:
+        futures = [batcher.submit(**request) for request in requests]
+    outputs = [future.result() for future in futures]
+    batcher.shutdown()
+
+    # Batched matrix multiplications may round differently than unbatched ones
+    np.testing.assert_allclose(outputs[0], expected[0], rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(outputs[1], expected[1], rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(outputs[2], expected[2], rtol=1e-4, atol=1e-4)
+
+    metrics = batcher.metrics()
+    assert metrics["requests"] == 3
+    assert metrics["steps"] == 4
+    # 2 guided steps + 2 guided and 2 unguided steps + 3 unguided steps, 2 prompts each
+    assert metrics["unet_evaluations"] == 2 * (4 + 6 + 3)
+    assert metrics["mean_batch_size"] == 2 * (2 + 4 + 3) / 4
+
+    with pytest.raises(RuntimeError):
+        batcher.submit(**requests[0])
+
+
+def test_continuous_batcher_admission(
+    model: TextToImageDiffusion, config: dict
+) -> None:
+    """
+    Test case to check if requests join the running batch at step boundaries, and
+    requests with a different resolution wait for the running batch to drain.
+
+    Raises
+    ------
+    AssertionError
+        If the outputs do not have the expected shape.
+    """
+    dim = config.get("image_dim")
+    kwargs = dict(num_inference_steps=3, output_type="np")
+
+    with ContinuousBatcher(model, max_batch_size=2) as batcher:
+        futures = [
+            batcher.submit(
+                config.get("prompt"), image_height=dim, image_width=dim, **kwargs
+            ),
+            batcher.submit(
+                config.get("prompt"),
+                image_height=dim * 2,
+                image_width=dim * 2,
+                **kwargs,
+            ),
+            batcher.submit(
+                config.get("prompt"), image_height=dim, image_width=dim, **kwargs
+            ),
+        ]
+
+        with pytest.raises(ValueError):
+            batcher.submit(["a", "b", "c"])
+
+    assert futures[0].result().shape == (1, dim, dim, 3)
+    assert futures[1].result().shape == (1, dim * 2, dim * 2, 3)
+    assert futures[2].result().shape == (1, dim, dim, 3)
+    assert batcher.metrics()["requests"] == 3
+
+
+def test_continuous_batcher_uses_pipeline_features(
+    model: TextToImageDiffusion, config: dict
+) -> None:
+    """
+    Test case to check if the running batch goes through the denoising loop of the
+    pipeline, so that denoising hooks and unconditional reuse apply to it.
+
+    Raises
+    ------
+    AssertionError
+        If hooks are not called or unconditional reuse is not applied.
+        If the output does not match the output of the model with the same settings.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    request = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=4,
+        output_type="latent",
+        latent=model.random_tensor((1, 4, latent_dim, latent_dim)),
+    )
+
+    calls, steps = [], []
+
+    def model_call_hook(call_model, latent_model_input, timestep, embedding):
+        calls.append(latent_model_input.shape[0])
+        return call_model(latent_model_input, timestep, embedding)
+
+    def post_step_hook(pipeline, step, timestep, latent):
+        steps.append(step)
+
+    model.add_denoise_hook("model_call", model_call_hook)
+    model.add_denoise_hook("post_step", post_step_hook)
+    model.enable_unconditional_reuse(interval=2)
+    expected = model(**request)
+    calls.clear()
+    steps.clear()
+
+    with ContinuousBatcher(model) as batcher:
+        output = batcher.submit(**request).result()
+
+    # The unconditional branch is evaluated at steps 0 and 2 only
+    assert calls == [2, 1, 2, 1]
+    assert steps == [0, 1, 2, 3]
+    assert batcher.metrics()["unet_evaluations"] == 6
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_continuous_batcher_rejects_invalid_requests(
+    model: TextToImageDiffusion, config: dict
+) -> None:
+    """
+    Test case to check if invalid requests are rejected on submission, without
+    failing the requests in the running batch.
+
+    Raises
+    ------
+    AssertionError
+        If an invalid request is accepted or a valid request fails.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    kwargs = dict(image_height=dim, image_width=dim, num_inference_steps=2)
+
+    with ContinuousBatcher(model) as batcher:
+        future = batcher.submit(config.get("prompt"), output_type="np", **kwargs)
+        with pytest.raises(ValueError):
+            batcher.submit(config.get("prompt"), guidance_scale=[7.5], **kwargs)
+        with pytest.raises(ValueError):
+            batcher.submit(
+                config.get("prompt"), guidance_rescale=torch.tensor([0.7]), **kwargs
+            )
+        with pytest.raises(ValueError):
+            batcher.submit(
+                config.get("prompt"),
+                latent=model.random_tensor((1, 4, latent_dim, latent_dim + 1)),
+                **kwargs,
+            )
+
+    assert future.result().shape == (1, dim, dim, 3)
+
+
+def test_continuous_batcher_decode_error(
+    model: TextToImageDiffusion, config: dict
+) -> None:
+    """
+    Test case to check if a request whose decoding fails gets the error, while a
+    request still denoising in the same running batch completes.
+
+    Raises
+    ------
+    AssertionError
+        If the failed request does not raise the decoding error.
+        If the concurrent request does not complete.
+    """
+    dim = config.get("image_dim")
+    kwargs = dict(image_height=dim, image_width=dim, output_type="np")
+    resolve_output = model.resolve_output
+    num_calls = []
+
+    def failing_resolve_output(*args, **kwargs):
+        num_calls.append(1)
+        if len(num_calls) == 1:
+            raise RuntimeError("decoding failed")
+        return resolve_output(*args, **kwargs)
+
+    model.resolve_output = failing_resolve_output
+    batcher = ContinuousBatcher(model)
+    # Hold the worker so that both requests are admitted at the same step boundary
+    with batcher._condition:
+        failed = batcher.submit(config.get("prompt"), num_inference_steps=2, **kwargs)
+        running = batcher.submit(config.get("prompt"), num_inference_steps=4, **kwargs)
+
+    with pytest.raises(RuntimeError, match="decoding failed"):
+        failed.result(timeout=60)
+    assert running.result(timeout=60).shape == (1, dim, dim, 3)
+    batcher.shutdown()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
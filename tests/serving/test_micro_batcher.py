@@ -0,0 +1,184 @@
+import numpy as np
+import torch
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from stablefused import MicroBatcher, TextToImageDiffusion
+
+
+@pytest.fixture
+def model():
+    """
+    Fixture to initialize the TextToImageDiffusion model and set random seeds for reproducibility.
+
+    Returns
+    -------
+    TextToImageDiffusion
+        The initialized TextToImageDiffusion model.
+    """
+    seed = 1337
+    model_id = "hf-internal-testing/tiny-stable-diffusion-pipe"
+    device = "cpu"
+
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    model = TextToImageDiffusion(model_id=model_id, device=device)
+    return model
+
+
+@pytest.fixture
+def config():
+    return {
+        "prompt": "a photo of a cat",
+        "num_inference_steps": 2,
+        "image_dim": 32,
+    }
+
+
+def test_micro_batcher(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if concurrent requests are grouped into batches and produce
+    the same outputs as calling the model directly.
+
+    Raises
+    ------
+    AssertionError
+        If the outputs do not have the expected type, shape or values.
+        If the requests are not batched as expected.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    kwargs = dict(
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+    )
+    prompts = [f"{config.get('prompt')} {i}" for i in range(4)]
+    latents = [model.random_tensor((1, 4, latent_dim, latent_dim)) for _ in prompts]
+    expected = [
+        model(prompt=p, latent=l, output_type="np", **kwargs)
+        for p, l in zip(prompts, latents)
+    ]
+
+    with MicroBatcher(model, max_batch_size=4, max_wait=10) as batcher:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futures = list(
+                pool.map(
+                    lambda i: batcher.submit(
+                        prompt=prompts[i],
+                        latent=latents[i],
+                        output_type=["np", "pil", "pt", "latent"][i],
+                        **kwargs,
+                    ),
+                    range(4),
+                )
+            )
+        outputs = [future.result() for future in futures]
+
+        # A request with a different resolution does not join the batch. It is run
+        # without waiting for the time window on shutdown.
+        other = batcher.submit(
+            prompt=prompts[0],
+            image_height=dim * 2,
+            image_width=dim * 2,
+            num_inference_steps=config.get("num_inference_steps"),
+            output_type="np",
+        )
+
+    assert other.result().shape == (1, dim * 2, dim * 2, 3)
+    np.testing.assert_allclose(outputs[0], expected[0], atol=1e-5)
+    assert isinstance(outputs[1][0], Image.Image)
+    assert outputs[2].shape == (1, 3, dim, dim)
+    assert outputs[3].shape == (1, 4, latent_dim, latent_dim)
+
+    metrics = batcher.metrics()
+    assert metrics["requests"] == 5
+    assert metrics["batches"] == 2
+    assert metrics["batch_fill_rate"] == 5 / 8
+    assert metrics["max_queue_delay"] >= metrics["mean_queue_delay"] > 0
+
+    with pytest.raises(RuntimeError):
+        batcher.submit(prompt=prompts[0], **kwargs)
+
+
+def test_micro_batcher_per_sample_guidance(
+    model: TextToImageDiffusion, config: dict
+) -> None:
+    """
+    Test case to check if requests with different guidance parameters and generators
+    share a batch and match calling the model directly.
+
+    Raises
+    ------
+    AssertionError
+        If the requests are not run in a single batch.
+        If the outputs differ from calling the model directly.
+    """
+    dim = config.get("image_dim")
+    kwargs = dict(
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+        output_type="latent",
+    )
+    requests = [
+        dict(prompt=f"{config.get('prompt')} {i}", guidance_scale=scale, seed=i)
+        for i, scale in enumerate([3.0, 7.5, 12.0])
+    ]
+    expected = [
+        model(
+            prompt=r["prompt"],
+            guidance_scale=r["guidance_scale"],
+            generator=torch.Generator().manual_seed(r["seed"]),
+            **kwargs,
+        )
+        for r in requests
+    ]
+
+    with MicroBatcher(model, max_batch_size=3, max_wait=10) as batcher:
+        futures = [
+            batcher.submit(
+                prompt=r["prompt"],
+                guidance_scale=r["guidance_scale"],
+                generator=torch.Generator().manual_seed(r["seed"]),
+                **kwargs,
+            )
+            for r in requests
+        ]
+        outputs = [future.result() for future in futures]
+
+    assert batcher.metrics()["batches"] == 1
+    for output, latent in zip(outputs, expected):
+        torch.testing.assert_close(output, latent, atol=1e-4, rtol=1e-4)
+
+
+def test_micro_batcher_validation(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if invalid requests are rejected at submission.
+
+    Raises
+    ------
+    AssertionError
+        If invalid requests are not rejected.
+    """
+    with MicroBatcher(model, max_batch_size=2) as batcher:
+        with pytest.raises(ValueError):
+            batcher.submit(prompt=["a", "b", "c"])
+        with pytest.raises(ValueError):
+            batcher.submit(prompt="a", image_height=33)
+        with pytest.raises(ValueError):
+            batcher.submit(prompt="a", output_type="jpeg")
+        with pytest.raises(ValueError):
+            batcher.submit(prompt="a", guidance_scale=[7.5])
+        with pytest.raises(ValueError):
+            batcher.submit(prompt="a", guidance_rescale=torch.tensor([0.7]))
+
+    with pytest.raises(ValueError):
+        MicroBatcher(model, max_batch_size=0)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,167 @@
+import numpy as np
+import torch
+import pytest
+
+from PIL import Image
+
+from stablefused import (
+    ImageToImageDiffusion,
+    LatentWalkDiffusion,
+    StagedExecutor,
+    TextToImageDiffusion,
+)
+
+
+@pytest.fixture
+def model():
+    """
+    Fixture to initialize the TextToImageDiffusion model and set random seeds for reproducibility.
+
+    Returns
+    -------
+    TextToImageDiffusion
+        The initialized TextToImageDiffusion model.
+    """
+    seed = 1337
+    model_id = "hf-internal-testing/tiny-stable-diffusion-pipe"
+    device = "cpu"
+
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+    model = TextToImageDiffusion(model_id=model_id, device=device)
+    return model
+
+
+@pytest.fixture
+def config():
+    return {
+        "prompt": "a photo of a cat",
+        "num_inference_steps": 2,
+        "image_dim": 32,
+    }
+
+
+def test_staged_executor(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if jobs run through the staged executor produce the same
+    outputs as calling the model directly.
+
+    Raises
+    ------
+    AssertionError
+        If the outputs do not have the expected type, shape or values.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    jobs = [
+        dict(
+            prompt=[config.get("prompt")] * 2,
+            image_height=dim,
+            image_width=dim,
+            num_inference_steps=config.get("num_inference_steps"),
+            latent=model.random_tensor((2, 4, latent_dim, latent_dim)),
+            output_type=output_type,
+        )
+        for output_type in ["np", "pil", "pt", "latent"]
+    ]
+    expected = [model(**job) for job in jobs]
+
+    with StagedExecutor(model, max_queue_size=1) as executor:
+        outputs = list(executor.map(jobs))
+        history = executor.submit(**jobs[1], return_latent_history=True).result()
+
+    assert type(outputs[1]) is list and isinstance(outputs[1][0], Image.Image)
+    assert (
+        len(history) == 2 and len(history[0]) == config.get("num_inference_steps") + 1
+    )
+    np.testing.assert_allclose(outputs[0], expected[0], atol=1e-6)
+    np.testing.assert_allclose(
+        np.array(outputs[1][0]), np.array(expected[1][0]), atol=1
+    )
+    torch.testing.assert_close(outputs[2], expected[2])
+    torch.testing.assert_close(outputs[3], expected[3])
+    assert all(value > 0 for value in executor.stage_times.values())
+
+    with pytest.raises(RuntimeError):
+        executor.submit(**jobs[0])
+
+
+def test_staged_executor_errors(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if a failing job does not affect the jobs around it.
+
+    Raises
+    ------
+    AssertionError
+        If the error is not raised by the future of the failing job.
+        If the other jobs do not complete.
+    """
+    dim = config.get("image_dim")
+    job = dict(
+        prompt=config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+        output_type="np",
+    )
+
+    with StagedExecutor(model) as executor:
+        futures = [
+            executor.submit(**job),
+            executor.submit(**job, guidance_end=2.0),
+            executor.submit(**job),
+        ]
+
+        with pytest.raises(ValueError):
+            futures[1].result()
+        assert futures[0].result().shape == (1, dim, dim, 3)
+        assert futures[2].result().shape == (1, dim, dim, 3)
+
+        with pytest.raises(TypeError):
+            executor.submit(**job, unknown_argument=True)
+
+
+def test_staged_executor_generator(model: TextToImageDiffusion, config: dict) -> None:
+    """
+    Test case to check if image-to-image and latent walk jobs seeded with a generator
+    produce the same outputs as calling the model directly with the same seed.
+
+    Raises
+    ------
+    AssertionError
+        If the outputs of seeded jobs do not match the outputs of the model.
+    """
+    dim = config.get("image_dim")
+    latent_dim = dim // model.vae_scale_factor
+    image = model(
+        config.get("prompt"),
+        image_height=dim,
+        image_width=dim,
+        num_inference_steps=config.get("num_inference_steps"),
+        output_type="pil",
+    )[0]
+    kwargs = dict(
+        prompt=config.get("prompt"),
+        num_inference_steps=config.get("num_inference_steps"),
+        output_type="pt",
+    )
+
+    for cls, job in [
+        (ImageToImageDiffusion, dict(image=image)),
+        (
+            LatentWalkDiffusion,
+            dict(latent=model.random_tensor((1, 4, latent_dim, latent_dim))),
+        ),
+    ]:
+        pipeline = cls(model_id=model.model_id, device="cpu")
+        expected = pipeline(**job, **kwargs, generator=torch.Generator().manual_seed(0))
+        with StagedExecutor(pipeline) as executor:
+            output = executor.submit(
+                **job, **kwargs, generator=torch.Generator().manual_seed(0)
+            ).result()
+        torch.testing.assert_close(output, expected)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,75 @@
+import pytest
+import torch
+
+from stablefused.utils import EmbeddingCache
+
+
+def test_make_key():
+    input_ids = torch.tensor([49406, 320, 1125, 49407])
+    key = EmbeddingCache.make_key("model", input_ids, False)
+
+    assert key == EmbeddingCache.make_key("model", input_ids.clone(), False)
+    assert key != EmbeddingCache.make_key("model", input_ids, True)
+    assert key != EmbeddingCache.make_key("other-model", input_ids, False)
+
+
+def test_hits_and_misses():
+    cache = EmbeddingCache(max_entries=2)
+    embedding = torch.randn(4, 8)
+
+    assert cache.get("a") is None
+    cache.set("a", embedding)
+    assert cache.get("a") is embedding
+
+    info = cache.info()
+    assert info["hits"] == 1
+    assert info["misses"] == 1
+    assert info["entries"] == 1
+    assert info["bytes"] == embedding.numel() * embedding.element_size()
+
+
+def test_lru_eviction_by_entries():
+    cache = EmbeddingCache(max_entries=2)
+    cache.set("a", torch.zeros(2))
+    cache.set("b", torch.zeros(2))
+    cache.get("a")
+    cache.set("c", torch.zeros(2))
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+
+
+def test_lru_eviction_by_bytes():
+    embedding = torch.zeros(16, dtype=torch.float32)
+    size = embedding.numel() * embedding.element_size()
+    cache = EmbeddingCache(max_entries=8, max_bytes=2 * size)
+
+    cache.set("a", embedding.clone())
+    cache.set("b", embedding.clone())
+    cache.set("c", embedding.clone())
+
+    assert len(cache) == 2
+    assert "a" not in cache
+    assert cache.info()["bytes"] == 2 * size
+
+    cache.set("d", torch.zeros(64))
+    assert "d" not in cache
+
+
+def test_resize_and_clear():
+    cache = EmbeddingCache(max_entries=4)
+    for key in "abcd":
+        cache.set(key, torch.zeros(2))
+
+    cache.resize(max_entries=1)
+    assert len(cache) == 1
+    assert "d" in cache
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.info()["bytes"] == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
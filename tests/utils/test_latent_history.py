@@ -0,0 +1,73 @@
+import os
+import pytest
+import torch
+
+from stablefused.utils import LatentHistory
+
+
+@pytest.mark.parametrize("storage", ["device", "host", "memmap"])
+def test_latent_history(storage):
+    latents = [torch.randn(2, 4, 8, 8) for _ in range(5)]
+    history = LatentHistory(
+        num_latents=len(latents),
+        latent_shape=(2, 4, 8, 8),
+        device="cpu",
+        dtype=torch.float32,
+        storage=storage,
+    )
+    for step, latent in enumerate(latents):
+        history.append(step, latent)
+
+    expected = torch.stack(latents)
+    atol = 0 if storage == "device" else 1e-2
+
+    assert len(history) == len(latents)
+    assert history.shape == (5, 2, 4, 8, 8)
+    torch.testing.assert_close(history.to_tensor(), expected, rtol=0, atol=atol)
+    torch.testing.assert_close(history[:, 1], expected[:, 1], rtol=0, atol=atol)
+    assert history[0].dtype == torch.float32
+
+
+def test_latent_history_stride():
+    history = LatentHistory(
+        num_latents=6,
+        latent_shape=(1, 4),
+        device="cpu",
+        dtype=torch.float32,
+        storage="host",
+        stride=2,
+    )
+    for step in range(6):
+        history.append(step, torch.full((1, 4), float(step)))
+
+    assert history.steps == [0, 2, 4, 5]
+    assert history.to_tensor()[:, 0, 0].tolist() == [0.0, 2.0, 4.0, 5.0]
+
+
+def test_latent_history_memmap_cleanup(tmp_path):
+    history = LatentHistory(
+        num_latents=2,
+        latent_shape=(1, 4),
+        device="cpu",
+        dtype=torch.float32,
+        storage="memmap",
+        directory=str(tmp_path),
+    )
+    filename = history.filename
+
+    assert os.path.dirname(filename) == str(tmp_path)
+    assert os.path.exists(filename)
+
+    del history
+    assert not os.path.exists(filename)
+
+
+def test_latent_history_invalid_arguments():
+    with pytest.raises(ValueError):
+        LatentHistory(2, (1, 4), "cpu", torch.float32, storage="disk")
+    with pytest.raises(ValueError):
+        LatentHistory(2, (1, 4), "cpu", torch.float32, stride=0)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,71 @@
+import json
+import pytest
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ["diffusers", "transformers", "imageio", "tqdm"]
+
+
+def run_import(statement: str) -> dict:
+    """Run an import statement in a fresh interpreter and report what it loaded."""
+    code = f"""
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "elapsed": elapsed,
+    "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+}}))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def test_import_is_lazy():
+    result = run_import("import stablefused")
+
+    assert result["loaded"] == []
+    assert result["elapsed"] < 1.0
+
+
+def test_utilities_do_not_import_pipelines():
+    # torch itself imports tqdm
+    result = run_import("from stablefused import image_grid, slerp")
+
+    assert "diffusers" not in result["loaded"]
+    assert "transformers" not in result["loaded"]
+    assert "imageio" not in result["loaded"]
+
+
+def test_pipelines_are_imported_on_use():
+    result = run_import(
+        "import stablefused; stablefused.TextToImageDiffusion; stablefused.Scheduler"
+    )
+
+    assert "diffusers" in result["loaded"]
+    assert "transformers" in result["loaded"]
+
+
+def test_video_pipeline_does_not_import_imageio():
+    result = run_import("from stablefused import TextToVideoDiffusion")
+
+    assert "imageio" not in result["loaded"]
+
+
+def test_attributes():
+    import stablefused
+
+    assert "TextToImageDiffusion" in stablefused.__all__
+    assert "TextToImageDiffusion" in dir(stablefused)
+    assert stablefused.slerp is stablefused.utils.slerp
+
+    with pytest.raises(AttributeError):
+        stablefused.does_not_exist
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+from types import SimpleNamespace
+
+from stablefused.utils import ModelCache
+
+
+def make_model(model_id: str, features: int = 4, device: str = "cpu"):
+    return SimpleNamespace(
+        model_id=model_id,
+        torch_dtype=torch.float32,
+        device=device,
+        variant=None,
+        text_encoder=torch.nn.Linear(features, features),
+        vae=torch.nn.BatchNorm1d(features),
+        unet=torch.nn.Linear(features, features, bias=False),
+        fast_vae=None,
+    )
+
+
+def test_make_key():
+    key = ModelCache.make_key("model", torch.float32, "cpu")
+
+    assert key == ModelCache.make_key("model", torch.float32, torch.device("cpu"))
+    assert key != ModelCache.make_key("model", torch.float16, "cpu")
+    assert key != ModelCache.make_key("model", torch.float32, "cuda")
+    assert key != ModelCache.make_key("model", torch.float32, "cpu", "fp16")
+    assert key != ModelCache.make_key(
+        "model", torch.float32, "cpu", quantization="dynamic_int8"
+    )
+    assert key != ModelCache.make_key(
+        "model", torch.float32, "cpu", component_dtypes={"unet": torch.bfloat16}
+    )
+    assert key == ModelCache.make_key(
+        "model", torch.float32, "cpu", component_dtypes={"unet": torch.float32}
+    )
+    assert key == ModelCache.key_of(make_model("model"))
+
+
+def test_hits_misses_and_sizes():
+    cache = ModelCache()
+    model = make_model("a")
+    key = ModelCache.key_of(model)
+
+    assert cache.get(key) is None
+    cache.set(model)
+    assert cache.get(key) is model
+
+    info = cache.info()
+    assert info["hits"] == 1
+    assert info["misses"] == 1
+    assert info["entries"] == 1
+    # Linear with bias, BatchNorm1d parameters and buffers, and Linear without bias
+    assert info["components"][key] == {
+        "text_encoder": (16 + 4) * 4,
+        "vae": (4 + 4 + 4 + 4) * 4 + 8,
+        "unet": 16 * 4,
+    }
+    assert info["bytes"] == sum(info["components"][key].values())
+
+
+def test_lru_eviction_by_bytes():
+    models = [make_model(model_id) for model_id in "abc"]
+    size = sum(ModelCache.size_of(models[0]).values())
+    cache = ModelCache(max_bytes=2 * size)
+
+    cache.set(models[0])
+    cache.set(models[1])
+    cache.get(ModelCache.key_of(models[0]))
+    cache.set(models[2])
+
+    assert cache.keys() == [ModelCache.key_of(m) for m in [models[0], models[2]]]
+    assert cache.info()["evictions"] == 1
+    assert cache.info()["bytes"] == 2 * size
+
+    cache.set(make_model("d", features=64))
+    assert ModelCache.key_of(make_model("d")) not in cache
+
+
+def test_refresh_resize_and_clear():
+    cache = ModelCache()
+    model = make_model("a")
+    cache.set(model)
+
+    model.device = "meta"
+    cache.refresh(model)
+    assert cache.keys() == [ModelCache.key_of(model)]
+    cache.refresh(make_model("b"))
+    assert len(cache) == 1
+
+    cache.set(make_model("c"))
+    cache.resize(max_entries=1)
+    assert len(cache) == 1
+    assert cache.info()["evictions"] == 1
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.info()["bytes"] == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])